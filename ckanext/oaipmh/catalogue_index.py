@@ -0,0 +1,394 @@
+'''In-process index of the record headers of the catalogue.
+
+ListIdentifiers and the headers of ListRecords only need the time, the id,
+the setSpecs and the state of each record. With ckanext.oaipmh.catalogue_index
+on, each process keeps these in memory, as the latest change journal entry of
+each package, and pages the headers without querying the database. The index
+is loaded on start up and caught up from the journal when a package or group
+has changed in the process, and at most every
+ckanext.oaipmh.catalogue_index.refresh seconds for the changes of the other
+processes.
+
+Live and deleted records are kept apart, each sorted by change time and
+journal entry like the date-selective pages. Package ids are packed as 16
+bytes, and setSpecs as a number into a table of the distinct combinations,
+so that an entry takes some 70 bytes with its locator: 500,000 packages fit
+in about 35 MB.
+'''
+import re
+import time
+import bisect
+import hashlib
+import calendar
+import logging
+import threading
+from array import array
+from binascii import hexlify, unhexlify
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, or_
+from sqlalchemy.exc import SQLAlchemyError
+
+from pylons import config
+from paste.deploy.converters import asbool
+
+from ckan.model import Session
+
+from model import oai_change_journal_table, DELETE
+
+log = logging.getLogger(__name__)
+
+_KEY_BYTES = 16
+_UUID = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                   r'[0-9a-f]{12}$')
+# Journal entries of transactions committed this late after their change time
+# are still read by a catch up.
+LATE_COMMIT = timedelta(seconds=60)
+# Cursors remembered per request kind, to continue the next page from the end
+# of the previous one.
+MAX_VIEWS = 100
+
+
+def _stamp(dt):
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+def _datetime(stamp):
+    return datetime.utcfromtimestamp(round(stamp, 6))
+
+
+class _Segment(object):
+    '''Entries sorted by (time, journal id), in parallel arrays.
+    '''
+    def __init__(self):
+        self.stamps = array('d')
+        self.jids = array('L')
+        self.combos = array('I')
+        self.keys = bytearray()
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def bound(self, stamp):
+        '''Position of the first entry at or after a time.
+        '''
+        return bisect.bisect_left(self.stamps, stamp)
+
+    def position(self, stamp, jid):
+        lo = bisect.bisect_left(self.stamps, stamp)
+        hi = bisect.bisect_right(self.stamps, stamp, lo)
+        return bisect.bisect_left(self.jids, jid, lo, hi)
+
+    def insert(self, i, stamp, jid, combo, key):
+        self.stamps.insert(i, stamp)
+        self.jids.insert(i, jid)
+        self.combos.insert(i, combo)
+        self.keys[i * _KEY_BYTES:i * _KEY_BYTES] = key
+
+    def remove(self, i):
+        del self.stamps[i]
+        del self.jids[i]
+        del self.combos[i]
+        del self.keys[i * _KEY_BYTES:(i + 1) * _KEY_BYTES]
+
+    def key(self, i):
+        return str(self.keys[i * _KEY_BYTES:(i + 1) * _KEY_BYTES])
+
+
+class _Locator(object):
+    '''Where the entry of each package is: its key, in sorted order, and
+    the time, journal id and state of its entry.
+    '''
+    def __init__(self):
+        self.keys = bytearray()
+        self.stamps = array('d')
+        self.jids = array('L')
+        self.deleted = bytearray()
+
+    def search(self, key):
+        '''Return the position of a key, or where it would be inserted, and
+        whether it is there.
+        '''
+        keys, lo, hi = self.keys, 0, len(self.stamps)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys[mid * _KEY_BYTES:(mid + 1) * _KEY_BYTES] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = lo < len(self.stamps) and \
+            keys[lo * _KEY_BYTES:(lo + 1) * _KEY_BYTES] == key
+        return lo, found
+
+
+class _View(object):
+    '''The entries of one kind of request: a set and a time window, or all
+    live records followed by all deleted ones.
+    '''
+    def __init__(self, index, set_spec, from_, until):
+        self.merged = bool(from_ or until)
+        lo = _stamp(from_) if from_ else float('-inf')
+        hi = _stamp(until + timedelta(seconds=1)) if until else float('inf')
+        live, deleted = index.live, index.deleted
+        self.start = (live.bound(lo), deleted.bound(lo))
+        self.ends = (live.bound(hi), deleted.bound(hi))
+        self.match = None
+        if set_spec:
+            prefix = set_spec + ':'
+            self.match = [any(spec == set_spec or spec.startswith(prefix)
+                              for spec in combo) for combo in index.combos]
+
+    def walk(self, index, state):
+        '''Yield the segment and position of each entry from a state, with
+        the state after it.
+        '''
+        live, deleted = index.live, index.deleted
+        li, di = state
+        live_end, deleted_end = self.ends
+        match = self.match
+        while True:
+            if li < live_end and (
+                    not self.merged or di >= deleted_end or
+                    (live.stamps[li], live.jids[li]) <=
+                    (deleted.stamps[di], deleted.jids[di])):
+                segment, i = live, li
+                li += 1
+            elif di < deleted_end:
+                segment, i = deleted, di
+                di += 1
+            else:
+                return
+            if match is None or match[segment.combos[i]]:
+                yield segment, i, (li, di)
+
+    def seek(self, cursor):
+        '''Return the state at a cursor without walking to it, for all
+        records without a time window, or None.
+        '''
+        if self.merged or self.match is not None:
+            return None
+        live = self.ends[0] - self.start[0]
+        if cursor <= live:
+            return (self.start[0] + cursor, self.start[1])
+        return (self.ends[0], min(self.start[1] + cursor - live,
+                                  self.ends[1]))
+
+
+class CatalogueIndex(object):
+    '''The latest journal entry of each package, by state and time.
+    '''
+    def __init__(self):
+        self.live = _Segment()
+        self.deleted = _Segment()
+        self.combos = []
+        self._combo_ids = {}
+        self._locator = _Locator()
+        self._aliases = {}
+        self._checkpoints = {}
+        self.last_jid = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.live) + len(self.deleted)
+
+    def _key(self, package_id):
+        '''Pack a package id in 16 bytes: the bytes of a UUID, or a hash of
+        other ids, which are kept aside.
+        '''
+        if _UUID.match(package_id):
+            return unhexlify(package_id.replace('-', ''))
+        key = hashlib.md5(package_id.encode('utf-8')).digest()
+        self._aliases[key] = package_id
+        return key
+
+    def _package_id(self, key):
+        if key in self._aliases:
+            return self._aliases[key]
+        value = hexlify(key)
+        return u'%s-%s-%s-%s-%s' % (value[:8], value[8:12], value[12:16],
+                                    value[16:20], value[20:])
+
+    def _combo(self, set_specs):
+        combo = tuple(set_specs.split())
+        if combo not in self._combo_ids:
+            self._combo_ids[combo] = len(self.combos)
+            self.combos.append(combo)
+        return self._combo_ids[combo]
+
+    def apply(self, rows):
+        '''Apply (journal id, package id, change time, change type,
+        setSpecs) journal entries. Entries older than the one indexed for
+        their package are ignored.
+        '''
+        with self._lock:
+            changed = False
+            for row in rows:
+                changed = self._apply(*row) or changed
+            if changed:
+                self._checkpoints.clear()
+
+    def load(self, rows):
+        '''Fill the empty index with journal entries at once, which is much
+        faster than applying them one by one.
+        '''
+        latest = {}
+        for jid, package_id, changed, change_type, set_specs in rows:
+            latest[self._key(package_id)] = (
+                _stamp(changed), jid, self._combo(set_specs),
+                change_type == DELETE)
+        with self._lock:
+            for segment, deleted in ((self.live, False),
+                                     (self.deleted, True)):
+                entries = sorted((stamp, jid, combo, key) for key, (
+                    stamp, jid, combo, is_deleted) in latest.iteritems()
+                    if is_deleted == deleted)
+                segment.stamps = array('d', [e[0] for e in entries])
+                segment.jids = array('L', [e[1] for e in entries])
+                segment.combos = array('I', [e[2] for e in entries])
+                segment.keys = bytearray(''.join(e[3] for e in entries))
+                del entries
+            locator = self._locator
+            keys = sorted(latest)
+            locator.keys = bytearray(''.join(keys))
+            locator.stamps = array('d', [latest[key][0] for key in keys])
+            locator.jids = array('L', [latest[key][1] for key in keys])
+            locator.deleted = bytearray([latest[key][3] for key in keys])
+            self.last_jid = max(locator.jids or [0])
+            self._checkpoints.clear()
+
+    def _apply(self, jid, package_id, changed, change_type, set_specs):
+        key = self._key(package_id)
+        locator = self._locator
+        i, found = locator.search(key)
+        if found:
+            if locator.jids[i] >= jid:
+                return False
+            segment = self.deleted if locator.deleted[i] else self.live
+            segment.remove(segment.position(locator.stamps[i],
+                                            locator.jids[i]))
+        deleted = change_type == DELETE
+        stamp = _stamp(changed)
+        segment = self.deleted if deleted else self.live
+        segment.insert(segment.position(stamp, jid), stamp, jid,
+                       self._combo(set_specs), key)
+        if found:
+            locator.stamps[i], locator.jids[i] = stamp, jid
+            locator.deleted[i] = deleted
+        else:
+            locator.keys[i * _KEY_BYTES:i * _KEY_BYTES] = key
+            locator.stamps.insert(i, stamp)
+            locator.jids.insert(i, jid)
+            locator.deleted.insert(i, deleted)
+        self.last_jid = max(self.last_jid, jid)
+        return True
+
+    def page(self, set_spec, from_, until, cursor, batch_size):
+        '''Return (package id, time, setSpecs, deleted) of the records of a
+        page. Without a time window the live records come first, then the
+        deleted ones; with one they come in change order, as the change
+        journal gives them.
+        '''
+        cursor = cursor or 0
+        view_key = (set_spec, from_, until)
+        with self._lock:
+            view = _View(self, set_spec, from_, until)
+            state = view.seek(cursor)
+            if state is not None:
+                return self._items(view.walk(self, state), batch_size)[0]
+            checkpoints = self._checkpoints.get(view_key)
+            if checkpoints is None:
+                if len(self._checkpoints) >= MAX_VIEWS:
+                    self._checkpoints.clear()
+                checkpoints = self._checkpoints[view_key] = {}
+            # Continue from the nearest cursor already walked to.
+            start = max([c for c in checkpoints if c <= cursor] or [0])
+            state = checkpoints.get(start, view.start)
+            walk = view.walk(self, state)
+            for _ in xrange(cursor - start):
+                entry = next(walk, None)
+                if entry is None:
+                    return []
+                state = entry[2]
+            checkpoints[cursor] = state
+            items, state = self._items(walk, batch_size, state)
+            checkpoints[cursor + len(items)] = state
+            return items
+
+    def _items(self, walk, batch_size, state=None):
+        '''Read up to batch_size entries of a walk. Returns them with the
+        state after the last one.
+        '''
+        items = []
+        for segment, i, state in walk:
+            items.append((
+                self._package_id(segment.key(i)),
+                _datetime(segment.stamps[i]),
+                list(self.combos[segment.combos[i]]),
+                segment is self.deleted))
+            if batch_size is not None and len(items) == batch_size:
+                break
+        return items, state
+
+
+def _latest_entries(since_jid=None, recent=None):
+    '''Query the latest journal entry of each package, or the entries after
+    a journal id and those changed since a recent time, which may have been
+    committed after entries with later ids.
+    '''
+    journal = oai_change_journal_table
+    columns = [journal.c.id, journal.c.package_id, journal.c.changed,
+               journal.c.change_type, journal.c.set_specs]
+    if since_jid is None:
+        latest = select([func.max(journal.c.id)]).group_by(
+            journal.c.package_id)
+        query = select(columns).where(journal.c.id.in_(latest))
+    else:
+        query = select(columns).where(or_(journal.c.id > since_jid,
+                                          journal.c.changed >= recent))
+    return Session.execute(query.order_by(journal.c.id))
+
+
+_index = None
+_state = {'checked': 0}
+_lock = threading.Lock()
+
+
+def rebuild():
+    '''Load the index of the process from the change journal.
+    '''
+    global _index
+    index = CatalogueIndex()
+    index.load(_latest_entries())
+    with _lock:
+        _index = index
+        _state['checked'] = time.time()
+    log.info('Catalogue index loaded with %i records' % len(index))
+    return index
+
+
+def invalidate():
+    '''Have the index caught up with the journal before it is next used.
+    '''
+    _state['checked'] = 0
+
+
+def get_index():
+    '''Return the index of the process, caught up with the journal if it has
+    not been for a while, or None if it is off or cannot be loaded.
+    '''
+    if not asbool(config.get('ckanext.oaipmh.catalogue_index', False)):
+        return None
+    refresh = float(config.get('ckanext.oaipmh.catalogue_index.refresh', 5))
+    try:
+        if _index is None:
+            return rebuild()
+        with _lock:
+            if time.time() - _state['checked'] < refresh:
+                return _index
+            _state['checked'] = time.time()
+        _index.apply(_latest_entries(_index.last_jid,
+                                     datetime.utcnow() - LATE_COMMIT))
+    except SQLAlchemyError as e:
+        log.warning('Catalogue index unavailable: %s' % e)
+        return None
+    return _index
@@ -0,0 +1,160 @@
+'''Paster commands for the OAI-PMH interface.
+'''
+import sys
+import logging
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger(__name__)
+
+
+class OAIPMHCommand(CkanCommand):
+    '''Maintain the OAI-PMH interface.
+
+    Usage:
+
+      oaipmh snapshot
+        - Refresh the pre-rendered ListRecords snapshot with the datasets
+          changed since it was last built or refreshed (builds it if missing)
+
+      oaipmh snapshot-build
+        - Build a new generation of the snapshot from scratch
+
+      oaipmh rebuild-sets
+        - Rebuild the set membership index
+
+      oaipmh unpark [<harvest source id>]
+        - Retry the parked records and sets, which failed too often, in the
+          next harvests of all sources or of one
+
+      oaipmh compact-journal
+        - Drop the change journal entries superseded by a later change
+
+      oaipmh rebuild-journal
+        - Start the change journal over from the datasets and tombstones
+
+      oaipmh import <harvest job id> [--workers=<n>] [--budget=<seconds>]
+        - Import the harvest objects of a job which have not been imported
+          yet, in n processes (default: the number of CPUs), starting none
+          after the budget (default: ckanext.oaipmh.harvest.import_budget)
+
+      oaipmh reimport [<harvest source id>]
+        - Convert the harvested records kept in the record store again,
+          of all sources or of one, without fetching them
+
+      oaipmh benchmark-serializer [<records>]
+        - Time the rendering of a ListRecords response of synthetic records
+          (default: 1000) by the direct serializer and by the pyoai tree
+          server
+
+      oaipmh loadtest [<requests file>] [--concurrency=<n>] [--sessions=<n>]
+                      [--max-pages=<n>]
+        - Replay harvest sessions against /oai in process with n concurrent
+          clients (default: 4) and report the throughput, latency, errors
+          and response sizes per verb. The sessions are the requests of the
+          file, one query string or access log line per line, or a synthetic
+          mix of n sessions (default: 50). Resumption tokens are followed,
+          up to max-pages pages per session
+
+    The commands should be run from the ckanext-oaipmh directory and expect
+    a development.ini file to be present. Most of the time you will
+    specify the config explicitly though::
+
+        paster oaipmh snapshot --config=../ckan/development.ini
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(OAIPMHCommand, self).__init__(name)
+        self.parser.add_option('--workers', dest='workers', type='int',
+                               default=None,
+                               help='Number of import processes')
+        self.parser.add_option('--budget', dest='budget', type='float',
+                               default=None,
+                               help='Seconds after which no object is '
+                                    'imported')
+        self.parser.add_option('--concurrency', dest='concurrency',
+                               type='int', default=4,
+                               help='Number of load test clients')
+        self.parser.add_option('--sessions', dest='sessions', type='int',
+                               default=50,
+                               help='Number of synthetic load test sessions')
+        self.parser.add_option('--max-pages', dest='max_pages', type='int',
+                               default=None,
+                               help='Pages followed per load test session')
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0]
+        if cmd == 'snapshot':
+            from ckanext.oaipmh import snapshot
+            snapshot.refresh()
+        elif cmd == 'snapshot-build':
+            from ckanext.oaipmh import snapshot
+            snapshot.build()
+        elif cmd == 'rebuild-sets':
+            from ckanext.oaipmh.model import rebuild_set_index
+            rebuild_set_index()
+        elif cmd == 'unpark':
+            from ckanext.oaipmh.model import unpark_retries
+            source_id = self.args[1] if len(self.args) > 1 else None
+            print '%i records and sets unparked' % unpark_retries(source_id)
+        elif cmd == 'compact-journal':
+            from ckanext.oaipmh.model import compact_journal
+            print '%i journal entries dropped' % compact_journal()
+        elif cmd == 'rebuild-journal':
+            from ckanext.oaipmh.model import rebuild_journal
+            rebuild_journal()
+        elif cmd == 'import':
+            import multiprocessing
+            from pylons import config
+            from ckanext.oaipmh.harvester import OAIPMHHarvester
+            if len(self.args) < 2:
+                print 'Please give the id of a harvest job'
+                sys.exit(1)
+            workers = self.options.workers or multiprocessing.cpu_count()
+            budget = self.options.budget or float(config.get(
+                'ckanext.oaipmh.harvest.import_budget', 0))
+            print '%i harvest objects imported' % \
+                OAIPMHHarvester().import_job(self.args[1], workers, budget)
+        elif cmd == 'reimport':
+            from ckanext.oaipmh.harvester import OAIPMHHarvester
+            from ckanext.oaipmh import record_store
+            if not record_store.store_dir():
+                print 'Please configure ckanext.oaipmh.harvest.record_store'
+                sys.exit(1)
+            source_id = self.args[1] if len(self.args) > 1 else None
+            print '%i records imported' % OAIPMHHarvester().reimport(
+                source_id)
+        elif cmd == 'benchmark-serializer':
+            from ckanext.oaipmh.serializer import benchmark
+            records = int(self.args[1]) if len(self.args) > 1 else 1000
+            for prefix, (direct, tree) in sorted(benchmark(records).items()):
+                print '%s: direct %.3f s, tree %.3f s (%.1fx)' % (
+                    prefix, direct, tree, tree / direct)
+        elif cmd == 'loadtest':
+            self._loadtest()
+        else:
+            print 'Command %s not recognized' % cmd
+            sys.exit(1)
+
+    def _loadtest(self):
+        from paste.deploy import loadapp
+        import paste.fixture
+        from ckanext.oaipmh import loadtest
+        wsgiapp = loadapp('config:' + self.filename)
+        if len(self.args) > 1:
+            with open(self.args[1]) as f:
+                queries = loadtest.recorded_mix(f)
+        else:
+            identifiers = loadtest.sample_identifiers(
+                paste.fixture.TestApp(wsgiapp))
+            queries = loadtest.synthetic_mix(self.options.sessions,
+                                             identifiers)
+        stats = loadtest.run(wsgiapp, queries, self.options.concurrency,
+                             self.options.max_pages)
+        for line in stats.report():
+            print line
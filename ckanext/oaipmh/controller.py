@@ -1,20 +1,54 @@
 '''Serving controller interface for OAI-PMH
 '''
+import os
+import gzip
 import logging
 
 from ckan.lib.base import BaseController, render
 
-from pylons import request, response
+from pylons import request, response, config
 
-from oaipmh.server import BatchingServer, oai_dc_writer
+from oaipmh.server import oai_dc_writer
 from oaipmh import metadata
 from oaipmh.metadata import oai_dc_reader
 
 from oaipmh_server import CKANServer
 from rdftools import rdf_reader, rdf_writer
+from serializer import RecordServer
+from snapshot import find_page
+from throttle import get_throttle
+import response_cache
+import replica
+import profiling
 
 log = logging.getLogger(__name__)
 
+BLOCK_SIZE = 65536
+
+
+def _read_blocks(f):
+    try:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+    finally:
+        f.close()
+
+
+def _etag_matches(etag, if_none_match):
+    '''Return whether an If-None-Match header lists an entity tag, compared
+    weakly, or is *.
+    '''
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
 
 class OAIPMHController(BaseController):
     '''Controller for OAI-PMH server implementation. Returns only the index
@@ -27,25 +61,122 @@ class OAIPMHController(BaseController):
         if 'verb' in request.params:
             verb = request.params['verb'] if request.params['verb'] else None
             if verb:
-                client = CKANServer()
-                metadata_registry = metadata.MetadataRegistry()
-                if 'metadataPrefix' in request.params:
-                    if request.params['metadataPrefix'] == 'oai_dc':
-                        metadata_registry.registerReader('oai_dc',
-                                                         oai_dc_reader)
-                        metadata_registry.registerWriter('oai_dc',
-                                                         oai_dc_writer)
-                    else:
-                        metadata_registry.registerReader('rdf', rdf_reader)
-                        metadata_registry.registerWriter('rdf', rdf_writer)
-                else:
-                    metadata_registry.registerReader('oai_dc', oai_dc_reader)
-                    metadata_registry.registerWriter('oai_dc', oai_dc_writer)
-                serv = BatchingServer(client,
-                                      metadata_registry=metadata_registry)
-                parms = request.params.mixed()
-                res = serv.handleRequest(parms)
-                response.headers['content-type'] = 'text/xml; charset=utf-8'
-                return res
+                throttle = get_throttle()
+                retry_after = throttle.admit(verb, self._client())
+                if retry_after:
+                    return self._service_unavailable(retry_after)
+                try:
+                    with profiling.for_request() as profile:
+                        res = self._handle()
+                        profile.tag(**self._profile_tags(res))
+                    return res
+                finally:
+                    throttle.release(verb)
         else:
             return render('ckanext/oaipmh/oaipmh.xhtml')
+
+    def _handle(self):
+        '''Answer an OAI-PMH request from the snapshot, the response cache or
+        the database.
+        '''
+        params = request.params.mixed()
+        if params.get('verb') in response_cache.CACHED_VERBS:
+            return self._serve_cached(params)
+        snapshot_page = find_page(params)
+        if snapshot_page:
+            return self._serve_snapshot(snapshot_page)
+        return self._render(params)
+
+    def _render(self, params):
+        '''Answer an OAI-PMH request from the database, or from the replica
+        for the list verbs.
+        '''
+        session = None
+        if params.get('verb') in replica.REPLICA_VERBS:
+            session = replica.session()
+        client = CKANServer(session)
+        metadata_registry = metadata.MetadataRegistry()
+        if 'metadataPrefix' in request.params:
+            if request.params['metadataPrefix'] == 'oai_dc':
+                metadata_registry.registerReader('oai_dc', oai_dc_reader)
+                metadata_registry.registerWriter('oai_dc', oai_dc_writer)
+            else:
+                metadata_registry.registerReader('rdf', rdf_reader)
+                metadata_registry.registerWriter('rdf', rdf_writer)
+        else:
+            metadata_registry.registerReader('oai_dc', oai_dc_reader)
+            metadata_registry.registerWriter('oai_dc', oai_dc_writer)
+        serv = RecordServer(client, metadata_registry=metadata_registry)
+        try:
+            res = serv.handleRequest(params)
+        finally:
+            replica.remove()
+        response.headers['content-type'] = 'text/xml; charset=utf-8'
+        return res
+
+    def _serve_cached(self, params):
+        '''Answer a request which only depends on the configuration or the
+        groups from the response cache, with an ETag and a Cache-Control
+        lifetime of ckanext.oaipmh.cache.max_age seconds (default 300).
+        '''
+        version = response_cache.version(params['verb'])
+        entry = response_cache.get(params, version)
+        if entry is None:
+            entry = response_cache.put(params, version, self._render(params))
+        response.headers['content-type'] = 'text/xml; charset=utf-8'
+        response.headers['etag'] = entry.etag
+        response.headers['cache-control'] = 'public, max-age=%i' % int(
+            config.get('ckanext.oaipmh.cache.max_age', 300))
+        if 'Pragma' in response.headers:
+            del response.headers['Pragma']
+        if _etag_matches(entry.etag,
+                         request.headers.get('If-None-Match', '')):
+            response.status_int = 304
+            return ''
+        return entry.response()
+
+    def _profile_tags(self, res):
+        '''Tags of the profile of a request. Records are counted by their
+        headers in rendered responses, streamed ones are not counted.
+        '''
+        params = request.params
+        tags = {'verb': params.get('verb'),
+                'prefix': params.get('metadataPrefix'),
+                'set': params.get('set')}
+        if isinstance(res, basestring):
+            tags['records'] = res.count('<header>') + res.count('<header ')
+        return tags
+
+    def _client(self):
+        '''Identify the client for rate limiting by its address, or by the
+        first address of a header set by a proxy, e.g. X-Forwarded-For.
+        '''
+        header = config.get('ckanext.oaipmh.throttle.client_header')
+        if header and request.headers.get(header):
+            return request.headers[header].split(',')[0].strip()
+        return request.environ.get('REMOTE_ADDR')
+
+    def _service_unavailable(self, retry_after):
+        '''Ask the client to come back later, as OAI-PMH flow control does.
+        '''
+        response.status_int = 503
+        response.headers['Retry-After'] = str(retry_after)
+        response.headers['content-type'] = 'text/plain; charset=utf-8'
+        return 'Too many requests, retry after %i seconds.' % retry_after
+
+    def _serve_snapshot(self, path):
+        '''Stream a pre-rendered ListRecords page. It is sent gzipped as it is
+        stored if the client accepts that, through the front end server if
+        ckanext.oaipmh.snapshot.sendfile_header is set (e.g. X-Sendfile).
+        '''
+        response.headers['content-type'] = 'text/xml; charset=utf-8'
+        response.headers['vary'] = 'Accept-Encoding'
+        if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+            return _read_blocks(gzip.open(path, 'rb'))
+        response.headers['content-encoding'] = 'gzip'
+        sendfile_header = config.get('ckanext.oaipmh.snapshot.sendfile_header')
+        if sendfile_header:
+            response.headers[sendfile_header] = path
+            return ''
+        response.headers['content-length'] = str(os.path.getsize(path))
+        return _read_blocks(open(path, 'rb'))
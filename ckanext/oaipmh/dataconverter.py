@@ -19,6 +19,8 @@ from ckan.model.license import LicenseRegister, LicenseOtherPublicDomain
 from ckan.model.license import LicenseOtherClosed, LicenseNotSpecified
 from ckan.controllers.storage import BUCKET, get_ofs
 
+from model import advisory_lock
+
 log = logging.getLogger(__name__)
 
 
@@ -163,6 +165,40 @@ def _handle_format(nodes, namespaces):
     return d
 
 
+def _sync_resources(pkg, resources):
+    """
+    Bring the resources of a package in line with the given ones, matched by
+    URL. Unchanged resources are left alone, changed ones are updated in
+    place, vanished ones are deleted and new ones are added at once.
+    """
+    existing = {}
+    for resource in pkg.resources:
+        if resource.url in existing:
+            resource.state = 'deleted'  # Duplicate left by older harvests.
+        else:
+            existing[resource.url] = resource
+    new, seen = [], set()
+    for fields in resources:
+        if fields['url'] in seen:
+            continue
+        seen.add(fields['url'])
+        resource = existing.pop(fields['url'], None)
+        if resource is None:
+            new.append(fields)
+            continue
+        for key, value in fields.items():
+            # Assigning an equal value would still make a new revision.
+            if getattr(resource, key) != value:
+                setattr(resource, key, value)
+    for resource in existing.values():
+        resource.state = 'deleted'
+    if new:
+        resource_group = pkg.resource_groups_all[0]
+        resource_group.resources_all.extend(
+            [model.Resource(resource_group_id=resource_group.id, **fields)
+             for fields in new])
+
+
 def _oai_dc2ckan(data, namespaces, group, harvest_object):
     model.repo.new_revision()
     identifier = data['identifier']
@@ -172,19 +208,28 @@ def _oai_dc2ckan(data, namespaces, group, harvest_object):
     title = metadata.get('title', identifier)[0]
     #title = metadata['title'][0] if len(metadata['title']) else identifier
     name = data['package_name']
-    pkg = Package.get(name)
+    pkg = None
+    if data.get('package_id'):
+        # Known to the harvester, unless the hash of the identifier collided.
+        pkg = Package.get(data['package_id'])
+        if pkg is not None and pkg.name != name:
+            pkg = None
+    if not pkg:
+        pkg = Package.get(name)
+    if not pkg:
+        # Concurrent imports lock the package name, then the tag names in
+        # order, and only to create them. Saving commits and unlocks.
+        advisory_lock(u'package:' + name)
+        pkg = Package.get(name)
     if not pkg:
         pkg = Package(name=name, title=title, id=identifier)
         pkg.save()
         setup_default_user_roles(pkg)
     else:
         log.debug('Updating: %s' % name)
-        # There are old resources which are replaced by new ones if they are
-        # relevant anymore so "delete" all existing resources now.
-        for r in pkg.resources:
-            r.state = 'deleted'
     extras = {}
     idx = 0
+    tags = set()
     for s in ('subject', 'type',):
         for tag in metadata.get(s, []):
             # Turn each subject or type field into it's own tag.
@@ -192,22 +237,24 @@ def _oai_dc2ckan(data, namespaces, group, harvest_object):
             if tagi.startswith('http://') or tagi.startswith('https://'):
                 extras['tag_source_%i' % idx] = tagi
                 idx += 1
-                tags = []  # URL tags break links in UI.
+                # URL tags break links in UI.
             else:
-                tags = [tagi]
-            for tagi in tags:
-                tagi = tagi[:100]  # 100 char limit in DB.
-                tag_obj = model.Tag.by_name(tagi)
-                if not tag_obj:
-                    tag_obj = model.Tag(name=tagi)
-                    tag_obj.save()
-                pkgtag = model.Session.query(model.PackageTag).filter(
-                    model.PackageTag.package_id == pkg.id).filter(
-                        model.PackageTag.tag_id == tag_obj.id
-                    ).limit(1).first()
-                if pkgtag is None:
-                    pkgtag = model.PackageTag(tag=tag_obj, package=pkg)
-                    pkgtag.save()  # Avoids duplicates if tags have duplicates.
+                tags.add(tagi[:100])  # 100 char limit in DB.
+    for tagi in sorted(tags):
+        tag_obj = model.Tag.by_name(tagi)
+        if not tag_obj:
+            advisory_lock(u'tag:' + tagi)
+            tag_obj = model.Tag.by_name(tagi)
+        if not tag_obj:
+            tag_obj = model.Tag(name=tagi)
+            tag_obj.save()
+        pkgtag = model.Session.query(model.PackageTag).filter(
+            model.PackageTag.package_id == pkg.id).filter(
+                model.PackageTag.tag_id == tag_obj.id
+            ).limit(1).first()
+        if pkgtag is None:
+            pkgtag = model.PackageTag(tag=tag_obj, package=pkg)
+            pkgtag.save()
     extras.update(
         _handle_contributor(metadata.get('contributorNode', []), namespaces))
     extras.update(
@@ -248,11 +295,12 @@ def _oai_dc2ckan(data, namespaces, group, harvest_object):
         del extras['date']
     pkg.extras = extras
     pkg.url = data['package_url']
+    resources = []
     if 'package_resource' in data:
         try:
             ofs = get_ofs()
             ofs.put_stream(BUCKET, data['package_xml_save']['label'], data['package_xml_save']['xml'], {})
-            pkg.add_resource(**(data['package_resource']))
+            resources.append(data['package_resource'])
         except KeyError:
             pass
     if harvest_object is not None:
@@ -279,7 +327,9 @@ def _oai_dc2ckan(data, namespaces, group, harvest_object):
                 if ids.endswith(ext):
                     infer_format = ext
 
-            pkg.add_resource(ids, name=pkg.title, format=infer_format)
+            resources.append({'url': ids, 'name': pkg.title,
+                              'format': infer_format})
+    _sync_resources(pkg, resources)
     # All belong to the main group even if they do not belong to any set.
     if group is not None:
         group.add_package_by_name(pkg.name)
@@ -4,10 +4,15 @@ Harvester for OAI-PMH interfaces.
 #pylint: disable-msg=E1101,E0611,F0401
 import logging
 import json
+import base64
+import zlib
+import hashlib
 import urllib2
 import urllib
 import sys
-import httplib
+import time
+import multiprocessing
+from cStringIO import StringIO
 
 from lxml import etree
 from dataconverter import oai_dc2ckan
@@ -16,21 +21,35 @@ import datetime
 from ckan.model import Session, Package, Group, Member
 from ckan import model
 from ckanext.harvest.harvesters.base import HarvesterBase
-from ckanext.harvest.model import HarvestObject, HarvestJob
+from ckanext.harvest.model import HarvestObject, HarvestJob, HarvestSource
+from ckanext.harvest.queue import get_fetch_publisher
+from ckan.plugins import implements, IConfigurable, IDomainObjectModification
+from ckan.model.domain_object import DomainObjectOperation
 from ckan.model.authz import setup_default_user_roles
 from ckan.lib import helpers as h
 from pylons import config
-import oaipmh.client
+from paste.deploy.converters import asbool
 from oaipmh.metadata import MetadataReader, MetadataRegistry, oai_dc_reader
 from oaipmh.error import NoSetHierarchyError, NoRecordsMatchError
 from oaipmh.error import XMLSyntaxError
 from oaipmh import common
+from scheduler import TransientError
+from streaming import StreamingClient, parse_list
+from static_repository import StaticRepository, open_repository
+from static_repository import list_response, get_record_response
+from record_store import RecordClient
+import record_store
+import source_index
+import profiling
+from model import setup as setup_model, save_harvest_record, harvest_records
+from model import advisory_lock, forget_harvested_package
+from model import forget_harvest_records
+from model import save_retry, forget_retry, due_retries, parked_retries
 
 
 log = logging.getLogger(__name__)
 
 import socket
-socket.setdefaulttimeout(30)
 
 import traceback
 
@@ -102,12 +121,28 @@ class OAIPMHHarvester(HarvesterBase):
     """
     OAI-PMH Harvester for ckanext-harvester.
     """
+    implements(IConfigurable)
+    implements(IDomainObjectModification, inherit=True)
 
     config = None
 
     metadata_prefix_key = 'metadataPrefix'
     metadata_prefix_value = 'oai_dc'
 
+    def configure(self, config):
+        """
+        Create the tables where fetched records are kept.
+        """
+        setup_model()
+
+    def notify(self, entity, operation):
+        """
+        Forget purged packages, so that their records are imported again.
+        """
+        if isinstance(entity, Package) and \
+                operation == DomainObjectOperation.deleted:
+            forget_harvested_package(entity.id)
+
     def _set_config(self, config_str):
         """
         Set the configuration string.
@@ -133,7 +168,8 @@ class OAIPMHHarvester(HarvesterBase):
 
         try:
             config_obj = json.loads(config)
-            allowed_params = ['default_extras', 'default_tags', 'force_all']
+            allowed_params = ['default_extras', 'default_tags', 'force_all',
+                              'sharded']
 
             for key in config_obj:
                 if key not in allowed_params:
@@ -151,6 +187,10 @@ class OAIPMHHarvester(HarvesterBase):
                 if not isinstance(config_obj['force_all'], bool):
                     raise ValueError('force_all must be boolean')
 
+            if 'sharded' in config_obj:
+                if not isinstance(config_obj['sharded'], bool):
+                    raise ValueError('sharded must be boolean')
+
         except ValueError, e:
             raise e
 
@@ -179,10 +219,10 @@ class OAIPMHHarvester(HarvesterBase):
     def _get_client_identifier(self, url, harvest_job=None):
         registry = MetadataRegistry()
         registry.registerReader(self.metadata_prefix_value, oai_dc_reader)
-        client = oaipmh.client.Client(url, registry)
+        client = StreamingClient(url, registry)
         try:
             identifier = client.identify()
-        except (urllib2.URLError, urllib2.HTTPError,):
+        except (urllib2.URLError, urllib2.HTTPError, TransientError):
             if harvest_job:
                 self._save_gather_error(
                     'Could not gather from %s!' % harvest_job.source.url,
@@ -206,6 +246,9 @@ class OAIPMHHarvester(HarvesterBase):
 
     def _get_group(self, domain, in_revision=True):
         group = Group.by_name(domain)
+        if not group:
+            advisory_lock(u'group:' + domain)
+            group = Group.by_name(domain)
         if not group:
             if not in_revision:
                 model.repo.new_revision()
@@ -244,15 +287,37 @@ class OAIPMHHarvester(HarvesterBase):
             raise RuntimeError('Could not get source identifier.')
         # Get things to retry.
         ident2rec, ident2set = {}, {}
-        rec_idents = []
+        source_id = harvest_job.source.id
+        for kind, ident, set_name in due_retries(source_id):
+            if kind == 'record':
+                ident2rec[ident] = True
+            else:
+                ident2set[set_name] = ident
+        parked = parked_retries(source_id)
+        rec_idents, deleted = [], []
         domain = identifier.repositoryName()
+        sharded = self.config.get('sharded', False)
+        earliest = identifier.earliestDatestamp()
+        day_granularity = identifier.granularity() == 'YYYY-MM-DD'
+        # Past the budget the listing stops at the end of a page, and the
+        # fetch stage goes on from there.
+        client.deadline = time.time() + float(config.get(
+            'ckanext.oaipmh.harvest.gather_budget', 3600))
         try:
             args = {self.metadata_prefix_key: self.metadata_prefix_value}
             if not self.config.get('force_all', False):
                 args.update(from_until)
-            for ident in client.listIdentifiers(**args):
+            # Sharded sources are listed by the shards in the fetch stage.
+            for ident in [] if sharded else client.listIdentifiers(**args):
+                if ident.isDeleted():
+                    # Withdrawn by the provider, nothing to fetch.
+                    ident2rec.pop(ident.identifier(), None)
+                    deleted.append(ident.identifier())
+                    continue
                 if ident.identifier() in ident2rec:
                     continue  # On our retry list already, do not fetch twice.
+                if ('record', ident.identifier()) in parked:
+                    continue  # Failed too often, until it is unparked.
                 rec_idents.append(ident.identifier())
         except NoRecordsMatchError:
             log.debug('No records matched: %s' % domain)
@@ -263,15 +328,18 @@ class OAIPMHHarvester(HarvesterBase):
             self._save_gather_error(
                 'Could not fetch identifier list.', harvest_job)
             raise RuntimeError('Could not fetch an identifier list.')
+        resumption_token = client.resumption_token
+        client.deadline = None
         # Gathering the set list here. Member identifiers in fetch.
-        sets = []
+        sets, listed_sets = [], []
         try:
             for set_ in client.listSets():
                 identifier, name, _ = set_
                 # Is set due for retry and it is not missing member insertion?
                 # Set either failed in retry of misses packages but not both.
                 # Set with failed insertions may have new members.
-                if name in ident2set:
+                listed_sets.append((identifier, name,))
+                if name in ident2set or ('set', identifier) in parked:
                     continue
                 sets.append((identifier, name,))
         except NoSetHierarchyError:
@@ -285,15 +353,42 @@ class OAIPMHHarvester(HarvesterBase):
         # Since network errors can't occur anymore, it's ok to create the
         # harvest objects to return to caller since we are not missing anything
         # crucial.
-        harvest_objs, set_objs, insertion_retries = [], [], set()
-        for ident in rec_idents:
+        harvest_objs, set_objs = [], []
+        # Records to retry first.
+        for ident in sorted(ident2rec) + rec_idents:
             info = {'fetch_type': 'record', 'record': ident, 'domain': domain}
             harvest_obj = HarvestObject(job=harvest_job)
             harvest_obj.content = json.dumps(info)
             harvest_obj.save()
             harvest_objs.append(harvest_obj.id)
+        harvest_objs.extend(
+            self._deletion_objects(harvest_job, domain, deleted))
+        if resumption_token:
+            log.info('Gather budget spent, %s is listed further by the '
+                     'fetch stage.' % domain)
+            harvest_objs.append(self._continuation(harvest_job, {
+                'fetch_type': 'listing', 'domain': domain,
+                'resumption_token': resumption_token}).id)
+        if sharded:
+            limits = {} if self.config.get('force_all', False) else from_until
+            for shard in self._shards(listed_sets, limits, earliest,
+                                      day_granularity):
+                info = dict(shard, fetch_type='shard', domain=domain,
+                            day_granularity=day_granularity)
+                harvest_obj = HarvestObject(job=harvest_job)
+                harvest_obj.content = json.dumps(info)
+                harvest_obj.save()
+                harvest_objs.append(harvest_obj.id)
         log.info('Gathered %i records from %s.' % (len(harvest_objs), domain,))
-        # Add sets to retry first.
+        # Add sets to retry first. They are listed whole, to insert their
+        # members which were missing.
+        for set_name, set_id in sorted(ident2set.items()):
+            harvest_obj = HarvestObject(job=harvest_job)
+            info = {'fetch_type': 'set', 'set': set_id, 'set_name': set_name,
+                    'domain': domain}
+            harvest_obj.content = json.dumps(info)
+            harvest_obj.save()
+            set_objs.append(harvest_obj.id)
         harvest_objs.extend(set_objs)
         for set_id, set_name in sets:
             harvest_obj = HarvestObject(job=harvest_job)
@@ -309,6 +404,39 @@ class OAIPMHHarvester(HarvesterBase):
             'Gathered %i records/sets from %s.' % (len(harvest_objs), domain,))
         return harvest_objs
 
+    def _shards(self, sets, from_until, earliest, day_granularity):
+        """
+        Split the records of a source into shards which can be listed
+        independently: one per set if the source has sets, and one for the
+        records which no set shard keeps, otherwise consecutive date
+        windows.
+        """
+        dates = {}
+        for key in ('from_', 'until'):
+            if key in from_until:
+                dates[key] = self._str_from_datetime(from_until[key])
+        if sets:
+            set_ids = sorted(set_id for set_id, _ in sets)
+            return [dict(dates, set=set_id) for set_id in set_ids] + \
+                [dict(dates, rest=True, sets=set_ids)]
+        count = int(config.get('ckanext.oaipmh.harvest.date_shards', 8))
+        start = from_until.get('from_') or earliest
+        if start is None:
+            return [dates]
+        end = from_until.get('until') or datetime.datetime.utcnow()
+        windows = _date_windows(start, end, count, day_granularity)
+        shards = []
+        for i, (window_from, window_until) in enumerate(windows):
+            shard = {}
+            # The first and last windows stay open unless the harvest has
+            # limits, so that nothing outside of the windows is missed.
+            if i or 'from_' in dates:
+                shard['from_'] = self._str_from_datetime(window_from)
+            if i < len(windows) - 1 or 'until' in dates:
+                shard['until'] = self._str_from_datetime(window_until)
+            shards.append(shard)
+        return shards
+
     def gather_stage(self, harvest_job):
         """
         The gather stage will recieve a HarvestJob object and will be
@@ -328,7 +456,11 @@ class OAIPMHHarvester(HarvesterBase):
         model.repo.new_revision()
         result = None
         try:
-            result = self._gather_stage(harvest_job)
+            with profiling.for_job(harvest_job, verb='gather',
+                                   prefix=self.metadata_prefix_value) \
+                    as profile:
+                result = self._gather_stage(harvest_job)
+                profile.tag(records=len(result or []))
         except Exception as e:
             log.error(traceback.format_exc(e))
         model.repo.commit()
@@ -348,10 +480,224 @@ class OAIPMHHarvester(HarvesterBase):
         :param harvest_object: HarvestObject object
         :returns: True if everything went right, False if errors were found
         """
-        # I needed to store things that don't pickle so import has to do all
-        # the work. Well, this avoids saving intermediate info in the DB.
+        # Records are fetched here and kept compressed, in the record store
+        # if there is one so that they can be imported again later. Sets are
+        # listed in the import stage which needs their member packages.
+        self._set_config(harvest_object.job.source.config)
+        ident = json.loads(harvest_object.content)
+        with profiling.for_job(harvest_object.job, verb='fetch',
+                               **self._profile_tags(ident)):
+            return self._fetch(harvest_object, ident)
+
+    def _fetch(self, harvest_object, ident):
+        if ident['fetch_type'] == 'shard':
+            return self._fetch_shard(harvest_object, ident)
+        if ident['fetch_type'] == 'listing':
+            return self._fetch_listing(harvest_object, ident)
+        if ident['fetch_type'] != 'record':
+            return True
+        client = StreamingClient(harvest_object.job.source.url)
+        try:
+            raw = client.makeRequest(
+                verb='GetRecord', metadataPrefix=self.metadata_prefix_value,
+                identifier=ident['record'])
+        except TransientError as e:
+            return self._requeue(harvest_object, e)
+        except urllib2.HTTPError:
+            self._retry_later(harvest_object, ident, 'http')
+            self._save_object_error(
+                'Failed to fetch record.',
+                harvest_object, stage='Fetch')
+            return False
+        except Exception as e:
+            log.debug(traceback.format_exc(e))
+            self._retry_later(harvest_object, ident, 'error')
+            self._save_object_error(
+                'Failed to fetch record: %s' % e,
+                harvest_object, stage='Fetch')
+            return False
+        ident['digest'] = hashlib.sha1(raw).hexdigest()
+        if not record_store.put(raw):
+            ident['raw'] = base64.b64encode(zlib.compress(raw))
+        harvest_object.content = json.dumps(ident)
+        harvest_object.save()
         return True
 
+    def _batch_object(self, harvest_job, domain, records, digests):
+        raw = list_response(records)
+        info = {'fetch_type': 'batch', 'domain': domain, 'digests': digests,
+                'raw': base64.b64encode(zlib.compress(raw))}
+        harvest_obj = HarvestObject(job=harvest_job)
+        harvest_obj.content = json.dumps(info)
+        harvest_obj.save()
+        return harvest_obj.id
+
+    def _fetch_shard(self, harvest_object, ident):
+        """
+        List the records of a shard and queue them in batches for import.
+        A record is kept by the shard of its first set. The records without
+        sets, or whose first set has no shard, are kept by the rest shard,
+        which lists all records.
+        """
+        if ident.get('batches') is not None:
+            return True  # Already listed, requeued for its import.
+        client = StreamingClient(harvest_object.job.source.url)
+        client._day_granularity = ident.get('day_granularity', False)
+        client.deadline = self._stage_deadline()
+        args = {self.metadata_prefix_key: self.metadata_prefix_value}
+        if 'set' in ident:
+            args['set'] = ident['set']
+        for key in ('from_', 'until'):
+            if key in ident:
+                args[key] = self._datetime_from_str(ident[key])
+        if 'resumption_token' in ident:
+            args = {'resumptionToken': ident['resumption_token']}
+        batch_size = int(config.get(
+            'ckanext.oaipmh.harvest.static_batch_size', 100))
+        sharded_sets = set(ident.get('sets', ()))
+        batches, records, digests, deleted = [], [], {}, []
+        try:
+            for header, record in client.listRawRecords(**args):
+                first = min(header.setSpec()) if header.setSpec() else None
+                if 'set' in ident and first != ident['set']:
+                    continue
+                if ident.get('rest') and first in sharded_sets:
+                    continue
+                if header.isDeleted():
+                    deleted.append(header.identifier())
+                    continue
+                response = get_record_response(record)
+                digests[header.identifier()] = record_store.put(response) \
+                    or hashlib.sha1(response).hexdigest()
+                records.append(record)
+                if len(records) == batch_size:
+                    batches.append(self._batch_object(
+                        harvest_object.job, ident['domain'], records,
+                        digests))
+                    records, digests = [], {}
+        except NoRecordsMatchError:
+            pass  # Ok, empty shard.
+        except TransientError as e:
+            return self._requeue(harvest_object, e)
+        except Exception as e:
+            log.debug(traceback.format_exc(e))
+            self._save_object_error('Failed to list the records of a shard.',
+                                    harvest_object, stage='Fetch')
+            return False
+        if records:
+            batches.append(self._batch_object(
+                harvest_object.job, ident['domain'], records, digests))
+        batches.extend(self._deletion_objects(harvest_object.job,
+                                              ident['domain'], deleted))
+        self._publish(batches)
+        if client.resumption_token:
+            # Stage budget spent, the rest of the shard is listed next.
+            rest = dict((key, ident[key]) for key in
+                        ('set', 'rest', 'sets', 'domain', 'day_granularity')
+                        if key in ident)
+            self._publish([self._continuation(harvest_object.job, dict(
+                rest, fetch_type='shard',
+                resumption_token=client.resumption_token)).id])
+        ident['batches'] = len(batches)
+        harvest_object.content = json.dumps(ident)
+        harvest_object.save()
+        log.debug('Shard %s listed in %i batches.' % (
+            harvest_object.id, len(batches)))
+        return True
+
+    def _fetch_listing(self, harvest_object, ident):
+        """
+        Go on with a ListIdentifiers listing which the gather stage did not
+        finish within its budget, queueing a record object for each
+        identifier.
+        """
+        if ident.get('records') is not None:
+            return True  # Already listed, requeued for its import.
+        client = StreamingClient(harvest_object.job.source.url)
+        client.deadline = self._stage_deadline()
+        parked = parked_retries(harvest_object.job.source_id)
+        object_ids, deleted = [], []
+        try:
+            for header in client.listIdentifiers(
+                    resumptionToken=ident['resumption_token']):
+                if header.isDeleted():
+                    deleted.append(header.identifier())
+                    continue
+                if ('record', header.identifier()) in parked:
+                    continue
+                object_ids.append(self._continuation(harvest_object.job, {
+                    'fetch_type': 'record', 'record': header.identifier(),
+                    'domain': ident['domain']}).id)
+        except NoRecordsMatchError:
+            pass
+        except TransientError as e:
+            return self._requeue(harvest_object, e)
+        except Exception as e:
+            log.debug(traceback.format_exc(e))
+            self._save_object_error('Failed to go on with the listing.',
+                                    harvest_object, stage='Fetch')
+            return False
+        object_ids.extend(self._deletion_objects(harvest_object.job,
+                                                 ident['domain'], deleted))
+        if client.resumption_token:
+            object_ids.append(self._continuation(harvest_object.job, dict(
+                ident, resumption_token=client.resumption_token)).id)
+        self._publish(object_ids)
+        ident['records'] = len(object_ids)
+        harvest_object.content = json.dumps(ident)
+        harvest_object.save()
+        return True
+
+    def _deletion_objects(self, harvest_job, domain, identifiers):
+        """
+        Create harvest objects withdrawing the records the provider has
+        deleted, in batches. Returns their ids.
+        """
+        batch_size = int(config.get(
+            'ckanext.oaipmh.harvest.deletion_batch_size', 500))
+        return [self._continuation(harvest_job, {
+            'fetch_type': 'deletions', 'domain': domain,
+            'records': identifiers[i:i + batch_size]}).id
+            for i in range(0, len(identifiers), batch_size)]
+
+    def _stage_deadline(self):
+        """
+        Return the time at which the listing of a harvest object should stop,
+        leaving the rest to a continuation object.
+        """
+        return time.time() + float(config.get(
+            'ckanext.oaipmh.harvest.stage_budget', 900))
+
+    def _continuation(self, harvest_job, info):
+        harvest_obj = HarvestObject(job=harvest_job)
+        harvest_obj.content = json.dumps(info)
+        harvest_obj.save()
+        return harvest_obj
+
+    def _publish(self, object_ids):
+        """
+        Put harvest objects created after the gather stage on the fetch
+        queue.
+        """
+        if not object_ids:
+            return
+        publisher = get_fetch_publisher()
+        try:
+            for object_id in object_ids:
+                publisher.send({'harvest_object_id': object_id})
+        finally:
+            publisher.close()
+
+    def _stored_record(self, ident):
+        """
+        Return the raw record kept by the fetch stage, if any.
+        """
+        if 'raw' in ident:
+            return zlib.decompress(base64.b64decode(ident['raw']))
+        if 'digest' in ident:
+            return record_store.get(ident['digest'])
+        return None
+
     def import_stage(self, harvest_object):
         """
         The import stage will receive a HarvestObject object and will be
@@ -369,16 +715,58 @@ class OAIPMHHarvester(HarvesterBase):
         :param harvest_object: HarvestObject object
         :returns: True if everything went right, False if errors were found
         """
+        if asbool(config.get('ckanext.oaipmh.harvest.deferred_import', False)):
+            # Left to "paster oaipmh import", which imports in parallel.
+            return True
+        ident = json.loads(harvest_object.content or '{}')
+        with profiling.for_job(harvest_object.job, verb='import',
+                               **self._profile_tags(ident)):
+            return self._import(harvest_object)
+
+    def _profile_tags(self, ident):
+        """
+        Return the tags of the profile of a stage of a harvest object.
+        """
+        records = None
+        if ident.get('fetch_type') == 'record':
+            records = 1
+        elif ident.get('fetch_type') == 'batch':
+            records = len(ident['digests'])
+        elif ident.get('fetch_type') == 'deletions':
+            records = len(ident['records'])
+        return {'prefix': self.metadata_prefix_value,
+                'set': ident.get('set_name') or ident.get('set'),
+                'records': records}
+
+    def _import(self, harvest_object):
         # Do common tasks and then call different methods depending on what
         # kind of info the harvest object contains.
         self._set_config(harvest_object.job.source.config)
         ident = json.loads(harvest_object.content)
         registry = MetadataRegistry()
         registry.registerReader(self.metadata_prefix_value, oai_dc_reader)
-        client = oaipmh.client.Client(harvest_object.job.source.url, registry)
+        raw = self._stored_record(ident)
+        if raw is not None:
+            client = RecordClient(raw, registry)
+        else:
+            client = StreamingClient(harvest_object.job.source.url, registry)
         domain = ident['domain']
-        group = Group.get(domain)  # Checked in gather_stage so exists.
+        group = source_index.for_job(harvest_object.job).group(domain, domain)
         try:
+            if ident['fetch_type'] in ('shard', 'listing', 'requeued'):
+                # Its records are imported from the objects it queued.
+                harvest_object.content = None
+                harvest_object.save()
+                return True
+            if ident['fetch_type'] == 'batch':
+                return self._import_batch(harvest_object, ident, raw,
+                                          registry, group)
+            if ident['fetch_type'] == 'deletions':
+                self._withdraw(harvest_object.job, ident['records'])
+                harvest_object.content = None
+                harvest_object.current = True
+                harvest_object.save()
+                return True
             if ident['fetch_type'] == 'record':
                 return self._fetch_import_record(
                     harvest_object, ident, client, group)
@@ -387,12 +775,63 @@ class OAIPMHHarvester(HarvesterBase):
                     harvest_object, ident, client, group)
             # This should not happen...
             log.error('Unknown fetch type: %s' % ident['fetch_type'])
+        except TransientError as e:
+            return self._requeue(harvest_object, e)
         except Exception as e:
             # Guard against miscellaneous stuff. Probably plain bugs.
             # Also very rare exceptions we haven't seen yet.
             log.debug(traceback.format_exc(e))
         return False
 
+    def _requeue(self, harvest_object, error):
+        """
+        Hand a harvest object whose fetch failed transiently over to a new
+        object on the fetch queue. The fetch queue gives up on an object
+        after a few deliveries, so the attempts are counted in the content
+        of the objects. After max_requeue attempts the record or set goes to
+        the retry queue instead. The scheduler of the host delays the next
+        attempt.
+        """
+        ident = json.loads(harvest_object.content or '{}')
+        requeued = ident.get('requeued', 0)
+        max_requeue = int(config.get('ckanext.oaipmh.harvest.max_requeue', 5))
+        if requeued >= max_requeue:
+            self._retry_later(harvest_object, ident, 'transient')
+            self._save_object_error(
+                'Gave up after %i attempts: %s' % (requeued + 1, error),
+                harvest_object, stage='Fetch')
+            return False
+        retry = self._continuation(harvest_object.job,
+                                   dict(ident, requeued=requeued + 1))
+        self._publish([retry.id])
+        log.info('Requeued %s as %s: %s' % (harvest_object.id, retry.id,
+                                            error))
+        harvest_object.content = json.dumps(
+            {'fetch_type': 'requeued', 'domain': ident.get('domain')})
+        harvest_object.save()
+        return True
+
+    def _retry_later(self, harvest_object, ident, failure):
+        """
+        Count a failure of the record or set of a harvest object, so that a
+        later harvest of the source retries it once due, or parks it after
+        too many failures. The caller commits.
+        """
+        if ident.get('fetch_type') == 'record':
+            kind, identifier, set_name = 'record', ident['record'], None
+        elif ident.get('fetch_type') == 'set' and 'set' in ident:
+            kind, identifier, set_name = 'set', ident['set'], ident['set_name']
+        else:
+            return
+        next_attempt = save_retry(
+            harvest_object.job.source_id, kind, identifier, failure,
+            int(config.get('ckanext.oaipmh.harvest.retry_backoff', 3600)),
+            int(config.get('ckanext.oaipmh.harvest.max_retries', 5)),
+            set_name)
+        if next_attempt is None:
+            log.warning('Parked %s %s after repeated failures (%s).' % (
+                kind, identifier, failure))
+
     def _package_name_from_identifier(self, identifier):
         return urllib.quote_plus(urllib.quote_plus(identifier))
 
@@ -411,6 +850,17 @@ class OAIPMHHarvester(HarvesterBase):
         return metadata
 
     def _fetch_import_record(self, harvest_object, master_data, client, group):
+        index = source_index.for_job(harvest_object.job)
+        known = index.packages.get(master_data['record'])
+        if known and known[1] and known[1] == master_data.get('digest'):
+            # Unchanged since it was last imported.
+            forget_retry(harvest_object.job.source_id, 'record',
+                         master_data['record'])
+            harvest_object.package_id = known[0]
+            harvest_object.content = None
+            harvest_object.current = True
+            harvest_object.save()
+            return True
         # The fetch part.
         try:
             header, metadata, _ = client.getRecord(
@@ -418,49 +868,211 @@ class OAIPMHHarvester(HarvesterBase):
                 identifier=master_data['record'])
         except XMLSyntaxError:
             log.error('oai_dc XML syntax error: %s' % master_data['record'])
+            self._retry_later(harvest_object, master_data, 'syntax')
             self._save_object_error(
                 'Syntax error.',
                 harvest_object, stage='Fetch')
             return False
-        except socket.error:
-            errno, errstr = sys.exc_info()[:2]
-            self._save_object_error(
-                'Socket error OAI-PMH %s, details:\n%s' % (errno, errstr),
-                harvest_object, stage='Fetch')
-            return False
-        except urllib2.URLError:
+        except urllib2.HTTPError:
+            self._retry_later(harvest_object, master_data, 'http')
             self._save_object_error(
                 'Failed to fetch record.',
                 harvest_object, stage='Fetch')
             return False
-        except httplib.BadStatusLine:
-            self._save_object_error(
-                'Bad HTTP response status line.',
-                harvest_object, stage='Fetch')
+        if header.isDeleted():
+            # Deleted since it was listed.
+            self._withdraw(harvest_object.job, [master_data['record']])
+            harvest_object.content = None
+            harvest_object.save()
+            return True
+        package_id = self._import_record(harvest_object, header, metadata,
+                                         group, known and known[0])
+        if not package_id:
+            self._retry_later(harvest_object, master_data, 'metadata')
+            model.Session.commit()
             return False
+        source_id = harvest_object.job.source_id
+        forget_retry(source_id, 'record', master_data['record'])
+        if 'digest' in master_data:
+            save_harvest_record(source_id, master_data['record'],
+                                master_data['domain'],
+                                master_data['digest'], package_id)
+        model.Session.commit()
+        return True
+
+    def _import_batch(self, harvest_object, ident, raw, registry, group):
+        """
+        Import a batch of records read from a static repository. Records
+        unchanged since they were last imported are skipped.
+        """
+        index = source_index.for_job(harvest_object.job)
+        imported = 0
+        for item in parse_list(StringIO(raw), 'ListRecords',
+                               self.metadata_prefix_value, registry):
+            if not isinstance(item, tuple):
+                continue  # No resumption token at the end.
+            header, metadata, _ = item
+            identifier = header.identifier()
+            digest = ident['digests'].get(identifier)
+            known = index.packages.get(identifier)
+            if known and known[1] and known[1] == digest:
+                continue
+            package_id = self._import_record(None, header, metadata, group,
+                                             known and known[0])
+            if package_id:
+                save_harvest_record(harvest_object.job.source_id, identifier,
+                                    ident['domain'], digest, package_id)
+                model.Session.commit()
+                imported += 1
+        log.debug('Imported %i of %i records of a batch.' % (
+            imported, len(ident['digests'])))
+        harvest_object.content = None
+        harvest_object.current = True
+        harvest_object.save()
+        return True
+
+    def _withdraw(self, harvest_job, identifiers):
+        """
+        Delete the packages of records the provider has deleted, and their
+        set memberships, in one revision. The records are forgotten, so that
+        they are imported anew if they come back. Returns the number of
+        withdrawn packages.
+        """
+        names = [self._package_name_from_identifier(identifier)
+                 for identifier in identifiers]
+        model.repo.new_revision()
+        packages = Session.query(Package).filter(
+            Package.name.in_(names)).filter(
+            Package.state != 'deleted').all()
+        if packages:
+            members = Session.query(Member).filter(
+                Member.table_name == 'package').filter(
+                Member.table_id.in_([package.id for package in packages])
+            ).filter(Member.state == 'active')
+            for member in members:
+                member.state = 'deleted'
+            for package in packages:
+                package.state = 'deleted'
+        forget_harvest_records(harvest_job.source_id, identifiers)
+        model.repo.commit()
+        log.debug('Withdrew %i packages of %i deleted records.' % (
+            len(packages), len(identifiers)))
+        return len(packages)
+
+    def _import_record(self, harvest_object, header, metadata, group,
+                       package_id=None):
+        """
+        Create or update the package of a record. Returns the id of the
+        package, or False if the record could not be imported.
+        """
+        identifier = header.identifier()
         if not metadata:
             # Assume that there is no metadata and not an error.
             # Should this be a cause for retry?
-            log.warning('No metadata: %s' % master_data['record'])
+            log.warning('No metadata: %s' % identifier)
             return False
         if 'date' not in metadata.getMap() or not metadata.getMap()['date']:
-            self._save_object_error(
-                'Missing date: %s' % master_data['record'],
-                harvest_object, stage='Fetch')
+            if harvest_object is not None:
+                self._save_object_error(
+                    'Missing date: %s' % identifier,
+                    harvest_object, stage='Fetch')
+            else:
+                log.warning('Missing date: %s' % identifier)
             return False
-        master_data['record'] = (header.identifier(), metadata.getMap())
+        record = metadata.getMap()
         # Do not save to database (because we can't json nor pickle _Element).
         # The import stage.
         # Gather all relevant information into a dictionary.
         data = {
-            'identifier': master_data['record'][0],
-            'metadata': self._metadata(master_data['record'][1]),
-            'package_name': self._package_name_from_identifier(master_data['record'][0]),
-            'package_url': master_data['record'][1]['source'][0] if master_data['record'][1]['source'] else ''
+            'identifier': identifier,
+            'metadata': self._metadata(record),
+            'package_name': self._package_name_from_identifier(identifier),
+            'package_url': record['source'][0] if record['source'] else ''
         }
+        if package_id:
+            data['package_id'] = package_id
 
         return oai_dc2ckan(data, oai_dc_reader._namespaces, group, harvest_object)
 
+    def reimport(self, source_id=None):
+        """
+        Convert the stored records again, of all harvest sources or of one,
+        without fetching them. Records which cannot be loaded from the store
+        are skipped. Returns the number of imported records.
+        """
+        if not record_store.store_dir():
+            raise ValueError(
+                'ckanext.oaipmh.harvest.record_store is not configured')
+        registry = MetadataRegistry()
+        registry.registerReader(self.metadata_prefix_value, oai_dc_reader)
+        imported, current = 0, None
+        for record_source_id, identifier, domain, digest in harvest_records(
+                source_id):
+            if record_source_id != current:
+                current = record_source_id
+                source = Session.query(HarvestSource).get(current)
+                self._set_config(source.config if source else None)
+            try:
+                raw = record_store.get(digest)
+            except (IOError, OSError) as e:
+                log.warning('Could not load stored %s: %s' % (identifier, e))
+                continue
+            client = RecordClient(raw, registry)
+            try:
+                header, metadata, _ = client.getRecord(
+                    metadataPrefix=self.metadata_prefix_value,
+                    identifier=identifier)
+            except Exception as e:
+                log.warning('Could not read stored %s: %s' % (identifier, e))
+                continue
+            if self._import_record(None, header, metadata, Group.get(domain)):
+                imported += 1
+        log.info('Imported %i stored records.' % imported)
+        return imported
+
+    def import_job(self, job_id, workers=1, budget=None):
+        """
+        Import the harvest objects of a job which have not been imported yet,
+        in parallel processes. Records are partitioned by a hash of their
+        package name, so that each package is imported by one process only,
+        and the sets are imported once all records are. No object is started
+        after budget seconds, the others are left for a later run. Returns
+        the number of imported objects.
+        """
+        deadline = time.time() + budget if budget else None
+        partitions = [[] for i in range(workers)]
+        sets = []
+        query = Session.query(HarvestObject.id, HarvestObject.content).filter(
+            HarvestObject.harvest_job_id == job_id).filter(
+            HarvestObject.content != None)
+        batches = 0
+        for object_id, content in query:
+            ident = json.loads(content)
+            if ident['fetch_type'] == 'record':
+                name = self._package_name_from_identifier(ident['record'])
+                partition = (zlib.crc32(name) & 0xffffffff) % workers
+                partitions[partition].append(object_id)
+            elif ident['fetch_type'] == 'batch':
+                # Records of a static repository, which are read once.
+                partitions[batches % workers].append(object_id)
+                batches += 1
+            else:
+                sets.append(object_id)
+        Session.remove()
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, _init_import_worker)
+            try:
+                imported = sum(pool.map(_import_partition, [
+                    (partition, deadline) for partition in partitions]))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            imported = _import_objects(partitions[0], deadline)
+        imported += _import_objects(sets, deadline)
+        log.info('Imported %i harvest objects of job %s.' % (imported, job_id))
+        return imported
+
     def _fetch_import_set(self, harvest_object, master_data, client, group):
         # Could be genuine fetch or retry of set insertions.
         if 'set' in master_data:
@@ -470,23 +1082,31 @@ class OAIPMHHarvester(HarvesterBase):
                 args['from_'] = self._datetime_from_str(master_data['from_'])
             if 'until' in master_data:
                 args['until'] = self._datetime_from_str(master_data['until'])
+            if 'resumption_token' in master_data:
+                args = {'resumptionToken': master_data['resumption_token']}
+            client.deadline = self._stage_deadline()
             ids = []
             try:
                 for identity in client.listIdentifiers(**args):
-                    ids.append(identity.identifier())
+                    if not identity.isDeleted():
+                        ids.append(identity.identifier())
             except NoRecordsMatchError:
                 return False  # Ok, empty set. Nothing to do.
-            except socket.error:
-                errno, errstr = sys.exc_info()[:2]
-                self._save_object_error(
-                    'Socket error OAI-PMH %s, details:\n%s' % (errno, errstr,),
-                    harvest_object, stage='Fetch')
-                return False
-            except httplib.BadStatusLine:
-                self._save_object_error(
-                    'Bad HTTP response status line.',
-                    harvest_object, stage='Fetch')
+            except TransientError:
+                raise
+            except Exception as e:
+                log.debug(traceback.format_exc(e))
+                self._retry_later(harvest_object, master_data, 'listing')
+                self._save_object_error('Failed to list set members.',
+                                        harvest_object, stage='Fetch')
                 return False
+            if getattr(client, 'resumption_token', None):
+                # Stage budget spent, the rest of the set is listed next.
+                rest = dict((key, master_data[key]) for key in
+                            ('set', 'set_name', 'domain'))
+                self._publish([self._continuation(harvest_object.job, dict(
+                    rest, fetch_type='set',
+                    resumption_token=client.resumption_token)).id])
             master_data['record_ids'] = ids
         else:
             log.debug('Reinsert: %s %i' % (master_data['set_name'], len(master_data['record_ids']),))
@@ -494,17 +1114,21 @@ class OAIPMHHarvester(HarvesterBase):
         # Import stage.
         model.repo.new_revision()
         subg_name = '%s - %s' % (group.name, master_data['set_name'],)
-        subgroup = Group.by_name(subg_name)
+        index = source_index.for_job(harvest_object.job)
+        subgroup = index.group(subg_name, group.name)
+        if not subgroup:
+            advisory_lock(u'group:' + subg_name)
+            subgroup = Group.by_name(subg_name)
         if not subgroup:
             subgroup = Group(name=subg_name, description=subg_name)
             setup_default_user_roles(subgroup)
             subgroup.save()
+            index.add_group(subgroup)
         missed = []
         for ident in master_data['record_ids']:
             pkg_name = self._package_name_from_identifier(ident)
             # Package may have been omitted due to missing metadata.
-            pkg = Package.get(pkg_name)
-            if pkg:
+            if index.packages.get(ident) or Package.get(pkg_name):
                 subgroup.add_package_by_name(pkg_name)
                 subgroup.save()
                 if 'set' not in master_data:
@@ -517,6 +1141,8 @@ class OAIPMHHarvester(HarvesterBase):
                 if 'set' not in master_data:
                     log.debug('Omitted %s from %s' % (pkg_name, subg_name,))
         if len(missed):
+            # Retried whole by a later harvest once the records are there.
+            self._retry_later(harvest_object, master_data, 'insertion')
             # Store missing names for retry.
             master_data['record_ids'] = missed
             if 'set' in master_data:
@@ -524,6 +1150,130 @@ class OAIPMHHarvester(HarvesterBase):
             harvest_object.content = json.dumps(master_data)
             log.debug('Missed %s %i' % (master_data['set_name'], len(missed),))
         else:
+            if 'set' in master_data:
+                forget_retry(harvest_object.job.source_id, 'set',
+                             master_data['set'])
             harvest_object.content = None  # Clear data.
         model.repo.commit()
         return True
+
+
+class OAIPMHStaticHarvester(OAIPMHHarvester):
+    """
+    Harvester for OAI-PMH Static Repository files. The source URL is the
+    path or the URL of the file. The gather stage reads it once and queues
+    its records in batches, which the import stage converts directly.
+    """
+    def info(self):
+        """
+        Return information about this harvester.
+        """
+        return {
+            'name': 'OAI-PMH static',
+            'title': 'OAI-PMH Static Repository',
+            'description': 'A file published as an OAI-PMH Static Repository.'
+        }
+
+    def _domain(self, repository, harvest_job):
+        # The Identify of the file comes before its records.
+        return repository.repository_name or harvest_job.source.url
+
+    def _gather_stage(self, harvest_job):
+        from_ = None
+        if not self.config.get('force_all', False):
+            from_ = self._get_time_limits(harvest_job).get('from_')
+        batch_size = int(config.get(
+            'ckanext.oaipmh.harvest.static_batch_size', 100))
+        try:
+            f = open_repository(harvest_job.source.url)
+        except (IOError, urllib2.URLError, socket.error) as e:
+            self._save_gather_error(
+                'Could not read %s: %s' % (harvest_job.source.url, e),
+                harvest_job)
+            raise RuntimeError('Could not read the static repository.')
+        harvest_objs, records, digests, deleted = [], [], {}, []
+        repository = StaticRepository(f, self.metadata_prefix_value)
+        try:
+            for header, record in repository:
+                if from_ and header.datestamp() < from_:
+                    continue
+                if header.isDeleted():
+                    deleted.append(header.identifier())
+                    continue
+                # Digests as of a fetched record, so that both kinds of
+                # source skip unchanged records and can be imported again.
+                response = get_record_response(record)
+                digests[header.identifier()] = record_store.put(response) or \
+                    hashlib.sha1(response).hexdigest()
+                records.append(record)
+                if len(records) == batch_size:
+                    harvest_objs.append(self._batch_object(
+                        harvest_job, self._domain(repository, harvest_job),
+                        records, digests))
+                    records, digests = [], {}
+            if records:
+                harvest_objs.append(self._batch_object(
+                    harvest_job, self._domain(repository, harvest_job),
+                    records, digests))
+        except etree.XMLSyntaxError as e:
+            self._save_gather_error(
+                'Syntax error in %s: %s' % (harvest_job.source.url, e),
+                harvest_job)
+            raise RuntimeError('Could not parse the static repository.')
+        finally:
+            f.close()
+        domain = self._domain(repository, harvest_job)
+        self._get_group(domain)
+        harvest_objs.extend(
+            self._deletion_objects(harvest_job, domain, deleted))
+        log.info('Gathered %i batches from %s.' % (len(harvest_objs), domain))
+        return harvest_objs
+
+
+def _date_windows(start, end, count, day_granularity=False):
+    """
+    Split the time from start to end into at most count consecutive windows
+    of whole seconds, or whole days, given as inclusive (from, until) pairs.
+    """
+    if day_granularity:
+        unit = datetime.timedelta(days=1)
+    else:
+        unit = datetime.timedelta(seconds=1)
+
+    def truncate(dt):
+        if day_granularity:
+            return datetime.datetime(dt.year, dt.month, dt.day)
+        return dt.replace(microsecond=0)
+    start, end = truncate(start), truncate(end)
+    end = max(start, end)
+    count = max(min(count, (end - start).total_seconds() //
+                    unit.total_seconds() + 1), 1)
+    step = (end - start) / int(count)
+    bounds = sorted(set(truncate(start + step * i)
+                        for i in range(int(count))))
+    return [(bound, (bounds[i + 1] - unit) if i + 1 < len(bounds) else end)
+            for i, bound in enumerate(bounds)]
+
+
+def _init_import_worker():
+    # Database connections cannot be shared with the parent process.
+    model.meta.engine.dispose()
+
+
+def _import_partition(args):
+    return _import_objects(*args)
+
+
+def _import_objects(object_ids, deadline=None):
+    harvester = OAIPMHHarvester()
+    imported = 0
+    for object_id in object_ids:
+        if deadline is not None and time.time() >= deadline:
+            log.info('Import budget spent, %i objects left.' % (
+                len(object_ids) - object_ids.index(object_id)))
+            break
+        harvest_object = HarvestObject.get(object_id)
+        if harvest_object is not None and harvester._import(harvest_object):
+            imported += 1
+        Session.remove()
+    return imported
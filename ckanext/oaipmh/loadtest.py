@@ -0,0 +1,205 @@
+'''Load test of the OAI-PMH interface.
+
+A mix of harvest sessions is replayed against the /oai route of the CKAN
+application, in process, by a number of concurrent clients. A session is one
+request followed by the requests of its resumption tokens, as a harvester
+would issue them. The mix is either synthetic or read from a file of recorded
+requests, one query string or access log line per line.
+'''
+import re
+import math
+import time
+import random
+import urllib
+import threading
+import Queue
+from datetime import datetime, timedelta
+from xml.sax.saxutils import unescape
+
+import paste.fixture
+
+# Weights of the requests of the synthetic mix.
+SYNTHETIC_MIX = [
+    (5, 'verb=ListRecords&metadataPrefix=oai_dc'),
+    (2, 'verb=ListRecords&metadataPrefix=rdf'),
+    (3, 'verb=ListIdentifiers&metadataPrefix=oai_dc'),
+    (2, 'verb=ListRecords&metadataPrefix=oai_dc&from=%(yesterday)s'),
+    (4, 'verb=GetRecord&metadataPrefix=oai_dc&identifier=%(identifier)s'),
+    (1, 'verb=Identify'),
+    (1, 'verb=ListMetadataFormats'),
+    (1, 'verb=ListSets'),
+]
+
+_VERB = re.compile(r'(?:^|&)verb=(\w+)')
+_TOKEN = re.compile(r'<resumptionToken[^>]*>([^<]+)</resumptionToken>')
+_IDENTIFIER = re.compile(r'<identifier>([^<]+)</identifier>')
+_ERROR = re.compile(r'<error code="(\w+)"')
+_LOGGED = re.compile(r'/oai\?(\S+)')
+
+
+def recorded_mix(lines):
+    '''Return the query strings of recorded requests. Requests with a
+    resumption token are left out, they are followed by the sessions.
+    '''
+    queries = []
+    for line in lines:
+        line = line.strip()
+        logged = _LOGGED.search(line)
+        query = logged.group(1) if logged else line.lstrip('?')
+        if _VERB.search(query) and 'resumptionToken=' not in query:
+            queries.append(query)
+    return queries
+
+
+def synthetic_mix(sessions, identifiers, seed=0):
+    '''Return the query strings of a weighted random mix of sessions. The
+    GetRecord requests ask for the given identifiers.
+    '''
+    rand = random.Random(seed)
+    yesterday = (datetime.utcnow() - timedelta(days=1)).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
+    weighted = [query for weight, query in SYNTHETIC_MIX for _ in
+                range(weight) if identifiers or 'identifier=' not in query]
+    return [rand.choice(weighted) % {
+        'yesterday': yesterday,
+        'identifier': urllib.quote(rand.choice(identifiers or ['']))}
+        for _ in range(sessions)]
+
+
+def sample_identifiers(app, base_url='/oai'):
+    '''Return the identifiers of the first ListIdentifiers page.
+    '''
+    res = app.get(base_url + '?verb=ListIdentifiers&metadataPrefix=oai_dc',
+                  status='*')
+    return [unescape(identifier) for identifier in
+            _IDENTIFIER.findall(res.body)]
+
+
+def _percentile(values, percent):
+    '''Nearest rank percentile of sorted values.
+    '''
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Stats(object):
+    '''Latencies, response sizes and errors of the requests of each verb.
+    Errors are non 200 responses and OAI-PMH errors other than
+    noRecordsMatch.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.sizes = {}
+        self.errors = {}
+        self.elapsed = 0.0
+
+    def add(self, verb, latency, size, error=None):
+        with self._lock:
+            self.latencies.setdefault(verb, []).append(latency)
+            self.sizes.setdefault(verb, []).append(size)
+            if error:
+                errors = self.errors.setdefault(verb, {})
+                errors[error] = errors.get(error, 0) + 1
+
+    def summary(self):
+        '''Return {verb: dict of the request count, throughput, latency
+        percentiles in seconds, error rate and mean and maximum size}.
+        '''
+        summary = {}
+        for verb, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            sizes = self.sizes[verb]
+            count = len(latencies)
+            errors = sum(self.errors.get(verb, {}).values())
+            summary[verb] = {
+                'requests': count,
+                'throughput': count / self.elapsed if self.elapsed else 0.0,
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'p99': _percentile(latencies, 99),
+                'error_rate': float(errors) / count,
+                'errors': dict(self.errors.get(verb, {})),
+                'mean_size': sum(sizes) / count,
+                'max_size': max(sizes),
+            }
+        return summary
+
+    def report(self):
+        '''Return the summary as lines of text.
+        '''
+        lines = ['%-20s %8s %8s %8s %8s %8s %7s %10s' % (
+            'verb', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'errors', 'mean size')]
+        for verb, row in sorted(self.summary().items()):
+            lines.append('%-20s %8i %8.1f %8.1f %8.1f %8.1f %6.1f%% %10i' % (
+                verb, row['requests'], row['throughput'], row['p50'] * 1000,
+                row['p95'] * 1000, row['p99'] * 1000,
+                row['error_rate'] * 100, row['mean_size']))
+            for code, count in sorted(row['errors'].items()):
+                lines.append('    %s: %i' % (code, count))
+        lines.append('%i requests in %.1f s' % (
+            sum(len(l) for l in self.latencies.values()), self.elapsed))
+        return lines
+
+
+def _session(app, base_url, query, stats, max_pages, environ):
+    '''Issue a request and follow its resumption tokens.
+    '''
+    verb = _VERB.search(query).group(1)
+    pages = 0
+    while query and (max_pages is None or pages < max_pages):
+        start = time.time()
+        try:
+            res = app.get('%s?%s' % (base_url, query), status='*',
+                          extra_environ=environ)
+        except Exception, e:
+            stats.add(verb, time.time() - start, 0, e.__class__.__name__)
+            return
+        latency = time.time() - start
+        body = res.body
+        error = None
+        if res.status != 200:
+            error = str(res.status)
+        else:
+            oai_error = _ERROR.search(body)
+            if oai_error and oai_error.group(1) != 'noRecordsMatch':
+                error = oai_error.group(1)
+        stats.add(verb, latency, len(body), error)
+        pages += 1
+        token = _TOKEN.search(body) if error is None else None
+        query = token and 'verb=%s&resumptionToken=%s' % (
+            verb, urllib.quote(unescape(token.group(1).strip())))
+
+
+def run(wsgiapp, queries, concurrency=4, max_pages=None, base_url='/oai'):
+    '''Replay the sessions of the query strings against a WSGI application
+    with concurrent clients, each with its own remote address, and return
+    their Stats.
+    '''
+    sessions = Queue.Queue()
+    for query in queries:
+        sessions.put(query)
+    stats = Stats()
+
+    def client(number):
+        app = paste.fixture.TestApp(wsgiapp)
+        environ = {'REMOTE_ADDR': '127.0.1.%i' % (number % 254 + 1)}
+        while True:
+            try:
+                query = sessions.get_nowait()
+            except Queue.Empty:
+                return
+            _session(app, base_url, query, stats, max_pages, environ)
+
+    threads = [threading.Thread(target=client, args=(number,))
+               for number in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.elapsed = time.time() - start
+    return stats
@@ -0,0 +1,445 @@
+'''Database tables used by the OAI-PMH server.
+'''
+import zlib
+import logging
+import datetime
+
+from sqlalchemy import Table, Column, Index, types, select, func, or_
+from sqlalchemy.engine.reflection import Inspector
+
+from ckan import model
+from ckan.model import meta
+from ckan.model.meta import metadata, Session
+from ckan.model import Group, Member
+
+log = logging.getLogger(__name__)
+
+__all__ = ['oai_tombstone_table', 'oai_set_membership_table', 'setup',
+           'mark_deleted', 'unmark_deleted', 'touch_package',
+           'set_spec_for_group', 'in_set', 'set_specs_for_packages',
+           'refresh_package_sets', 'refresh_group_sets', 'rebuild_set_index',
+           'oai_harvest_record_table', 'save_harvest_record',
+           'harvest_records', 'forget_harvested_package',
+           'forget_harvest_records', 'advisory_lock',
+           'oai_change_journal_table', 'journal_changes', 'journaled',
+           'rebuild_journal',
+           'compact_journal', 'CREATE', 'UPDATE', 'DELETE',
+           'oai_harvest_retry_table', 'save_retry', 'forget_retry',
+           'due_retries', 'parked_retries', 'unpark_retries']
+
+# The harvester names the group of a set '<domain> - <set>'.
+SUBSET_SEPARATOR = ' - '
+
+# Packages which have been deleted, purged or made private. These are served
+# as deleted records so that harvesters can stay incremental.
+oai_tombstone_table = Table('oai_tombstone', metadata,
+    Column('package_id', types.UnicodeText, primary_key=True),
+    Column('deleted', types.DateTime, nullable=False, index=True),
+)
+
+# The setSpecs of each package, maintained on package and group changes.
+# Deleted packages keep their rows so that their headers can be set-selected.
+oai_set_membership_table = Table('oai_set_membership', metadata,
+    Column('package_id', types.UnicodeText, primary_key=True),
+    Column('set_spec', types.UnicodeText, primary_key=True),
+)
+
+# The record last imported for each identifier of a harvest source, by its
+# digest in the record store, so that unchanged records can be skipped and
+# stored ones imported again.
+oai_harvest_record_table = Table('oai_harvest_record', metadata,
+    Column('harvest_source_id', types.UnicodeText, primary_key=True),
+    Column('identifier', types.UnicodeText, primary_key=True),
+    Column('domain', types.UnicodeText, nullable=False),
+    Column('digest', types.UnicodeText, nullable=False),
+    Column('package_id', types.UnicodeText),
+    Column('fetched', types.DateTime, nullable=False),
+)
+
+# Records and sets of a harvest source which failed, with the class of the
+# last failure and the number of attempts. They are retried by the following
+# harvests once due, and parked, without a next attempt, after too many.
+oai_harvest_retry_table = Table('oai_harvest_retry', metadata,
+    Column('harvest_source_id', types.UnicodeText, primary_key=True),
+    Column('kind', types.Unicode(6), primary_key=True),
+    Column('identifier', types.UnicodeText, primary_key=True),
+    Column('set_name', types.UnicodeText),
+    Column('failure', types.UnicodeText, nullable=False),
+    Column('attempts', types.Integer, nullable=False),
+    Column('next_attempt', types.DateTime),
+)
+
+# Every change of a public package: created, updated or deleted (which
+# includes purged and made private), with its setSpecs at that time. The
+# latest entry of a package gives its state, so date-selective harvests scan
+# the changes since their from date only.
+oai_change_journal_table = Table('oai_change_journal', metadata,
+    Column('id', types.Integer, primary_key=True),
+    Column('package_id', types.UnicodeText, nullable=False),
+    Column('changed', types.DateTime, nullable=False),
+    Column('change_type', types.Unicode(6), nullable=False),
+    # Space separated and padded, so that a set and its subsets can be
+    # matched with LIKE.
+    Column('set_specs', types.UnicodeText, nullable=False),
+)
+
+CREATE, UPDATE, DELETE = u'create', u'update', u'delete'
+
+oai_change_journal_index = Index('idx_oai_change_journal_changed',
+                                 oai_change_journal_table.c.changed,
+                                 oai_change_journal_table.c.package_id,
+                                 oai_change_journal_table.c.id)
+
+oai_set_membership_index = Index('idx_oai_set_membership_set_spec',
+                                 oai_set_membership_table.c.set_spec,
+                                 oai_set_membership_table.c.package_id)
+
+# Listing is a range scan over the modification time of the active public
+# packages, which the index answers together with the ids of the headers.
+package_listing_index = Index('idx_oai_package_listing',
+                              model.package_table.c.state,
+                              model.package_table.c.private,
+                              model.package_table.c.metadata_modified,
+                              model.package_table.c.id)
+
+
+def _create_index(index):
+    inspector = Inspector.from_engine(meta.engine)
+    existing = [i['name'] for i in inspector.get_indexes(index.table.name)]
+    if index.name not in existing:
+        index.create(meta.engine)
+        log.debug('Index %s created' % index.name)
+
+
+def setup():
+    '''Create the OAI-PMH tables and indexes if they do not exist yet.
+    '''
+    if model.package_table.exists():
+        if not oai_tombstone_table.exists():
+            oai_tombstone_table.create()
+            log.debug('OAI-PMH tables created')
+        if not oai_set_membership_table.exists():
+            oai_set_membership_table.create()
+            rebuild_set_index()
+        if not oai_harvest_record_table.exists():
+            oai_harvest_record_table.create()
+        if not oai_harvest_retry_table.exists():
+            oai_harvest_retry_table.create()
+        if not oai_change_journal_table.exists():
+            oai_change_journal_table.create()
+            _create_index(oai_change_journal_index)
+            rebuild_journal()
+        _create_index(package_listing_index)
+
+
+def mark_deleted(package_id, timestamp=None):
+    '''Record the package as deleted at the given time (default: now, UTC).
+    A package which is already marked keeps its original deletion time.
+    Returns whether the package was marked now.
+    '''
+    known = Session.query(oai_tombstone_table.c.package_id).filter(
+        oai_tombstone_table.c.package_id == package_id).first()
+    if known is None:
+        Session.execute(oai_tombstone_table.insert().values(
+            package_id=package_id,
+            deleted=timestamp or datetime.datetime.utcnow()))
+    return known is None
+
+
+def unmark_deleted(package_id):
+    '''Forget the deletion of a package, e.g. after it has been restored.
+    '''
+    Session.execute(oai_tombstone_table.delete().where(
+        oai_tombstone_table.c.package_id == package_id))
+
+
+def touch_package(package_id, timestamp=None):
+    '''Set the modification time of a package (default: now, UTC). CKAN only
+    does this in package_update, not when the model is changed directly.
+    '''
+    Session.execute(model.package_table.update().where(
+        model.package_table.c.id == package_id).values(
+            metadata_modified=timestamp or datetime.datetime.utcnow()))
+
+
+def _set_spec(name, group_id, parent_id):
+    pos = name.rfind(SUBSET_SEPARATOR)
+    while pos > 0:
+        parent = name[:pos]
+        parent_group_id = parent_id(parent)
+        if parent_group_id:
+            return '%s:%s' % (_set_spec(parent, parent_group_id, parent_id),
+                              group_id)
+        pos = name.rfind(SUBSET_SEPARATOR, 0, pos)
+    return group_id
+
+
+def set_spec_for_group(group, group_ids=None):
+    '''Return the setSpec of a group, which is its id. The groups of the sets
+    of a harvested source are subsets of the group of its domain, so their
+    setSpec is prefixed by the setSpec of that group. A mapping of group names
+    to ids can be given to avoid a query per level.
+    '''
+    if group_ids is not None:
+        parent_id = group_ids.get
+    else:
+        def parent_id(name):
+            return Session.query(Group.id).filter(Group.name == name).scalar()
+    return _set_spec(group.name, group.id, parent_id)
+
+
+def in_set(column, set_spec):
+    '''Return a clause limiting a package id column to the members of a set
+    and its subsets.
+    '''
+    spec = oai_set_membership_table.c.set_spec
+    return column.in_(
+        select([oai_set_membership_table.c.package_id]).where(
+            or_(spec == set_spec, spec.like(set_spec + ':%'))))
+
+
+def set_specs_for_packages(package_ids, session=Session):
+    '''Return a dictionary of the setSpecs of each package, in one query.
+    '''
+    specs = dict((package_id, []) for package_id in package_ids)
+    if specs:
+        query = session.query(oai_set_membership_table.c.package_id,
+                              oai_set_membership_table.c.set_spec).filter(
+            oai_set_membership_table.c.package_id.in_(specs.keys())).\
+            order_by(oai_set_membership_table.c.set_spec)
+        for package_id, set_spec in query:
+            specs[package_id].append(set_spec)
+    return specs
+
+
+def refresh_package_sets(package):
+    '''Rewrite the setSpecs of a package from its group memberships.
+    '''
+    Session.execute(oai_set_membership_table.delete().where(
+        oai_set_membership_table.c.package_id == package.id))
+    rows = [{'package_id': package.id, 'set_spec': set_spec_for_group(group)}
+            for group in package.get_groups() if group.state == 'active']
+    if rows:
+        Session.execute(oai_set_membership_table.insert(), rows)
+
+
+def refresh_group_sets(group):
+    '''Rewrite the setSpecs of the members of a group and of its subsets,
+    e.g. after it has been renamed or deleted. Returns the ids of the
+    members.
+    '''
+    group_ids = [group_id for group_id, in Session.query(Group.id).filter(
+        or_(Group.id == group.id,
+            Group.name.like(group.name + SUBSET_SEPARATOR + '%')))]
+    package_ids = [package_id for package_id, in Session.query(
+        Member.table_id).filter(Member.table_name == 'package').filter(
+        Member.group_id.in_(group_ids)).distinct()]
+    if package_ids:
+        for package in Session.query(model.Package).filter(
+                model.Package.id.in_(package_ids)):
+            refresh_package_sets(package)
+    return package_ids
+
+
+def rebuild_set_index():
+    '''Rebuild the whole set membership index.
+    '''
+    groups = Session.query(Group).filter(Group.state == 'active').all()
+    group_ids = dict((group.name, group.id) for group in groups)
+    specs = dict((group.id, set_spec_for_group(group, group_ids))
+                 for group in groups)
+    query = Session.query(Member.table_id, Member.group_id).filter(
+        Member.table_name == 'package').filter(Member.state == 'active')
+    rows = [{'package_id': package_id, 'set_spec': specs[group_id]}
+            for package_id, group_id in query if group_id in specs]
+    Session.execute(oai_set_membership_table.delete())
+    if rows:
+        Session.execute(oai_set_membership_table.insert(), rows)
+    Session.commit()
+
+
+def save_harvest_record(source_id, identifier, domain, digest,
+                        package_id=None):
+    '''Record the digest of the raw record last imported for an identifier,
+    and the package it was imported into.
+    '''
+    table = oai_harvest_record_table
+    Session.execute(table.delete().where(
+        table.c.harvest_source_id == source_id).where(
+        table.c.identifier == identifier))
+    Session.execute(table.insert().values(
+        harvest_source_id=source_id, identifier=identifier, domain=domain,
+        digest=digest, package_id=package_id,
+        fetched=datetime.datetime.utcnow()))
+
+
+def harvest_records(source_id=None):
+    '''Return (harvest source id, identifier, domain, digest) of the stored
+    records, of all sources or of one.
+    '''
+    table = oai_harvest_record_table
+    query = Session.query(table.c.harvest_source_id, table.c.identifier,
+                          table.c.domain, table.c.digest)
+    if source_id is not None:
+        query = query.filter(table.c.harvest_source_id == source_id)
+    return query.order_by(table.c.harvest_source_id,
+                          table.c.identifier).all()
+
+
+def forget_harvested_package(package_id):
+    '''Drop the package of the records imported into it, e.g. after it has
+    been purged.
+    '''
+    table = oai_harvest_record_table
+    Session.execute(table.update().where(
+        table.c.package_id == package_id).values(package_id=None))
+
+
+def forget_harvest_records(source_id, identifiers):
+    '''Drop the stored records of identifiers the provider has deleted, and
+    their retries, so that they are imported anew if they come back.
+    '''
+    for table in (oai_harvest_record_table, oai_harvest_retry_table):
+        query = table.delete().where(
+            table.c.harvest_source_id == source_id).where(
+            table.c.identifier.in_(identifiers))
+        if table is oai_harvest_retry_table:
+            query = query.where(table.c.kind == 'record')
+        Session.execute(query)
+
+
+def save_retry(source_id, kind, identifier, failure, backoff, max_attempts,
+               set_name=None):
+    '''Count a failed attempt of a record or set ('record' or 'set' kind).
+    The next attempt is due after backoff seconds, doubled at each failure,
+    and the identifier is parked after max_attempts. Returns the time of the
+    next attempt, None when parked.
+    '''
+    table = oai_harvest_retry_table
+    where = (table.c.harvest_source_id == source_id) & \
+        (table.c.kind == kind) & (table.c.identifier == identifier)
+    attempts = Session.execute(select([table.c.attempts]).where(
+        where)).scalar() or 0
+    attempts += 1
+    next_attempt = None
+    if attempts < max_attempts:
+        next_attempt = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=backoff * 2 ** (attempts - 1))
+    Session.execute(table.delete().where(where))
+    Session.execute(table.insert().values(
+        harvest_source_id=source_id, kind=kind, identifier=identifier,
+        set_name=set_name, failure=failure, attempts=attempts,
+        next_attempt=next_attempt))
+    return next_attempt
+
+
+def forget_retry(source_id, kind, identifier):
+    '''Drop a record or set which has been harvested after all.
+    '''
+    table = oai_harvest_retry_table
+    Session.execute(table.delete().where(
+        table.c.harvest_source_id == source_id).where(
+        table.c.kind == kind).where(table.c.identifier == identifier))
+
+
+def due_retries(source_id, now=None):
+    '''Return (kind, identifier, set name) of the records and sets of a
+    source whose next attempt is due.
+    '''
+    table = oai_harvest_retry_table
+    return Session.query(table.c.kind, table.c.identifier,
+                         table.c.set_name).filter(
+        table.c.harvest_source_id == source_id).filter(
+        table.c.next_attempt <= (now or datetime.datetime.utcnow())).order_by(
+        table.c.kind, table.c.identifier).all()
+
+
+def parked_retries(source_id):
+    '''Return the set of (kind, identifier) of the parked records and sets of
+    a source.
+    '''
+    table = oai_harvest_retry_table
+    return set(Session.query(table.c.kind, table.c.identifier).filter(
+        table.c.harvest_source_id == source_id).filter(
+        table.c.next_attempt == None))
+
+
+def unpark_retries(source_id=None):
+    '''Make the parked records and sets, of all sources or of one, due again
+    with a fresh attempt count. Returns their number.
+    '''
+    table = oai_harvest_retry_table
+    update = table.update().where(table.c.next_attempt == None)
+    if source_id is not None:
+        update = update.where(table.c.harvest_source_id == source_id)
+    result = Session.execute(update.values(
+        attempts=0, next_attempt=datetime.datetime.utcnow()))
+    Session.commit()
+    return result.rowcount
+
+
+def advisory_lock(name):
+    '''Take a PostgreSQL advisory lock on a name until the end of the
+    transaction, so that concurrent imports do not create the same package,
+    tag or group twice. Does nothing on other databases.
+    '''
+    if meta.engine.dialect.name == 'postgresql':
+        key = zlib.crc32(name.encode('utf-8'))
+        Session.execute(select([func.pg_advisory_xact_lock(key)]))
+
+
+def _journal_rows(changes):
+    specs = set_specs_for_packages([package_id for package_id, _, _
+                                    in changes])
+    return [{'package_id': package_id, 'changed': changed,
+             'change_type': change_type,
+             'set_specs': u' %s ' % u' '.join(specs[package_id])}
+            for package_id, changed, change_type in changes]
+
+
+def journal_changes(changes):
+    '''Append (package id, change time, change type) changes to the journal,
+    with the current setSpecs of the packages.
+    '''
+    if changes:
+        Session.execute(oai_change_journal_table.insert(),
+                        _journal_rows(changes))
+
+
+def journaled(package_id):
+    '''Return whether the package has an entry in the journal, that is
+    whether it has ever been served as a record.
+    '''
+    table = oai_change_journal_table
+    return Session.query(table.c.id).filter(
+        table.c.package_id == package_id).first() is not None
+
+
+def rebuild_journal(chunk=1000):
+    '''Start the journal over with one entry for each live package and one
+    for each deleted package, at their modification and deletion times.
+    '''
+    live = Session.query(model.Package.id, model.Package.metadata_modified).\
+        filter(model.Package.state == 'active').\
+        filter(model.Package.private == False)
+    changes = [(package_id, modified, UPDATE)
+               for package_id, modified in live]
+    changes.extend((package_id, deleted, DELETE) for package_id, deleted in
+                   Session.query(oai_tombstone_table.c.package_id,
+                                 oai_tombstone_table.c.deleted))
+    Session.execute(oai_change_journal_table.delete())
+    for start in range(0, len(changes), chunk):
+        journal_changes(changes[start:start + chunk])
+    Session.commit()
+    log.info('Change journal rebuilt with %i entries' % len(changes))
+
+
+def compact_journal():
+    '''Drop the journal entries superseded by a later change of the same
+    package, which are never read.
+    '''
+    table = oai_change_journal_table
+    latest = select([func.max(table.c.id)]).group_by(table.c.package_id)
+    result = Session.execute(table.delete().where(~table.c.id.in_(latest)))
+    Session.commit()
+    return result.rowcount
@@ -1,26 +1,44 @@
 '''OAI-PMH implementation for CKAN datasets and groups.
 '''
 # pylint: disable=E1101,E1103
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from ckan.model import Package, Session, Group, PackageRevision
+from sqlalchemy import select, func, or_
+
+from ckan.model import Package, Session, Group, State
 from ckan.lib.helpers import url_for
 
 from pylons import config
 
-from sqlalchemy import between
-
 from oaipmh.common import ResumptionOAIPMH
 from oaipmh import common
+from oaipmh.error import IdDoesNotExistError
+
+from model import oai_tombstone_table, in_set, set_spec_for_group
+from model import set_specs_for_packages, oai_change_journal_table, DELETE
+from serializer import dc_fields, DatasetURL
+from prefetch import get_prefetcher
+from catalogue_index import get_index
 
 import logging
 
 log = logging.getLogger(__name__)
 
 
+def _after_second(until):
+    '''Return the exclusive upper bound of an inclusive until datestamp.
+    Datestamps have second granularity while the database keeps fractions.
+    '''
+    return until + timedelta(seconds=1)
+
+
 class CKANServer(ResumptionOAIPMH):
-    '''A OAI-PMH implementation class for CKAN.
+    '''A OAI-PMH implementation class for CKAN. The list verbs read from the
+    given session, e.g. of a replica, and the other verbs from the primary.
     '''
+    def __init__(self, session=None):
+        self._session = session or Session
+
     def identify(self):
         '''Return identification information for this server.
         '''
@@ -33,12 +51,12 @@ class CKANServer(ResumptionOAIPMH):
             protocolVersion="2.0",
             adminEmails=[config.get('email_to')],
             earliestDatestamp=datetime(2004, 1, 1),
-            deletedRecord='no',
-            granularity='YYYY-MM-DD',
+            deletedRecord='persistent',
+            granularity='YYYY-MM-DDThh:mm:ssZ',
             compression=['identity'])
 
-    def _record_for_dataset(self, dataset):
-        '''Show a tuple of a header and metadata for this dataset.
+    def _metadata_for_dataset(self, dataset):
+        '''Show the metadata of this dataset.
         '''
         meta = {
                 'title': [dataset.name],
@@ -68,67 +86,212 @@ class CKANServer(ResumptionOAIPMH):
                 metadata[str(key)] = [value]
             else:
                 metadata[str(key)] = value
+        return common.Metadata(metadata)
+
+    def _record_for_dataset(self, dataset):
+        '''Show a tuple of a header and metadata for this dataset.
+        '''
+        specs = set_specs_for_packages([dataset.id])
         return (common.Header(dataset.id,
-                              dataset.metadata_created,
-                              [dataset.name],
+                              dataset.metadata_modified,
+                              specs[dataset.id],
                               False),
-                common.Metadata(metadata),
+                self._metadata_for_dataset(dataset),
                 None)
 
+    def _set_spec(self, set):
+        '''Resolve the set argument of a request to a setSpec. A group name
+        or id is accepted for a top level set as well.
+        '''
+        group = Group.get(set.split(':')[-1])
+        if group is None:
+            return None
+        return set_spec_for_group(group)
+
+    def _packages(self, set_spec):
+        '''Return a query of the ids and modification times of the active
+        public packages in modification order, optionally limited to a set.
+        Date-selective requests are answered from the change journal.
+        '''
+        query = self._session.query(Package.id, Package.metadata_modified).\
+            filter(Package.state == State.ACTIVE).\
+            filter(Package.private == False)
+        if set_spec:
+            query = query.filter(in_set(Package.id, set_spec))
+        return query.order_by(Package.metadata_modified, Package.id)
+
+    def _tombstones(self, set_spec):
+        '''Return a query of the ids and deletion times of deleted and
+        withdrawn packages, optionally limited to a set.
+        '''
+        query = self._session.query(oai_tombstone_table.c.package_id,
+                                    oai_tombstone_table.c.deleted)
+        if set_spec:
+            query = query.filter(
+                in_set(oai_tombstone_table.c.package_id, set_spec))
+        return query.order_by(oai_tombstone_table.c.deleted,
+                              oai_tombstone_table.c.package_id)
+
+    def _changes(self, set_spec, from_, until):
+        '''Return a query of the latest journal entry of each package changed
+        in a time window, in change order. Only the entries since the from
+        date are scanned.
+        '''
+        journal = oai_change_journal_table
+        latest = select([func.max(journal.c.id)])
+        if from_:
+            latest = latest.where(journal.c.changed >= from_)
+        query = self._session.query(journal.c.package_id, journal.c.changed,
+                                    journal.c.change_type,
+                                    journal.c.set_specs).\
+            filter(journal.c.id.in_(latest.group_by(journal.c.package_id)))
+        if until:
+            query = query.filter(journal.c.changed < _after_second(until))
+        if set_spec:
+            query = query.filter(or_(
+                journal.c.set_specs.like(u'%% %s %%' % set_spec),
+                journal.c.set_specs.like(u'%% %s:%%' % set_spec)))
+        return query.order_by(journal.c.changed, journal.c.id)
+
+    def _page(self, query, offset, limit):
+        '''Fetch one batch of a query.
+        '''
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    def _page_headers(self, set, cursor, from_, until, batch_size):
+        '''Return the header of each record of a batch and whether it is
+        deleted. Live packages come first, then deleted ones. Only the
+        columns of the headers and only the rows of the batch are read, and
+        the setSpecs of the whole batch are looked up at once. Requests
+        with a from or until date are answered from the change journal. With
+        the catalogue index on, the batch is read from memory instead.
+        '''
+        set_spec = None
+        if set:
+            set_spec = self._set_spec(set)
+            if set_spec is None:
+                return []
+        cursor = cursor or 0
+        index = get_index()
+        if index is not None:
+            return [(common.Header(package_id, datestamp, set_specs, deleted),
+                     deleted)
+                    for package_id, datestamp, set_specs, deleted in
+                    index.page(set_spec, from_, until, cursor, batch_size)]
+        if from_ or until:
+            return [(common.Header(package_id, changed, set_specs.split(),
+                                   change_type == DELETE),
+                     change_type == DELETE)
+                    for package_id, changed, change_type, set_specs in
+                    self._page(self._changes(set_spec, from_, until),
+                               cursor, batch_size)]
+        live = self._packages(set_spec)
+        items = [(package_id, modified, False) for package_id, modified in
+                 self._page(live, cursor, batch_size)]
+        if batch_size is None or len(items) < batch_size:
+            if items or not cursor:
+                live_count = cursor + len(items)
+            else:
+                live_count = live.count()
+            limit = None if batch_size is None else batch_size - len(items)
+            items += [(package_id, deleted, True) for package_id, deleted in
+                      self._page(self._tombstones(set_spec),
+                                 max(cursor - live_count, 0), limit)]
+        specs = set_specs_for_packages([item[0] for item in items],
+                                       self._session)
+        return [(common.Header(package_id, datestamp, specs[package_id],
+                               deleted), deleted)
+                for package_id, datestamp, deleted in items]
+
+    def records(self, package_ids):
+        '''Show the records of the given packages, in the given order.
+        Packages which are neither live nor deleted are left out.
+        '''
+        packages = dict((package.id, package) for package in
+                        self._session.query(Package).filter(
+                            Package.id.in_(package_ids)))
+        tombstone = oai_tombstone_table
+        deleted = dict(self._session.query(tombstone.c.package_id,
+                                           tombstone.c.deleted).filter(
+            tombstone.c.package_id.in_(package_ids)))
+        specs = set_specs_for_packages(package_ids, self._session)
+        data = []
+        for package_id in package_ids:
+            package = packages.get(package_id)
+            if package and package.state == State.ACTIVE and \
+                    not package.private:
+                data.append((common.Header(package_id,
+                                           package.metadata_modified,
+                                           specs[package_id],
+                                           False),
+                             self._metadata_for_dataset(package),
+                             None))
+            elif package_id in deleted:
+                data.append((common.Header(package_id,
+                                           deleted[package_id],
+                                           specs[package_id],
+                                           True),
+                             None,
+                             None))
+        return data
+
+    def record_fields(self, package_ids, dataset_url=None):
+        '''Like records, with the Dublin Core fields of the live records for
+        the direct serializer instead of their metadata.
+        '''
+        fields = dc_fields(package_ids, self._session, dataset_url)
+        tombstone = oai_tombstone_table
+        deleted = dict(self._session.query(tombstone.c.package_id,
+                                           tombstone.c.deleted).filter(
+            tombstone.c.package_id.in_(package_ids)))
+        modified = dict(self._session.query(Package.id,
+                                            Package.metadata_modified).
+                        filter(Package.id.in_(fields.keys()))) \
+            if fields else {}
+        specs = set_specs_for_packages(package_ids, self._session)
+        data = []
+        for package_id in package_ids:
+            if package_id in fields:
+                data.append((common.Header(package_id, modified[package_id],
+                                           specs[package_id], False),
+                             fields[package_id]))
+            elif package_id in deleted:
+                data.append((common.Header(package_id, deleted[package_id],
+                                           specs[package_id], True),
+                             None))
+        return data
+
     def getRecord(self, metadataPrefix, identifier):
-        '''Simple getRecord for a dataset.
+        '''Simple getRecord for a dataset. Deleted and withdrawn datasets are
+        returned as deleted records.
         '''
         package = Package.get(identifier)
-        return self._record_for_dataset(package)
+        if package and package.state == State.ACTIVE and not package.private:
+            return self._record_for_dataset(package)
+        package_id = package.id if package else identifier
+        tombstone = Session.query(oai_tombstone_table.c.deleted).filter(
+            oai_tombstone_table.c.package_id == package_id).first()
+        if tombstone is None:
+            raise IdDoesNotExistError('No such record: %s' % identifier)
+        specs = set_specs_for_packages([package_id])
+        return (common.Header(package_id,
+                              tombstone[0],
+                              specs[package_id],
+                              True),
+                None,
+                None)
 
     def listIdentifiers(self, metadataPrefix, set=None, cursor=None,
                         from_=None, until=None, batch_size=None):
-        '''List all identifiers for this repository.
+        '''List all identifiers for this repository, followed by the
+        identifiers of deleted records.
         '''
-        data = []
-        packages = []
-        if not set:
-            if not from_ and not until:
-                packages = Session.query(Package).all()
-            else:
-                if from_:
-                    packages = Session.query(Package).\
-                        filter(PackageRevision.revision_timestamp > from_).\
-                        all()
-                if until:
-                    packages = Session.query(Package).\
-                        filter(PackageRevision.revision_timestamp < until).\
-                        all()
-                if from_ and until:
-                    packages = Session.query(Package).\
-                        filter(between(PackageRevision.revision_timestamp,
-                                       from_,
-                                       until)\
-                               ).all()
-        else:
-            group = Group.get(set)
-            if group:
-                packages = group.packages(return_query=True)
-                if from_ and not until:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp > from_)
-                if until and not from_:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp < until)
-                if from_ and until:
-                    packages = packages.filter(
-                        between(PackageRevision.revision_timestamp,
-                                from_,
-                                until))
-                packages = packages.all()
-        if cursor:
-            packages = packages[:cursor]
-        for package in packages:
-            data.append(common.Header(package.id,
-                                      package.metadata_created,
-                                      [package.name],
-                                      False))
-        return data
+        return [header for header, _ in
+                self._page_headers(set, cursor, from_, until, batch_size)]
 
     def listMetadataFormats(self):
         '''List available metadata formats.
@@ -142,55 +305,81 @@ class CKANServer(ResumptionOAIPMH):
 
     def listRecords(self, metadataPrefix, set=None, cursor=None, from_=None,
                     until=None, batch_size=None):
-        '''Show a selection of records, basically lists all datasets.
+        '''Show a selection of records, basically lists all datasets. Deleted
+        datasets are listed last with a deleted header only.
         '''
+        headers = self._page_headers(set, cursor, from_, until, batch_size)
+        live_ids = [header.identifier() for header, deleted in headers
+                    if not deleted]
+        packages = {}
+        if live_ids:
+            packages = dict((package.id, package) for package in
+                            self._session.query(Package).filter(
+                                Package.id.in_(live_ids)))
         data = []
-        packages = []
-        if not set:
-            if not from_ and not until:
-                packages = Session.query(Package).all()
-            if from_:
-                packages = Session.query(Package).\
-                    filter(PackageRevision.revision_timestamp > from_).all()
-            if until:
-                packages = Session.query(Package).\
-                    filter(PackageRevision.revision_timestamp < until).all()
-            if from_ and until:
-                packages = Session.query(Package).filter(
-                    between(PackageRevision.revision_timestamp,from_,until)).\
-                    all()
-        else:
-            group = Group.get(set)
-            if group:
-                packages = group.packages(return_query=True)
-                if from_ and not until:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp > from_).\
-                        all()
-                if until and not from_:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp < until).\
-                        all()
-                if from_ and until:
-                    packages = packages.filter(
-                            between(PackageRevision.revision_timestamp,
-                                    from_,
-                                    until))\
-                                    .all()
-        if cursor:
-            packages = packages[:cursor]
-        for res in packages:
-            data.append(self._record_for_dataset(res))
+        for header, deleted in headers:
+            if deleted:
+                data.append((header, None, None))
+            elif header.identifier() in packages:
+                data.append((header,
+                             self._metadata_for_dataset(
+                                 packages[header.identifier()]),
+                             None))
         return data
 
+    def listRecordFields(self, metadataPrefix, set=None, cursor=None,
+                         from_=None, until=None, batch_size=None):
+        '''Like listRecords, with the Dublin Core fields of the live records
+        for the direct serializer instead of their metadata. With prefetch
+        on, the next page is read ahead once this one has been read.
+        '''
+        prefetcher = get_prefetcher()
+        if prefetcher is None:
+            return self._record_fields(set, cursor, from_, until, batch_size)
+        cursor = cursor or 0
+        records = prefetcher.take((set, cursor, from_, until, batch_size))
+        if records is None:
+            records = self._record_fields(set, cursor, from_, until,
+                                          batch_size)
+        if batch_size and len(records) >= batch_size:
+            # The batching resumption reads one record more than a page
+            # holds, to know whether there is a next page.
+            next_cursor = cursor + batch_size - 1
+            session, dataset_url = self._session, DatasetURL()
+
+            def read():
+                try:
+                    return CKANServer(session)._record_fields(
+                        set, next_cursor, from_, until, batch_size,
+                        dataset_url)
+                finally:
+                    # Sets are resolved through the primary session.
+                    session.remove()
+                    if session is not Session:
+                        Session.remove()
+            prefetcher.schedule((set, next_cursor, from_, until, batch_size),
+                                read)
+        return records
+
+    def _record_fields(self, set, cursor, from_, until, batch_size,
+                       dataset_url=None):
+        headers = self._page_headers(set, cursor, from_, until, batch_size)
+        fields = dc_fields([header.identifier() for header, deleted in headers
+                            if not deleted], self._session, dataset_url)
+        return [(header, None if deleted else fields[header.identifier()])
+                for header, deleted in headers
+                if deleted or header.identifier() in fields]
+
     def listSets(self, cursor=None, batch_size=None):
-        '''List all sets in this repository, where sets are groups.
+        '''List one batch of the sets in this repository, where sets are
+        active groups in name order. The groups of harvested sets are listed
+        as subsets of the group of their domain.
         '''
-        data = []
-        if not cursor:
-            groups = Session.query(Group).all()
-        else:
-            groups = Session.query(Group).all()[:cursor]
-        for dataset in groups:
-            data.append((dataset.id, dataset.name, dataset.description))
-        return data
+        group_ids = dict(self._session.query(Group.name, Group.id).filter(
+            Group.state == State.ACTIVE))
+        query = self._session.query(Group).\
+            filter(Group.state == State.ACTIVE).order_by(Group.name)
+        return [(set_spec_for_group(group, group_ids),
+                 group.name,
+                 group.description)
+                for group in self._page(query, cursor, batch_size)]
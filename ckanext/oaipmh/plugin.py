@@ -1,7 +1,20 @@
 import logging
 import os
+from datetime import datetime
+
 from ckan.plugins import implements, SingletonPlugin
-from ckan.plugins import IRoutes, IConfigurer
+from ckan.plugins import IRoutes, IConfigurer, IConfigurable
+from ckan.plugins import IDomainObjectModification, IGroupController
+from ckan.model import Package, State, Session
+from ckan.model.domain_object import DomainObjectOperation
+
+from paste.deploy.converters import asbool
+from sqlalchemy.exc import SQLAlchemyError
+
+from model import setup as setup_model, mark_deleted, unmark_deleted
+from model import touch_package, refresh_package_sets, refresh_group_sets
+from model import journal_changes, journaled, CREATE, UPDATE, DELETE
+import catalogue_index
 
 log = logging.getLogger(__name__)
 
@@ -13,6 +26,9 @@ class OAIPMHPlugin(SingletonPlugin):
     '''
     implements(IRoutes, inherit=True)
     implements(IConfigurer)
+    implements(IConfigurable)
+    implements(IDomainObjectModification, inherit=True)
+    implements(IGroupController, inherit=True)
 
     def update_config(self, config):
         """This IConfigurer implementation causes CKAN to look in the
@@ -31,6 +47,75 @@ class OAIPMHPlugin(SingletonPlugin):
         config['extra_template_paths'] = ','.join([template_dir,
                 config.get('extra_template_paths', '')])
 
+    def configure(self, config):
+        '''Create the OAI-PMH tables on start up, and load the catalogue
+        index if it is on.
+        '''
+        setup_model()
+        if asbool(config.get('ckanext.oaipmh.catalogue_index', False)):
+            try:
+                catalogue_index.rebuild()
+            except SQLAlchemyError as e:
+                log.warning('Catalogue index not loaded: %s' % e)
+
+    def notify(self, entity, operation):
+        '''Keep the tombstones of deleted, purged and private packages up to
+        date so that they can be served as deleted records, and keep the
+        modification time and set membership of the other packages current.
+        Deleted packages keep their last set membership. Each change is
+        appended to the change journal. Packages which have never been
+        public, such as packages created private, are not served at all, not
+        even as deleted records.
+        '''
+        if not isinstance(entity, Package):
+            return
+        now = datetime.utcnow()
+        if operation == DomainObjectOperation.deleted or \
+                entity.state == State.DELETED or entity.private:
+            if journaled(entity.id) and mark_deleted(entity.id, now):
+                journal_changes([(entity.id, now, DELETE)])
+        else:
+            unmark_deleted(entity.id)
+            touch_package(entity.id, now)
+            refresh_package_sets(entity)
+            change = CREATE if operation == DomainObjectOperation.new \
+                else UPDATE
+            journal_changes([(entity.id, now, change)])
+        catalogue_index.invalidate()
+
+    def _refresh_group(self, group):
+        '''Refresh the setSpecs of the members of a group and journal the
+        change of the live ones, whose records have new setSpecs.
+        '''
+        package_ids = refresh_group_sets(group)
+        if not package_ids:
+            return
+        now = datetime.utcnow()
+        live = [package_id for package_id, in Session.query(Package.id).
+                filter(Package.id.in_(package_ids)).
+                filter(Package.state == State.ACTIVE).
+                filter(Package.private == False)]
+        for package_id in live:
+            touch_package(package_id, now)
+        journal_changes([(package_id, now, UPDATE) for package_id in live])
+        catalogue_index.invalidate()
+
+    def create(self, entity):
+        '''A new group may be the parent of existing subsets.
+        '''
+        self._refresh_group(entity)
+
+    def edit(self, entity):
+        '''The setSpecs of the members of a group and its subsets depend on
+        its name and state.
+        '''
+        self._refresh_group(entity)
+
+    def delete(self, entity):
+        '''Drop the setSpecs of a deleted group.
+        '''
+        self._refresh_group(entity)
+
     def before_map(self, map):
         '''Map the controller to be used for OAI-PMH.
         '''
@@ -0,0 +1,145 @@
+'''Speculative prefetch of the next ListRecords page.
+
+Harvesters ask for the next resumption token as soon as they have a page.
+With ckanext.oaipmh.prefetch on, the records of the next page are read in a
+background thread once a page has been read, so that they are ready when the
+token comes. A page is taken once, and dropped if it is not asked for within
+ckanext.oaipmh.prefetch.ttl seconds. At most ckanext.oaipmh.prefetch.workers
+pages are read at a time, and the pages kept are bounded by an estimate of
+their size, ckanext.oaipmh.prefetch.max_size megabytes. A request for a page
+which is still being read waits for it up to ckanext.oaipmh.prefetch.wait
+seconds, then reads the page itself.
+'''
+import time
+import logging
+import threading
+
+from pylons import config
+from paste.deploy.converters import asbool
+
+log = logging.getLogger(__name__)
+
+# Rough size of a record besides its field values.
+RECORD_OVERHEAD = 200
+
+
+def _size(records):
+    '''Estimate the memory taken by the (header, fields) records of a page.
+    '''
+    size = 0
+    for header, fields in records:
+        size += RECORD_OVERHEAD
+        for values in (fields or {}).values():
+            size += sum(len(value) for value in values if value)
+    return size
+
+
+class _Pending(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.abandoned = False
+
+
+class Prefetcher(object):
+    '''Pages read ahead by key, each read by a function in a thread of its
+    own.
+    '''
+    def __init__(self, workers=2, ttl=60, max_size=64 * 1024 * 1024,
+                 wait=0.5):
+        self.workers = workers
+        self.ttl = ttl
+        self.max_size = max_size
+        self.wait = wait
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._pages = {}  # key: (time read, size, records)
+        self._pending = {}
+        self._size = 0
+
+    def _expire(self, now):
+        for key, (read, size, _) in self._pages.items():
+            if now - read > self.ttl:
+                del self._pages[key]
+                self._size -= size
+
+    def take(self, key):
+        '''Return the records read ahead for a key and forget them, waiting
+        a little for them if they are being read. None if there are none
+        yet, the caller reads them then.
+        '''
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            pending.done.wait(self.wait)
+        with self._lock:
+            if pending is not None and not pending.done.is_set():
+                # Read by the caller, the page is not kept when it is done.
+                pending.abandoned = True
+                return None
+            self._expire(time.time())
+            page = self._pages.pop(key, None)
+            if page is None:
+                return None
+            self._size -= page[1]
+            self.hits += 1
+            return page[2]
+
+    def schedule(self, key, read):
+        '''Read the records of a key in the background, unless they are
+        already there or being read, or too many pages are being read.
+        '''
+        with self._lock:
+            if key in self._pages or key in self._pending or \
+                    len(self._pending) >= self.workers:
+                return
+            pending = self._pending[key] = _Pending()
+        thread = threading.Thread(target=self._read, args=(key, read, pending))
+        thread.daemon = True
+        thread.start()
+
+    def _read(self, key, read, pending):
+        try:
+            records = read()
+        except Exception as e:
+            log.debug('Could not prefetch %r: %s' % (key, e))
+            records = None
+        with self._lock:
+            del self._pending[key]
+            if records is not None and not pending.abandoned:
+                now = time.time()
+                self._expire(now)
+                size = _size(records)
+                # Oldest pages go first to make room.
+                for old in sorted(self._pages,
+                                  key=lambda k: self._pages[k][0]):
+                    if self._size + size <= self.max_size:
+                        break
+                    self._size -= self._pages.pop(old)[1]
+                if self._size + size <= self.max_size:
+                    self._pages[key] = (now, size, records)
+                    self._size += size
+            pending.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._size = 0
+
+
+_prefetcher = None
+
+
+def get_prefetcher():
+    '''Return the prefetcher of the process if prefetch is on, else None.
+    '''
+    global _prefetcher
+    if not asbool(config.get('ckanext.oaipmh.prefetch', False)):
+        return None
+    if _prefetcher is None:
+        _prefetcher = Prefetcher(
+            int(config.get('ckanext.oaipmh.prefetch.workers', 2)),
+            float(config.get('ckanext.oaipmh.prefetch.ttl', 60)),
+            float(config.get('ckanext.oaipmh.prefetch.max_size', 64)) *
+            1024 * 1024,
+            float(config.get('ckanext.oaipmh.prefetch.wait', 0.5)))
+    return _prefetcher
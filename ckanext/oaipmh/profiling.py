@@ -0,0 +1,112 @@
+'''Profiling of OAI-PMH requests and harvest stages on demand.
+
+Nothing is profiled unless ckanext.oaipmh.profile.dir is set. Then a
+fraction ckanext.oaipmh.profile.rate of the /oai requests, and the stages of
+the harvest jobs whose ids, or the ids or URLs of whose sources, are listed
+in ckanext.oaipmh.profile.jobs, run under cProfile. Each profile is dumped
+in the pstats format, which pstats, snakeviz, gprof2dot or flameprof read, to
+a file named after its tags: the verb or stage, the metadata prefix, the set
+and the number of records. When profiling is off, the check costs a few
+configuration lookups.
+'''
+import os
+import re
+import time
+import random
+import cProfile
+import logging
+import itertools
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+TAGS = ('verb', 'prefix', 'set', 'records')
+
+_UNSAFE = re.compile(r'[^\w.:-]+')
+_counter = itertools.count()
+
+
+def _file_name(tags):
+    '''Return the name of the file of a profile, from its time, process and
+    tags.
+    '''
+    parts = [time.strftime('%Y%m%dT%H%M%S'), str(os.getpid()),
+             str(next(_counter))]
+    for tag in TAGS:
+        if tags.get(tag) is not None:
+            parts.append('%s=%s' % (tag, _UNSAFE.sub(
+                '_', unicode(tags[tag]).encode('utf-8'))[:60]))
+    return '-'.join(parts) + '.pstats'
+
+
+class Profile(object):
+    '''cProfile of the block of a with statement, dumped to the profile
+    directory with its tags at the end of the block.
+    '''
+    def __init__(self, directory, **tags):
+        self.directory = directory
+        self.tags = tags
+        self.path = None
+        self._profile = cProfile.Profile()
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def __enter__(self):
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profile.disable()
+        self.path = os.path.join(self.directory, _file_name(self.tags))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._profile.dump_stats(self.path)
+        except (IOError, OSError) as e:
+            log.warning('Could not write profile %s: %s' % (self.path, e))
+        return False
+
+
+class _NoProfile(object):
+    '''Stand-in for a Profile when nothing is profiled.
+    '''
+    path = None
+
+    def tag(self, **tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_PROFILE = _NoProfile()
+
+
+def for_request():
+    '''Return a Profile for an /oai request if it is sampled, NO_PROFILE
+    otherwise.
+    '''
+    directory = config.get('ckanext.oaipmh.profile.dir')
+    if not directory:
+        return NO_PROFILE
+    if random.random() >= float(config.get('ckanext.oaipmh.profile.rate', 0)):
+        return NO_PROFILE
+    return Profile(directory)
+
+
+def for_job(harvest_job, **tags):
+    '''Return a Profile for a stage of a harvest job if it is profiled,
+    NO_PROFILE otherwise.
+    '''
+    directory = config.get('ckanext.oaipmh.profile.dir')
+    if not directory:
+        return NO_PROFILE
+    names = config.get('ckanext.oaipmh.profile.jobs', '').split()
+    source = harvest_job.source
+    if not set(names) & set([harvest_job.id, source.id, source.url]):
+        return NO_PROFILE
+    return Profile(directory, **tags)
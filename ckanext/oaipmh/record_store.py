@@ -0,0 +1,68 @@
+'''Content-addressed store of the raw records fetched by the harvester.
+
+Each GetRecord response is kept gzipped under the SHA-1 of its content, so
+that unchanged records are stored once and the mapping can be converted
+again from disk, without harvesting the providers anew.
+'''
+import os
+import gzip
+import hashlib
+
+from pylons import config
+
+from oaipmh.client import BaseClient
+
+
+def store_dir():
+    '''Return the store directory, or None if records are not kept.
+    '''
+    return config.get('ckanext.oaipmh.harvest.record_store') or None
+
+
+def _path(root, digest):
+    return os.path.join(root, digest[:2], digest + '.xml.gz')
+
+
+def put(data):
+    '''Store a raw record and return its digest, or None if there is no
+    store.
+    '''
+    root = store_dir()
+    if not root:
+        return None
+    digest = hashlib.sha1(data).hexdigest()
+    path = _path(root, digest)
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.%i.tmp' % (path, os.getpid())
+        f = gzip.open(tmp, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    return digest
+
+
+def get(digest):
+    '''Return the raw record stored under a digest.
+    '''
+    f = gzip.open(_path(store_dir(), digest), 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class RecordClient(BaseClient):
+    '''Answers with a stored response, so that pyoai parses a fetched record
+    just as it would parse it from the provider.
+    '''
+    def __init__(self, data, metadata_registry=None):
+        BaseClient.__init__(self, metadata_registry)
+        self._data = data
+
+    def makeRequest(self, **kw):
+        return self._data
@@ -0,0 +1,106 @@
+'''Read-only replica for the bulk OAI-PMH list verbs.
+
+ListIdentifiers, ListRecords and ListSets may read from a replica of the
+CKAN database, configured with ckanext.oaipmh.replica.url, so that big
+harvests of the interface do not compete with the writes to the primary.
+The replication lag of a PostgreSQL standby is checked at most every
+CHECK_INTERVAL seconds: while it is over ckanext.oaipmh.replica.max_lag
+seconds, or while the replica cannot be reached, the primary is used.
+'''
+import time
+import logging
+import threading
+
+from sqlalchemy import create_engine, orm
+from sqlalchemy.exc import SQLAlchemyError
+
+from ckan.model import Session
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+REPLICA_VERBS = ('ListIdentifiers', 'ListRecords', 'ListSets')
+CHECK_INTERVAL = 10
+
+ReadSession = orm.scoped_session(orm.sessionmaker(autoflush=False,
+                                                  autocommit=False))
+
+_lock = threading.Lock()
+_state = {'url': None, 'engine': None, 'checked': 0, 'lag': None}
+
+
+def _lag(engine):
+    '''Return the replication lag of a database in seconds, 0 if it is not a
+    standby or has replayed everything it has received.
+    '''
+    if engine.dialect.name != 'postgresql':
+        return 0
+    connection = engine.connect()
+    try:
+        # The server version is known once connected.
+        if engine.dialect.server_version_info >= (10,):
+            received, replayed = ('pg_last_wal_receive_lsn',
+                                  'pg_last_wal_replay_lsn')
+        else:
+            received, replayed = ('pg_last_xlog_receive_location',
+                                  'pg_last_xlog_replay_location')
+        return connection.execute(
+            'SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 '
+            'WHEN %s() = %s() THEN 0 ELSE EXTRACT(EPOCH FROM now() - '
+            'pg_last_xact_replay_timestamp()) END' % (received, replayed)
+        ).scalar() or 0
+    finally:
+        connection.close()
+
+
+def _engine(url):
+    if _state['url'] != url:
+        if _state['engine'] is not None:
+            _state['engine'].dispose()
+        _state.update(url=url, engine=create_engine(url), checked=0,
+                      lag=None)
+        ReadSession.remove()
+        ReadSession.configure(bind=_state['engine'])
+    return _state['engine']
+
+
+def lag():
+    '''Return the replication lag of the replica in seconds as last checked,
+    or None if there is no replica or it cannot be reached.
+    '''
+    url = config.get('ckanext.oaipmh.replica.url')
+    if not url:
+        return None
+    with _lock:
+        engine = _engine(url)
+        now = time.time()
+        if now - _state['checked'] >= CHECK_INTERVAL:
+            _state['checked'] = now
+            try:
+                _state['lag'] = float(_lag(engine))
+            except SQLAlchemyError as e:
+                log.warning('Replica unavailable: %s' % e)
+                _state['lag'] = None
+        return _state['lag']
+
+
+def session():
+    '''Return the session to read the list verbs from: the replica session if
+    there is a replica within the maximum lag, otherwise the primary one.
+    '''
+    replica_lag = lag()
+    if replica_lag is None:
+        return Session
+    if replica_lag > float(config.get('ckanext.oaipmh.replica.max_lag', 30)):
+        log.debug('Replica %.1f seconds behind, using the primary.' %
+                  replica_lag)
+        return Session
+    return ReadSession
+
+
+def remove():
+    '''Release the replica session of the request, if any.
+    '''
+    if _state['engine'] is not None:
+        ReadSession.remove()
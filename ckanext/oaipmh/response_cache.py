@@ -0,0 +1,100 @@
+'''Cache of the OAI-PMH responses which do not depend on the packages.
+
+Identify, ListMetadataFormats and ListSets are asked for at the start of
+every harvest and change only with the configuration or the groups. Their
+serialized responses are kept per process along with a version: the
+configuration the server reads and, for ListSets, the time of the last group
+revision and the number of groups, which one small query returns. A response
+is rendered again when its version has changed, so that changes made through
+other processes are seen on the next request. The responseDate is set on
+each response served.
+'''
+import re
+import hashlib
+import datetime
+import threading
+
+from pylons import config
+from sqlalchemy import select, func
+
+from ckan.model import Session
+from ckan.model.group import group_table, group_revision_table
+
+from oaipmh.datestamp import datetime_to_datestamp
+
+CACHED_VERBS = ('Identify', 'ListMetadataFormats', 'ListSets')
+# The configuration read by the server for these responses.
+CONFIG_KEYS = ('site.title', 'email_to', 'ckan.site_url', 'ckan.root_path')
+# Requests with other arguments are rendered too, errors included, so the
+# number of responses kept is bounded.
+MAX_ENTRIES = 1000
+
+_RESPONSE_DATE = re.compile('<responseDate>[^<]*</responseDate>')
+
+
+class Entry(object):
+    '''A rendered response and the version it was rendered for.
+    '''
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(
+            _RESPONSE_DATE.sub('', body)).hexdigest()
+
+    def response(self, now=None):
+        '''Return the body with the current responseDate.
+        '''
+        stamp = datetime_to_datestamp(now or datetime.datetime.utcnow())
+        return _RESPONSE_DATE.sub(
+            '<responseDate>%s</responseDate>' % stamp, self.body, 1)
+
+
+def group_version():
+    '''Return the time of the last group revision and the number of groups.
+    '''
+    return Session.execute(select([
+        select([func.max(group_revision_table.c.revision_timestamp)]).
+        as_scalar(),
+        select([func.count(group_table.c.id)]).as_scalar()])).first()
+
+
+def version(verb):
+    '''Return the version of the response to a verb.
+    '''
+    version = tuple(config.get(key) for key in CONFIG_KEYS)
+    if verb == 'ListSets':
+        version += tuple(group_version())
+    return version
+
+
+def _key(params):
+    return tuple(sorted(params.items()))
+
+
+_entries = {}
+_lock = threading.Lock()
+
+
+def get(params, version):
+    '''Return the cached entry of a request if it has this version, or None.
+    '''
+    entry = _entries.get(_key(params))
+    if entry is not None and entry.version == version:
+        return entry
+    return None
+
+
+def put(params, version, body):
+    '''Cache the response to a request and return its entry.
+    '''
+    entry = Entry(version, body)
+    with _lock:
+        if len(_entries) >= MAX_ENTRIES:
+            _entries.clear()
+        _entries[_key(params)] = entry
+    return entry
+
+
+def clear():
+    with _lock:
+        _entries.clear()
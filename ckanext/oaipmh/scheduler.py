@@ -0,0 +1,224 @@
+'''Adaptive request scheduling for harvested OAI-PMH providers.
+
+Requests to a host go through its scheduler, which limits how many are in
+flight at once. The limit grows by one after a run of fast responses and is
+halved when the provider slows down, fails or answers 503. Retry-After is
+honoured for every request to the host, and transient failures are retried
+after an exponential backoff with jitter. The schedulers are kept per process.
+
+Each request has its own socket timeout, for the connection and for every
+read, and the whole response must arrive within a deadline, so that a
+provider trickling data cannot hold a worker.
+'''
+import time
+import random
+import socket
+import urllib2
+import httplib
+import logging
+import threading
+from urlparse import urlparse
+from urllib import urlencode
+
+from pylons import config
+
+import oaipmh.client
+
+log = logging.getLogger(__name__)
+
+# Retry-After is ignored past this many seconds, the request fails instead.
+MAX_RETRY_AFTER = 3600
+BLOCK_SIZE = 65536
+
+
+class TransientError(Exception):
+    '''A request still failed after all attempts, but may succeed later.
+    '''
+
+
+class HostScheduler(object):
+    '''Schedules the requests to one host.
+
+    :param max_concurrency: upper bound of the concurrency limit
+    :param target_latency: seconds under which a response counts as healthy
+    :param backoff: base of the exponential backoff, in seconds
+    :param max_backoff: upper bound of the backoff, in seconds
+    :param slot_timeout: seconds to wait for a free slot before giving up
+    '''
+    # Healthy responses needed to raise the limit by one.
+    increase_after = 5
+
+    def __init__(self, max_concurrency=4, target_latency=2.0, backoff=1.0,
+                 max_backoff=300.0, slot_timeout=600.0):
+        self._condition = threading.Condition()
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.slot_timeout = slot_timeout
+        self.limit = 1
+        self.running = 0
+        self.healthy = 0
+        self.not_before = 0
+
+    def acquire(self, sleep=time.sleep):
+        '''Wait until a request may be sent to the host. Raises
+        TransientError if no slot frees up within slot_timeout seconds.
+        '''
+        give_up = time.time() + self.slot_timeout
+        while True:
+            with self._condition:
+                now = time.time()
+                delay = self.not_before - now
+                if delay <= 0 and self.running < self.limit:
+                    self.running += 1
+                    return
+                if delay <= 0:
+                    if now >= give_up:
+                        raise TransientError(
+                            'No request slot free within %s seconds' %
+                            self.slot_timeout)
+                    self._condition.wait(give_up - now)
+                    continue
+            sleep(delay)
+
+    def release(self, latency=None, ok=True):
+        '''Give back a slot, with the latency of the request if it got a
+        response and whether the response was a healthy one.
+        '''
+        with self._condition:
+            self.running -= 1
+            if ok and latency is not None and latency <= self.target_latency:
+                self.healthy += 1
+                if self.healthy >= self.increase_after and \
+                        self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.healthy = 0
+            else:
+                self.limit = max(1, self.limit // 2)
+                self.healthy = 0
+            self._condition.notify_all()
+
+    def retry_after(self, seconds):
+        '''Hold back every request to the host for the given time.
+        '''
+        with self._condition:
+            self.not_before = max(self.not_before, time.time() + seconds)
+
+    def delay(self, attempt):
+        '''Return a backoff for the given attempt, from 0, with full jitter.
+        '''
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(url):
+    '''Return the scheduler of the host of a URL, set up from the
+    configuration on first use.
+    '''
+    host = urlparse(url).netloc.lower()
+    with _schedulers_lock:
+        if host not in _schedulers:
+            _schedulers[host] = HostScheduler(
+                int(config.get('ckanext.oaipmh.harvest.max_concurrency', 4)),
+                float(config.get('ckanext.oaipmh.harvest.target_latency', 2)),
+                float(config.get('ckanext.oaipmh.harvest.backoff', 1)),
+                float(config.get('ckanext.oaipmh.harvest.max_backoff', 300)),
+                float(config.get('ckanext.oaipmh.harvest.slot_timeout', 600)))
+        return _schedulers[host]
+
+
+def _retry_after(error):
+    try:
+        return int(error.hdrs.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class _DeadlineReader(object):
+    '''Response wrapper which fails once the response as a whole has taken
+    longer than its deadline.
+    '''
+    def __init__(self, f, deadline):
+        self._f = f
+        self._deadline = deadline
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(BLOCK_SIZE), ''))
+        if time.time() > self._deadline:
+            raise socket.timeout('Response not complete before its deadline')
+        return self._f.read(size)
+
+
+class ScheduledClient(oaipmh.client.Client):
+    '''OAI-PMH client whose requests go through the scheduler of the host.
+    Raises TransientError once a request has failed max_attempts times with
+    a network error, a timeout, 503 or another 5xx response.
+    '''
+    def __init__(self, base_url, metadata_registry=None, credentials=None,
+                 max_attempts=None):
+        oaipmh.client.Client.__init__(self, base_url, metadata_registry,
+                                      credentials)
+        self._scheduler = scheduler_for(base_url)
+        self._max_attempts = max_attempts or \
+            int(config.get('ckanext.oaipmh.harvest.max_attempts', 5))
+        self._timeout = float(config.get('ckanext.oaipmh.harvest.timeout', 30))
+        self._response_deadline = float(config.get(
+            'ckanext.oaipmh.harvest.response_deadline', 300))
+
+    def _read(self, f):
+        return f.read()
+
+    def _request(self, kw, read):
+        '''Send a request through the scheduler and return what read makes
+        of the response.
+        '''
+        headers = {'User-Agent': 'pyoai'}
+        if self._credentials is not None:
+            headers['Authorization'] = 'Basic ' + self._credentials.strip()
+        scheduler = self._scheduler
+        for attempt in range(self._max_attempts):
+            request = urllib2.Request(
+                self._base_url, data=urlencode(kw), headers=headers)
+            scheduler.acquire()
+            started = time.time()
+            try:
+                f = urllib2.urlopen(request, timeout=self._timeout)
+                try:
+                    result = read(_DeadlineReader(
+                        f, started + self._response_deadline))
+                finally:
+                    f.close()
+            except urllib2.HTTPError as e:
+                scheduler.release(time.time() - started, ok=False)
+                if e.code < 500:
+                    raise
+                seconds = _retry_after(e) if e.code == 503 else None
+                if seconds is not None and seconds <= MAX_RETRY_AFTER:
+                    scheduler.retry_after(seconds)
+                else:
+                    scheduler.retry_after(scheduler.delay(attempt))
+                error = e
+            except (urllib2.URLError, socket.error, httplib.HTTPException) \
+                    as e:
+                scheduler.release(ok=False)
+                scheduler.retry_after(scheduler.delay(attempt))
+                error = e
+            except:
+                scheduler.release(ok=False)
+                raise
+            else:
+                scheduler.release(time.time() - started)
+                return result
+            log.debug('Attempt %i of %s failed: %s' % (
+                attempt + 1, self._base_url, error))
+        raise TransientError('%s failed %i times, last: %s' % (
+            self._base_url, self._max_attempts, error))
+
+    def makeRequest(self, **kw):
+        return self._request(kw, self._read)
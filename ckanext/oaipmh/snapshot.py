@@ -0,0 +1,250 @@
+'''Pre-rendered snapshot of the whole catalogue for complete ListRecords
+harvests.
+
+The snapshot is a series of gzipped ListRecords pages for each metadata
+prefix, chained by resumption tokens of the form
+``snapshot.<generation>.<prefix>.<page>``. A full build starts a new
+generation, a refresh re-renders in place only the pages holding packages
+changed since the last build or refresh and appends pages for new packages.
+The responseDate of every page is the time up to which the snapshot is
+consistent, so harvesters can continue incrementally from there.
+'''
+import os
+import json
+import gzip
+import shutil
+import logging
+import datetime
+from urlparse import urlparse
+
+from pylons import config
+
+from ckan.model import Session, Package, State
+
+from model import oai_tombstone_table
+from oaipmh_server import CKANServer
+from serializer import PREFIXES, DatasetURL, list_records
+from serializer import request_attributes
+
+log = logging.getLogger(__name__)
+
+TOKEN_PREFIX = 'snapshot'
+STAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Paths of the OAI-PMH interface and of the dataset pages, as routed by the
+# plugin and by CKAN. Snapshots are built without a request to route URLs.
+OAI_PATH = '/oai'
+DATASET_PATH = '/dataset/'
+
+
+def snapshot_dir():
+    '''Return the snapshot directory, or None if snapshots are disabled.
+    '''
+    return config.get('ckanext.oaipmh.snapshot.dir') or None
+
+
+def page_size():
+    return int(config.get('ckanext.oaipmh.snapshot.page_size', 100))
+
+
+def token(generation, prefix, page):
+    return '%s.%s.%s.%i' % (TOKEN_PREFIX, generation, prefix, page)
+
+
+def parse_token(value):
+    '''Return (generation, prefix, page) of a snapshot resumption token, or
+    None if it is not one.
+    '''
+    parts = value.split('.')
+    if len(parts) != 4 or parts[0] != TOKEN_PREFIX:
+        return None
+    _, generation, prefix, page = parts
+    if not generation.isdigit() or prefix not in PREFIXES or \
+            not page.isdigit():
+        return None
+    return generation, prefix, int(page)
+
+
+def page_path(root, generation, prefix, page):
+    return os.path.join(root, generation, prefix, '%08i.xml.gz' % page)
+
+
+def _current(root):
+    try:
+        with open(os.path.join(root, 'current')) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def find_page(params):
+    '''Return the path of the snapshot page answering a request, or None if
+    the request has to be answered by the live server. Only ListRecords
+    requests without set or date selection are answered from the snapshot.
+    '''
+    root = snapshot_dir()
+    if not root or params.get('verb') != 'ListRecords':
+        return None
+    if not all(isinstance(value, basestring) for value in params.values()):
+        return None
+    keys = set(params.keys()) - set(['verb'])
+    if keys == set(['metadataPrefix']):
+        generation = _current(root)
+        prefix = params['metadataPrefix']
+        if generation is None or prefix not in PREFIXES:
+            return None
+        path = page_path(root, generation, prefix, 0)
+    elif keys == set(['resumptionToken']):
+        parsed = parse_token(params['resumptionToken'])
+        if parsed is None:
+            return None
+        path = page_path(root, *parsed)
+    else:
+        return None
+    return path if os.path.exists(path) else None
+
+
+def _render(base_url, prefix, records, request_token, next_token, stamp):
+    attributes = request_attributes(verb='ListRecords', metadataPrefix=prefix)
+    if request_token is not None:
+        attributes = [(key, value) for key, value in attributes
+                      if key != 'metadataPrefix']
+        attributes.append(('resumptionToken', request_token))
+    return list_records(attributes, base_url, records, prefix, next_token,
+                        stamp)
+
+
+def _write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    f = gzip.open(tmp, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+def _render_pages(root, generation, pages, numbers, stamp):
+    site_url = config.get('ckan.site_url', '').rstrip('/')
+    base_url = urlparse(site_url).path + OAI_PATH
+    dataset_url = DatasetURL(site_url + DATASET_PATH)
+    server = CKANServer()
+    for number in numbers:
+        records = server.record_fields(pages[number], dataset_url)
+        if not records:
+            log.warning('Snapshot page %i is empty, kept as it was' % number)
+            continue
+        for prefix in PREFIXES:
+            request_token = token(generation, prefix, number) \
+                if number else None
+            next_token = token(generation, prefix, number + 1) \
+                if number + 1 < len(pages) else None
+            _write(page_path(root, generation, prefix, number),
+                   _render(base_url, prefix, records, request_token,
+                           next_token, stamp))
+        # Keep memory bounded by one page.
+        Session.expunge_all()
+
+
+def _paginate(ids, pages=None):
+    pages = pages if pages is not None else []
+    size = page_size()
+    ids = list(ids)
+    if pages and len(pages[-1]) < size:
+        room = size - len(pages[-1])
+        pages[-1].extend(ids[:room])
+        ids = ids[room:]
+    for start in range(0, len(ids), size):
+        pages.append(ids[start:start + size])
+    return pages
+
+
+def _catalogue_ids(since=None):
+    '''Return the ids of the live and deleted packages, all of them or those
+    changed since the given time, in modification order.
+    '''
+    live = Session.query(Package.id).filter(Package.state == State.ACTIVE).\
+        filter(Package.private == False)
+    deleted = Session.query(oai_tombstone_table.c.package_id)
+    if since is not None:
+        live = live.filter(Package.metadata_modified >= since)
+        deleted = deleted.filter(oai_tombstone_table.c.deleted >= since)
+    live = live.order_by(Package.metadata_modified, Package.id)
+    deleted = deleted.order_by(oai_tombstone_table.c.deleted)
+    ids, seen = [], set()
+    for package_id, in list(live) + list(deleted):
+        if package_id not in seen:
+            seen.add(package_id)
+            ids.append(package_id)
+    return ids
+
+
+def build():
+    '''Render a new generation of the snapshot and make it the current one.
+    The previous generation is kept for harvesters still walking it.
+    '''
+    root = snapshot_dir()
+    if not root:
+        raise ValueError('ckanext.oaipmh.snapshot.dir is not configured')
+    stamp = datetime.datetime.utcnow().replace(microsecond=0)
+    generation = stamp.strftime('%Y%m%d%H%M%S')
+    previous = _current(root)
+    pages = _paginate(_catalogue_ids())
+    _render_pages(root, generation, pages, range(len(pages)), stamp)
+    if not os.path.isdir(os.path.join(root, generation)):
+        os.makedirs(os.path.join(root, generation))
+    _write_json(os.path.join(root, generation, 'manifest.json'),
+                {'updated': stamp.strftime(STAMP_FORMAT), 'pages': pages})
+    with open(os.path.join(root, 'current.tmp'), 'w') as f:
+        f.write(generation)
+    os.rename(os.path.join(root, 'current.tmp'),
+              os.path.join(root, 'current'))
+    for name in os.listdir(root):
+        if name.isdigit() and name not in (generation, previous):
+            shutil.rmtree(os.path.join(root, name))
+    log.info('Built snapshot %s with %i pages' % (generation, len(pages)))
+    return generation
+
+
+def refresh():
+    '''Bring the current snapshot up to date with the packages changed since
+    it was last built or refreshed. Builds one if there is none yet.
+    '''
+    root = snapshot_dir()
+    generation = _current(root) if root else None
+    if generation is None:
+        return build()
+    manifest_path = os.path.join(root, generation, 'manifest.json')
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    since = datetime.datetime.strptime(manifest['updated'], STAMP_FORMAT)
+    stamp = datetime.datetime.utcnow().replace(microsecond=0)
+    pages = manifest['pages']
+    position = {}
+    for number, ids in enumerate(pages):
+        for package_id in ids:
+            position[package_id] = number
+    changed = _catalogue_ids(since)
+    dirty = set(position[package_id] for package_id in changed
+                if package_id in position)
+    new = [package_id for package_id in changed
+           if package_id not in position]
+    if new:
+        # The last page gets new records or at least a resumption token.
+        first = len(pages) - 1 if pages else 0
+        pages = _paginate(new, pages)
+        dirty.update(range(first, len(pages)))
+    _render_pages(root, generation, pages, sorted(dirty), stamp)
+    _write_json(manifest_path,
+                {'updated': stamp.strftime(STAMP_FORMAT), 'pages': pages})
+    log.info('Refreshed %i pages of snapshot %s' % (len(dirty), generation))
+    return generation
@@ -0,0 +1,153 @@
+'''What a harvest source already has in the catalogue, loaded once per job.
+
+The import stage looks up the package and the last imported digest of every
+record, and the group of every set. The index answers these from memory. The
+package map keeps sorted 64-bit hashes of the identifiers in arrays, with the
+package ids in one string and the digests packed, so that it stays small for
+sources with millions of records.
+'''
+import bisect
+import hashlib
+import logging
+from array import array
+from collections import OrderedDict
+from cStringIO import StringIO
+from binascii import hexlify, unhexlify
+
+from sqlalchemy import select, or_
+
+from ckan.model import Session, Group
+from ckanext.harvest.model import HarvestJob
+
+from model import SUBSET_SEPARATOR, oai_harvest_record_table
+
+log = logging.getLogger(__name__)
+
+_KEY_TYPE = 'L'
+_KEY_BYTES = array(_KEY_TYPE).itemsize
+_DIGEST_BYTES = 20
+_NO_DIGEST = '\0' * _DIGEST_BYTES
+
+
+def _key(identifier):
+    return int(hexlify(hashlib.sha1(identifier.encode('utf-8')).digest()
+                       [:_KEY_BYTES]), 16)
+
+
+class PackageMap(object):
+    '''Maps record identifiers to (package id, digest of the record last
+    imported). Built from (identifier, package id, digest) triples.
+    '''
+    def __init__(self, records):
+        keys, offsets = array(_KEY_TYPE), array('L', [0])
+        ids, digests = StringIO(), StringIO()
+        for identifier, package_id, digest in records:
+            keys.append(_key(identifier))
+            package_id = package_id.encode('utf-8')
+            ids.write(package_id)
+            offsets.append(offsets[-1] + len(package_id))
+            digests.write(unhexlify(digest) if digest else _NO_DIGEST)
+        ids, digests = ids.getvalue(), digests.getvalue()
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        self._keys, self._offsets = array(_KEY_TYPE), array('L', [0])
+        sorted_ids, sorted_digests = StringIO(), StringIO()
+        for i in order:
+            self._keys.append(keys[i])
+            package_id = ids[offsets[i]:offsets[i + 1]]
+            sorted_ids.write(package_id)
+            self._offsets.append(self._offsets[-1] + len(package_id))
+            sorted_digests.write(
+                digests[i * _DIGEST_BYTES:(i + 1) * _DIGEST_BYTES])
+        del keys, ids, digests, offsets, order
+        self._ids = sorted_ids.getvalue()
+        self._digests = sorted_digests.getvalue()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, identifier):
+        '''Return (package id, digest) for an identifier, or None. A hash
+        collision may give the package of another record, so callers check
+        the package they load.
+        '''
+        key = _key(identifier)
+        i = bisect.bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return None
+        package_id = self._ids[self._offsets[i]:self._offsets[i + 1]]
+        digest = self._digests[i * _DIGEST_BYTES:(i + 1) * _DIGEST_BYTES]
+        return (package_id.decode('utf-8'),
+                hexlify(digest) if digest != _NO_DIGEST else None)
+
+
+class SourceIndex(object):
+    '''The packages a harvest source owns and the groups of its domains.
+    '''
+    def __init__(self, job_id, source_id):
+        self.job_id = job_id
+        table = oai_harvest_record_table
+        # Streamed from a server side cursor rather than fetched at once.
+        query = select([table.c.identifier, table.c.package_id,
+                        table.c.digest]).where(
+            table.c.harvest_source_id == source_id).where(
+            table.c.package_id != None).execution_options(stream_results=True)
+        self.packages = PackageMap(Session.execute(query))
+        self._groups = {}
+        self._domains = set()
+        log.debug('Loaded %i packages of source %s' % (
+            len(self.packages), source_id))
+
+    def _load_domain(self, domain):
+        query = Session.query(Group.name, Group.id).filter(
+            or_(Group.name == domain,
+                Group.name.like(domain + SUBSET_SEPARATOR + '%')))
+        self._groups.update(query)
+        self._domains.add(domain)
+
+    def group(self, name, domain):
+        '''Return the group of a domain or of one of its sets, or None.
+        '''
+        if domain not in self._domains:
+            self._load_domain(domain)
+        group_id = self._groups.get(name)
+        # The identity map answers without a query while the session lasts.
+        return Session.query(Group).get(group_id) if group_id else None
+
+    def add_group(self, group):
+        self._groups[group.name] = group.id
+
+
+# Indexes kept per process, so that consumers taking the objects of several
+# jobs in turn do not load them again and again.
+MAX_INDEXES = 4
+_indexes = OrderedDict()
+
+
+def _drop_finished():
+    finished = Session.query(HarvestJob.id).filter(
+        HarvestJob.id.in_(_indexes.keys())).filter(
+        HarvestJob.status == u'Finished')
+    for job_id, in finished:
+        del _indexes[job_id]
+
+
+def for_job(harvest_job):
+    '''Return the index of the source of a job, loaded on its first use in
+    this process. The indexes of the jobs used last are kept, those of
+    finished jobs are dropped.
+    '''
+    index = _indexes.pop(harvest_job.id, None)
+    if index is None:
+        if _indexes:
+            _drop_finished()
+        while len(_indexes) >= MAX_INDEXES:
+            _indexes.popitem(last=False)
+        index = SourceIndex(harvest_job.id, harvest_job.source_id)
+    _indexes[harvest_job.id] = index
+    return index
+
+
+def forget(job_id):
+    '''Drop the index of a job, to be loaded again on its next use.
+    '''
+    _indexes.pop(job_id, None)
@@ -0,0 +1,82 @@
+'''Reader of OAI-PMH Static Repository files.
+
+A static repository is one XML file holding the Identify and
+ListMetadataFormats responses of a repository and a ListRecords element for
+each metadata prefix. The file is read once with iterparse, each record being
+handed out as soon as it is complete and dropped from the tree afterwards.
+Files given by a URL are downloaded to a temporary file first, so that a slow
+import cannot make the provider drop the connection.
+'''
+import shutil
+import tempfile
+import urllib2
+
+from lxml import etree
+
+from pylons import config
+
+from streaming import OAI_NS, _oai, _header, _drop
+
+STATIC_NS = 'http://www.openarchives.org/OAI/2.0/static-repository'
+
+
+def _static(tag):
+    return '{%s}%s' % (STATIC_NS, tag)
+
+
+def open_repository(location):
+    '''Open a static repository file given by a path or a URL.
+    '''
+    if '://' not in location:
+        return open(location, 'rb')
+    f = urllib2.urlopen(location, timeout=float(
+        config.get('ckanext.oaipmh.harvest.timeout', 30)))
+    try:
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(f, spool)
+    finally:
+        f.close()
+    spool.seek(0)
+    return spool
+
+
+def list_response(records):
+    '''Return a ListRecords response holding serialized records, as read by
+    streaming.parse_list.
+    '''
+    return '<ListRecords xmlns="%s">%s</ListRecords>' % (
+        OAI_NS, ''.join(records))
+
+
+def get_record_response(record):
+    '''Return a GetRecord response holding a serialized record, as fetched
+    from a live repository and kept in the record store.
+    '''
+    return '<OAI-PMH xmlns="%s"><GetRecord>%s</GetRecord></OAI-PMH>' % (
+        OAI_NS, record)
+
+
+class StaticRepository(object):
+    '''The records of one metadata prefix of a static repository file. The
+    repository name is known once the first record has been read.
+    '''
+    def __init__(self, f, metadata_prefix):
+        self._f = f
+        self.metadata_prefix = metadata_prefix
+        self.repository_name = None
+
+    def __iter__(self):
+        '''Yield the header and the serialization of each record, in file
+        order.
+        '''
+        for event, element in etree.iterparse(self._f, events=('end',)):
+            parent = element.getparent()
+            if element.tag == _oai('record') and parent is not None and \
+                    parent.tag == _static('ListRecords'):
+                if parent.get('metadataPrefix') == self.metadata_prefix:
+                    yield (_header(element.find(_oai('header'))),
+                           etree.tostring(element, with_tail=False))
+                _drop(element)
+            elif element.tag == _oai('repositoryName') and \
+                    parent.tag == _static('Identify'):
+                self.repository_name = element.text
@@ -0,0 +1,161 @@
+'''Streaming parser for OAI-PMH list responses.
+
+pyoai parses every response into a whole tree before reading the records.
+The client here spools ListRecords and ListIdentifiers responses to a
+temporary file and parses them with iterparse, handing out each record as
+soon as it is complete and dropping it from the tree afterwards, so that
+memory is bounded by one record rather than one page.
+'''
+import time
+import shutil
+import tempfile
+
+from lxml import etree
+
+from oaipmh import common, error, validation
+from oaipmh.datestamp import datestamp_to_datetime, datetime_to_datestamp
+
+from scheduler import ScheduledClient
+
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+STREAMED_VERBS = ('ListIdentifiers', 'ListRecords')
+# Responses up to this size are spooled in memory, larger ones on disk.
+SPOOL_SIZE = 1024 * 1024
+
+ERROR_CODES = ('badArgument', 'badResumptionToken', 'badVerb',
+               'cannotDisseminateFormat', 'idDoesNotExist', 'noRecordsMatch',
+               'noMetadataFormats', 'noSetHierarchy')
+
+
+def _oai(tag):
+    return '{%s}%s' % (OAI_NS, tag)
+
+
+def _raise_error(element):
+    code = element.get('code')
+    if code not in ERROR_CODES:
+        raise error.UnknownError(
+            'Unknown error code from server: %s, message: %s' % (
+                code, element.text))
+    raise getattr(error, code[0].upper() + code[1:] + 'Error')(element.text)
+
+
+def _header(element):
+    return common.Header(
+        element.findtext(_oai('identifier'), ''),
+        datestamp_to_datetime(element.findtext(_oai('datestamp'), '')),
+        [spec.text for spec in element.findall(_oai('setSpec'))],
+        element.get('status') == 'deleted')
+
+
+def _drop(element):
+    '''Detach a handled element from the tree. Callers keeping parts of it
+    can still use them.
+    '''
+    parent = element.getparent()
+    if parent is not None:
+        parent.remove(element)
+
+
+def parse_list(f, verb, metadata_prefix=None, metadata_registry=None,
+               raw=False):
+    '''Parse a ListRecords or ListIdentifiers response from a file. Yields
+    (header, metadata, None) for each record, or (header, serialized record)
+    if raw is true, or the header of each item of ListIdentifiers, then the
+    resumption token (None at the end of the list) as the last item.
+    '''
+    item_tag = _oai('record') if verb == 'ListRecords' else _oai('header')
+    list_tag = _oai(verb)
+    token = None
+    for event, element in etree.iterparse(f, events=('end',)):
+        if element.tag == item_tag and \
+                element.getparent().tag == list_tag:
+            if verb == 'ListRecords' and raw:
+                yield (_header(element.find(_oai('header'))),
+                       etree.tostring(element, with_tail=False))
+            elif verb == 'ListRecords':
+                header = _header(element.find(_oai('header')))
+                metadata_node = element.find(_oai('metadata'))
+                metadata = None
+                if metadata_node is not None:
+                    metadata = metadata_registry.readMetadata(
+                        metadata_prefix, metadata_node)
+                yield header, metadata, None
+            else:
+                yield _header(element)
+            _drop(element)
+        elif element.tag == _oai('resumptionToken'):
+            token = (element.text or '').strip() or None
+        elif element.tag == _oai('error'):
+            _raise_error(element)
+    yield token
+
+
+class StreamingClient(ScheduledClient):
+    '''Scheduled client which streams the records and headers of list
+    responses. Parts of the metadata which are nodes must be used before
+    the next record is requested.
+
+    A list stops at the end of a page once the deadline (a time.time()
+    value) has passed, leaving the token of the next page in
+    resumption_token.
+    '''
+    deadline = None
+    resumption_token = None
+
+    def _spool(self, f):
+        spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        shutil.copyfileobj(f, spool)
+        spool.seek(0)
+        return spool
+
+    def _arguments(self, verb, kw):
+        if 'resumptionToken' in kw:
+            # Goes on with a list cut short by the deadline.
+            if len(kw) > 1:
+                raise error.BadArgumentError(
+                    'resumptionToken is an exclusive argument')
+            return kw
+        validation.validateArguments(verb, kw)
+        for key, name in (('from_', 'from'), ('until', 'until')):
+            value = kw.pop(key, None)
+            if value is not None:
+                kw[name] = datetime_to_datestamp(value,
+                                                 self._day_granularity)
+        return kw
+
+    def handleVerb(self, verb, kw):
+        if verb not in STREAMED_VERBS:
+            return ScheduledClient.handleVerb(self, verb, kw)
+        return self._stream(verb, self._arguments(verb, kw))
+
+    def listRawRecords(self, **kw):
+        '''Like listRecords, but yield the header and the serialization of
+        each record instead of reading its metadata.
+        '''
+        return self._stream('ListRecords', self._arguments('ListRecords', kw),
+                            raw=True)
+
+    def _stream(self, verb, kw, raw=False):
+        metadata_prefix = kw.get('metadataPrefix')
+        self.resumption_token = None
+        while kw is not None:
+            spool = self._request(dict(kw, verb=verb), self._spool)
+            try:
+                items = parse_list(spool, verb, metadata_prefix,
+                                   self._metadata_registry, raw)
+                token = None
+                for item in items:
+                    if item is None or isinstance(item, basestring):
+                        token = item
+                    else:
+                        yield item
+            except etree.XMLSyntaxError:
+                raise error.XMLSyntaxError(kw)
+            finally:
+                spool.close()
+            kw = {'resumptionToken': token} if token else None
+            if kw and self.deadline is not None and \
+                    time.time() >= self.deadline:
+                self.resumption_token = token
+                return
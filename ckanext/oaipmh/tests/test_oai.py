@@ -7,11 +7,18 @@ import urllib2
 from StringIO import StringIO
 import json
 import contextlib
+import re
+import time
+import threading
+import gzip
+import pstats
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 
 import testdata
 
-from ckan.model import Session, Package, User, Group
+from ckan.model import Session, Package, User, Group, Member
 import ckan.model as model
 from ckan.tests import CreateTestData
 from ckan.lib.helpers import url_for
@@ -27,11 +34,27 @@ from oaipmh import metadata
 import oaipmh.client
 from pylons import config
 
+from ckanext.oaipmh import harvester
 from ckanext.oaipmh.harvester import OAIPMHHarvester
 from ckanext.harvest.model import HarvestJob, HarvestSource, HarvestObject,\
                                   HarvestGatherError, HarvestObjectError, setup
 
 from ckanext.oaipmh.oaipmh_server import CKANServer
+from ckanext.oaipmh.model import oai_change_journal_table, compact_journal
+from ckanext.oaipmh.model import due_retries, parked_retries, forget_retry
+from ckanext.oaipmh.model import unpark_retries
+from ckanext.oaipmh import snapshot
+from ckanext.oaipmh import throttle
+from ckanext.oaipmh import replica
+from ckanext.oaipmh import profiling
+from ckanext.oaipmh import prefetch
+from ckanext.oaipmh import catalogue_index
+from ckanext.oaipmh import loadtest
+from ckanext.oaipmh import scheduler
+from ckanext.oaipmh.streaming import parse_list, StreamingClient
+from ckanext.oaipmh import source_index
+from ckanext.oaipmh import dataconverter
+from ckanext.oaipmh import serializer
 from ckanext.oaipmh.rdftools import rdf_reader, rdf_writer
 
 
@@ -140,6 +163,30 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
     def test_list_sets(self):
         body = self._oai_get_method_and_validate('?verb=ListSets')
         self.assert_('roger' in body)
+        sets = CKANServer().listSets()
+        self.assert_(CKANServer().listSets(cursor=3, batch_size=4) == sets[3:7])
+        res = self.app.get(self.base_url + '?verb=ListSets')
+        etag = res.headers['ETag']
+        self.assert_('max-age' in res.headers['Cache-Control'])
+        res = self.app.get(self.base_url + '?verb=ListSets',
+                           headers={'If-None-Match': etag}, status=304)
+        for header in ('"a", W/%s' % etag, '*'):
+            self.app.get(self.base_url + '?verb=ListSets',
+                         headers={'If-None-Match': header}, status=304)
+        # A tag which only contains the current one does not match.
+        self.app.get(self.base_url + '?verb=ListSets',
+                     headers={'If-None-Match': '"x%s"' % etag.strip('"')},
+                     status=200)
+        model.repo.new_revision()
+        Session.add(Group(name=u'roger_cached', description=u''))
+        model.repo.commit()
+        res = self.app.get(self.base_url + '?verb=ListSets')
+        self.assert_(res.headers['ETag'] != etag)
+        body = self._oai_get_method_and_validate(
+            '?verb=ListSets&resumptionToken=%s' % re.search(
+                '<resumptionToken[^>]*>(.*)</resumptionToken>',
+                res.body).group(1))
+        self.assert_('<setSpec>' in body)
 
     def test_list_records(self):
         # All or nothing
@@ -272,6 +319,28 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         for rec in recs:
             self.assert_(rec)
 
+    def test_serializer(self):
+        def dated(body):
+            return re.sub('<responseDate>.*</responseDate>', '', body)
+        for prefix, writer in (('oai_dc', oai_dc_writer), ('rdf', rdf_writer)):
+            registry = metadata.MetadataRegistry()
+            registry.registerWriter(prefix, writer)
+            tree = BatchingServer(CKANServer(), metadata_registry=registry)
+            direct = serializer.RecordServer(CKANServer(),
+                                             metadata_registry=registry)
+            request = {'verb': 'ListRecords', 'metadataPrefix': prefix}
+            while request:
+                body = direct.handleRequest(request)
+                self.assert_(dated(body) ==
+                             dated(tree.handleRequest(request)))
+                self.assert_(oaischema.validate(etree.fromstring(body)))
+                token = re.search('<resumptionToken>(.*)</resumptionToken>',
+                                  body)
+                request = token and {'verb': 'ListRecords',
+                                     'resumptionToken': token.group(1)}
+        timings = serializer.benchmark(10, 1)
+        self.assert_(sorted(timings) == ['oai_dc', 'rdf'])
+
     def test_list_metadata(self):
         self._oai_get_method_and_validate('?verb=ListMetadataFormats')
 
@@ -290,6 +359,320 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         self.assert_(oaischema.validate(etree.fromstring(res.body)))
         self.assert_("abraham" in res.body)
 
+    def test_datestamps(self):
+        body = self._oai_get_method_and_validate('?verb=Identify')
+        self.assert_('<granularity>YYYY-MM-DDThh:mm:ssZ</granularity>' in body)
+        pkg = Package.get(u'homer')
+        modified = pkg.metadata_modified.replace(microsecond=0)
+        stamp = modified.strftime('%Y-%m-%dT%H:%M:%SZ')
+        body = self._oai_get_method_and_validate('?verb=GetRecord&identifier=%s&metadataPrefix=oai_dc' % pkg.id)
+        self.assert_('<datestamp>%s</datestamp>' % stamp in body)
+        server = CKANServer()
+        ids = [h.identifier() for h in
+               server.listIdentifiers('oai_dc', from_=modified, until=modified)]
+        self.assert_(pkg.id in ids)
+        later = modified + timedelta(seconds=1)
+        ids = [h.identifier() for h in
+               server.listIdentifiers('oai_dc', from_=later)]
+        self.assert_(pkg.id not in ids)
+
+    def test_deleted_records(self):
+        model.repo.new_revision()
+        pkg = Package(name=u'withdrawn', title=u'Withdrawn')
+        Session.add(pkg)
+        model.repo.commit()
+        model.repo.new_revision()
+        pkg = Package.get(u'withdrawn')
+        pkg.state = u'deleted'
+        model.repo.commit()
+        body = self._oai_get_method_and_validate('?verb=Identify')
+        self.assert_('<deletedRecord>persistent</deletedRecord>' in body)
+        body = self._oai_get_method_and_validate('?verb=GetRecord&identifier=%s&metadataPrefix=oai_dc' % pkg.id)
+        self.assert_('status="deleted"' in body)
+        self.assert_('<metadata>' not in body)
+        dates = datetime.utcnow() - timedelta(days=1)
+        headers = CKANServer().listIdentifiers('oai_dc', from_=dates)
+        deleted = [h.identifier() for h in headers if h.isDeleted()]
+        self.assert_(pkg.id in deleted)
+        # A package which has never been public is not a record at all.
+        model.repo.new_revision()
+        Session.add(Package(name=u'unpublished', private=True))
+        model.repo.commit()
+        hidden = Package.get(u'unpublished')
+        model.repo.new_revision()
+        hidden.state = u'deleted'
+        model.repo.commit()
+        identifiers = [h.identifier() for h in
+                       CKANServer().listIdentifiers('oai_dc')] + \
+            [h.identifier() for h in
+             CKANServer().listIdentifiers('oai_dc', from_=dates)]
+        self.assert_(hidden.id not in identifiers)
+
+    def test_change_journal(self):
+        server = CKANServer()
+        since = datetime.utcnow().replace(microsecond=0)
+        model.repo.new_revision()
+        pkg = Package.get(u'beer')
+        pkg.title = u'Beer changed'
+        model.repo.commit()
+        model.repo.new_revision()
+        pkg = Package.get(u'beer')
+        pkg.notes = u'Changed twice'
+        model.repo.commit()
+        headers = server.listIdentifiers('oai_dc', from_=since)
+        ids = [h.identifier() for h in headers]
+        self.assert_(ids.count(pkg.id) == 1)
+        self.assert_(Package.get(u'lisa').id not in ids)
+        roger = Group.get('roger')
+        self.assert_(pkg.id in [h.identifier() for h in server.listIdentifiers(
+            'oai_dc', set=roger.id, from_=since)])
+        self.assert_(pkg.id not in [h.identifier() for h in
+                                    server.listIdentifiers(
+                                        'oai_dc', set=Group.get('roger1').id,
+                                        from_=since)])
+        journal = oai_change_journal_table
+        before = Session.query(journal).count()
+        self.assert_(compact_journal() > 0)
+        self.assert_(Session.query(journal).count() < before)
+        self.assert_([h.identifier() for h in server.listIdentifiers(
+            'oai_dc', from_=since)] == ids)
+
+    def test_header_pages(self):
+        model.repo.new_revision()
+        Session.add(Package(name=u'paged-withdrawn', title=u'Withdrawn'))
+        model.repo.commit()
+        model.repo.new_revision()
+        pkg = Package.get(u'paged-withdrawn')
+        pkg.state = u'deleted'
+        model.repo.commit()
+        server = CKANServer()
+        headers = server.listIdentifiers('oai_dc')
+        self.assert_((pkg.id, True) in
+                     [(h.identifier(), h.isDeleted()) for h in headers])
+        paged, cursor = [], 0
+        while True:
+            page = server.listIdentifiers('oai_dc', cursor=cursor,
+                                          batch_size=4)
+            paged.extend(page)
+            cursor += 4
+            if len(page) < 4:
+                break
+        self.assert_([(h.identifier(), h.isDeleted()) for h in paged] ==
+                     [(h.identifier(), h.isDeleted()) for h in headers])
+        records = server.listRecords('oai_dc', cursor=2, batch_size=3)
+        self.assert_([r[0].identifier() for r in records] ==
+                     [h.identifier() for h in headers[2:5]])
+
+    def test_replica(self):
+        self.assert_(replica.session() is Session)
+        primary = [h.identifier() for h in
+                   CKANServer().listIdentifiers('oai_dc')]
+        # The database itself stands in for a replica without lag.
+        config['ckanext.oaipmh.replica.url'] = config['sqlalchemy.url']
+        try:
+            session = replica.session()
+            self.assert_(session is replica.ReadSession)
+            self.assert_(replica.lag() == 0)
+            self.assert_([h.identifier() for h in CKANServer(session).
+                          listIdentifiers('oai_dc')] == primary)
+            body = self._oai_get_method_and_validate(
+                '?verb=ListRecords&metadataPrefix=oai_dc')
+            self.assert_(primary[0] in body)
+            config['ckanext.oaipmh.replica.max_lag'] = '-1'
+            self.assert_(replica.session() is Session)
+        finally:
+            del config['ckanext.oaipmh.replica.url']
+            config.pop('ckanext.oaipmh.replica.max_lag', None)
+            replica.remove()
+
+    def test_catalogue_index(self):
+        def pages(**kw):
+            return [[(header.identifier(), header.isDeleted())
+                     for header in CKANServer().listIdentifiers(
+                         'oai_dc', cursor=cursor, batch_size=4, **kw)]
+                    for cursor in (0, 3, 6)]
+        since = {'from_': datetime(2000, 1, 1)}
+        in_set = {'set': 'roger'}
+        expected = pages(**since), pages(**in_set)
+        config['ckanext.oaipmh.catalogue_index'] = 'true'
+        try:
+            index = catalogue_index.rebuild()
+            self.assert_(len(index) >= 10)
+            self.assert_(pages(**since) == expected[0])
+            self.assert_(sorted(sum(pages(**in_set), [])) ==
+                         sorted(sum(expected[1], [])))
+            # Catching up without a change keeps the walked cursors.
+            checkpoints = dict(index._checkpoints)
+            index.apply(catalogue_index._latest_entries(
+                0, datetime.utcnow() - catalogue_index.LATE_COMMIT))
+            self.assert_(checkpoints and index._checkpoints == checkpoints)
+            # Pages of all records are read at their position.
+            everything = index.page(None, None, None, 0, None)
+            self.assert_(index.page(None, None, None, 3, 4) ==
+                         everything[3:7])
+            # A change is seen by the next request of the process.
+            model.repo.new_revision()
+            package = Package.get(u'homer')
+            package.notes = u'Changed'
+            model.repo.commit()
+            last = CKANServer().listIdentifiers('oai_dc', **since)[-1]
+            self.assert_(last.identifier() == package.id)
+        finally:
+            del config['ckanext.oaipmh.catalogue_index']
+
+    def test_prefetch(self):
+        def page(cursor):
+            return [(header.identifier(), fields) for header, fields in
+                    CKANServer().listRecordFields('oai_dc', cursor=cursor,
+                                                  batch_size=4)]
+        first, second = page(0), page(3)
+        self.assert_(prefetch.get_prefetcher() is None)
+        config['ckanext.oaipmh.prefetch'] = 'true'
+        prefetcher = prefetch.get_prefetcher()
+        prefetcher.wait = 10
+        try:
+            self.assert_(page(0) == first)
+            # Read ahead after the first page.
+            self.assert_(page(3) == second)
+            self.assert_(prefetcher.hits == 1)
+            # A page still being read is not waited for long.
+            slow = prefetch.Prefetcher(wait=0.01)
+            release = threading.Event()
+            slow.schedule('page', lambda: release.wait(10) and [])
+            self.assert_(slow.take('page') is None)
+            release.set()
+            time.sleep(0.1)
+            self.assert_(slow.take('page') is None)
+        finally:
+            del config['ckanext.oaipmh.prefetch']
+            prefetcher.clear()
+
+    def test_profiling(self):
+        self.assert_(profiling.for_request() is profiling.NO_PROFILE)
+        directory = tempfile.mkdtemp()
+        config['ckanext.oaipmh.profile.dir'] = directory
+        config['ckanext.oaipmh.profile.rate'] = '1'
+        try:
+            self._oai_get_method_and_validate(
+                '?verb=ListIdentifiers&metadataPrefix=oai_dc')
+            names = os.listdir(directory)
+            self.assert_(len(names) == 1)
+            self.assert_('verb=ListIdentifiers' in names[0])
+            self.assert_('prefix=oai_dc' in names[0])
+            self.assert_('records=10' in names[0])
+            stats = pstats.Stats(os.path.join(directory, names[0]))
+            self.assert_(stats.total_calls > 0)
+        finally:
+            del config['ckanext.oaipmh.profile.dir']
+            del config['ckanext.oaipmh.profile.rate']
+            shutil.rmtree(directory)
+
+    def test_set_specs(self):
+        roger = Group.get('roger')
+        model.repo.new_revision()
+        subset = Group(name=u'roger - sub', description=u'roger - sub')
+        Session.add(subset)
+        subset.save()
+        subset.add_package_by_name(u'homer')
+        model.repo.commit()
+        subset = Group.get(u'roger - sub')
+        spec = '%s:%s' % (roger.id, subset.id)
+        specs = [set_spec for set_spec, _, _ in CKANServer().listSets()]
+        self.assert_(spec in specs)
+        body = self._oai_get_method_and_validate('?verb=GetRecord&identifier=homer&metadataPrefix=oai_dc')
+        self.assert_('<setSpec>%s</setSpec>' % roger.id in body)
+        self.assert_('<setSpec>%s</setSpec>' % spec in body)
+        body = self._oai_get_method_and_validate('?verb=ListIdentifiers&metadataPrefix=oai_dc&set=%s' % spec)
+        self.assert_(Package.get(u'homer').id in body)
+        self.assert_(Package.get(u'lisa').id not in body)
+
+    def test_snapshot(self):
+        root = tempfile.mkdtemp()
+        config['ckanext.oaipmh.snapshot.dir'] = root
+        config['ckanext.oaipmh.snapshot.page_size'] = '5'
+        try:
+            generation = snapshot.build()
+            body = self._oai_get_method_and_validate('?verb=ListRecords&metadataPrefix=oai_dc')
+            token = re.search('<resumptionToken>(.*)</resumptionToken>', body).group(1)
+            self.assert_(token == 'snapshot.%s.oai_dc.1' % generation)
+            res = self.app.get(self.base_url + '?verb=ListRecords&resumptionToken=%s' % token,
+                               headers={'Accept-Encoding': 'gzip'})
+            self.assert_(res.headers['Content-Encoding'] == 'gzip')
+            body = self._oai_get_method_and_validate('?verb=ListRecords&resumptionToken=%s' % token)
+            self.assert_('resumptionToken="%s"' % token in body)
+            # Selective requests still go to the live server.
+            body = self._oai_get_method_and_validate('?verb=ListRecords&metadataPrefix=oai_dc&set=roger')
+            self.assert_('snapshot.' not in body)
+            self.assert_(snapshot.refresh() == generation)
+        finally:
+            del config['ckanext.oaipmh.snapshot.dir']
+            del config['ckanext.oaipmh.snapshot.page_size']
+            shutil.rmtree(root)
+
+    def test_snapshot_outside_request(self):
+        root = tempfile.mkdtemp()
+        config['ckanext.oaipmh.snapshot.dir'] = root
+        no_routes = mock.Mock(side_effect=RuntimeError('No request'))
+        try:
+            # As in the paster commands, nothing can be routed.
+            with mock.patch('ckanext.oaipmh.serializer.url_for', no_routes), \
+                    mock.patch('ckanext.oaipmh.oaipmh_server.url_for',
+                               no_routes):
+                generation = snapshot.build()
+            f = gzip.open(snapshot.page_path(root, generation, 'oai_dc', 0))
+            try:
+                body = f.read()
+            finally:
+                f.close()
+            self.assert_(oaischema.validate(etree.fromstring(body)))
+            self.assert_('<dc:identifier>%s/dataset/' %
+                         config.get('ckan.site_url', '').rstrip('/') in body)
+            self.assert_('>%s</request>' % self.base_url in body)
+        finally:
+            del config['ckanext.oaipmh.snapshot.dir']
+            shutil.rmtree(root)
+
+    def test_throttle(self):
+        limits = throttle.Throttle({'ListRecords': 1}, {'heavy': (1.0, 2.0)}, 7)
+        self.assert_(limits.admit('ListRecords', 'a', now=100.0) == 0)
+        # The cap is reached, but cheap verbs have their own budget.
+        self.assert_(limits.admit('ListRecords', 'b', now=100.0) == 7)
+        self.assert_(limits.admit('Identify', 'b', now=100.0) == 0)
+        limits.release('ListRecords')
+        self.assert_(limits.admit('ListIdentifiers', 'a', now=100.0) == 0)
+        # The bucket of client a is empty until a second has passed.
+        self.assert_(limits.admit('ListRecords', 'a', now=100.0) == 1)
+        self.assert_(limits.admit('ListRecords', 'a', now=101.0) == 0)
+        saved = throttle._throttle
+        throttle._throttle = throttle.Throttle({'ListRecords': 0}, retry_after=5)
+        try:
+            res = self.app.get(self.base_url + '?verb=ListRecords&metadataPrefix=oai_dc', status=503)
+            self.assert_(res.headers['Retry-After'] == '5')
+            self._oai_get_method_and_validate('?verb=Identify')
+        finally:
+            throttle._throttle = saved
+
+    def test_loadtest(self):
+        identifiers = loadtest.sample_identifiers(self.app, self.base_url)
+        self.assert_(Package.get(u'homer').id in identifiers)
+        queries = loadtest.synthetic_mix(20, identifiers)
+        queries += loadtest.recorded_mix([
+            '127.0.0.1 - - "GET /oai?verb=ListRecords&metadataPrefix=oai_dc HTTP/1.1" 200',
+            'verb=ListIdentifiers&resumptionToken=abc',
+            'verb=GetRecord&metadataPrefix=oai_dc&identifier=missing'])
+        self.assert_(len(queries) == 22)
+        stats = loadtest.run(self.app.app, queries, concurrency=3,
+                             base_url=self.base_url)
+        summary = stats.summary()
+        self.assert_(sum(row['requests'] for row in summary.values()) >= 22)
+        self.assert_(summary['ListRecords']['requests'] >
+                     len([q for q in queries if 'ListRecords' in q]))
+        self.assert_(summary['GetRecord']['errors'].get('idDoesNotExist'))
+        self.assert_(summary['ListRecords']['error_rate'] == 0)
+        self.assert_(summary['ListRecords']['p50'] <=
+                     summary['ListRecords']['p99'])
+        self.assert_(len(stats.report()) > len(summary))
+
     def test_errors(self):
         self._oai_get_method_and_validate('')
         self._oai_get_method_and_validate('?verbi=GetRecordi')
@@ -313,14 +696,14 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         metadata_registry.registerReader('oai_dc', oai_dc_reader)
         metadata_registry.registerWriter('oai_dc', oai_dc_writer)
         serv = BatchingServer(client, metadata_registry=metadata_registry)
-        oaipmh.client.Client = mock.Mock(return_value=ServerClient(serv, metadata_registry))
+        harvester.StreamingClient = mock.Mock(return_value=ServerClient(serv, metadata_registry))
         harvest_job, harv = self._create_harvester_info(config=config)
         harvest_obj_list = harv.gather_stage(harvest_job)
         harvest_object = HarvestObject.get(harvest_obj_list[0])
         harv.fetch_stage(harvest_object)
         return harvest_object, harv
 
-    def _side_effect_identify_listsets(self, foo):
+    def _side_effect_identify_listsets(self, foo, timeout=None):
         if self._first == 1:
             self._first = 2
             return StringIO(testdata.identify)
@@ -347,6 +730,83 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         errs = Session.query(HarvestGatherError).all()
         self.assert_(errs[0].message == 'Could not gather anything from http://foo!')
 
+    def test_scheduler(self):
+        host = scheduler.HostScheduler(max_concurrency=2, target_latency=1.0)
+        for i in range(host.increase_after):
+            host.acquire()
+            host.release(0.1)
+        self.assert_(host.limit == 2)
+        host.acquire()
+        host.release(5.0)
+        self.assert_(host.limit == 1)
+        responses = [urllib2.HTTPError('http://scheduler.test/oai', 503,
+                                       'Busy', {'Retry-After': '0'}, None),
+                     StringIO('<ok/>')]
+        def side_effect(request, timeout=None):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        urllib2.urlopen = mock.Mock(side_effect=side_effect)
+        client = scheduler.ScheduledClient('http://scheduler.test/oai',
+                                           max_attempts=2)
+        client._scheduler.backoff = 0
+        self.assert_(client.makeRequest(verb='Identify') == '<ok/>')
+        self.assert_(urllib2.urlopen.call_args[1]['timeout'] == 30.0)
+        urllib2.urlopen = mock.Mock(side_effect=urllib2.URLError('down'))
+        self.assertRaises(scheduler.TransientError, client.makeRequest,
+                          verb='Identify')
+        # A response still arriving after its deadline is given up.
+        urllib2.urlopen = mock.Mock(side_effect=lambda request, timeout: \
+            StringIO('<ok/>'))
+        client._response_deadline = -1
+        self.assertRaises(scheduler.TransientError, client.makeRequest,
+                          verb='Identify')
+        # Any other failure gives its slot back too.
+        urllib2.urlopen = mock.Mock(side_effect=ValueError('unknown url type'))
+        self.assertRaises(ValueError, client.makeRequest, verb='Identify')
+        self.assert_(client._scheduler.running == 0)
+        urllib2.urlopen = realopen
+        # Waiting for a slot is bounded.
+        host = scheduler.HostScheduler(slot_timeout=0.1)
+        host.acquire()
+        self.assertRaises(scheduler.TransientError, host.acquire)
+        host.release(0.1)
+        host.acquire()
+
+    def test_harvest_budget(self):
+        xml = self._oai_get_method_and_validate(
+            '?verb=ListIdentifiers&metadataPrefix=oai_dc')
+        urllib2.urlopen = mock.Mock(side_effect=lambda request, timeout: \
+            StringIO(xml))
+        client = StreamingClient('http://budget.test/oai')
+        client.deadline = time.time() - 1
+        headers = list(client.listIdentifiers(metadataPrefix='oai_dc'))
+        urllib2.urlopen = realopen
+        # The list stops after the first page, which has a next one.
+        self.assert_(len(headers) == 10)
+        self.assert_(client.resumption_token)
+
+    def test_streaming_parser(self):
+        xml = self._oai_get_method_and_validate(
+            '?verb=ListRecords&metadataPrefix=oai_dc')
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_reader)
+        items = list(parse_list(StringIO(xml), 'ListRecords', 'oai_dc',
+                                registry))
+        # Ten records to a page.
+        self.assert_(items.pop())
+        self.assert_(len(items) == 10)
+        header, metadata, _ = items[0]
+        self.assert_(header.identifier())
+        self.assert_(metadata is None or 'title' in metadata.getMap())
+        xml = self._oai_get_method_and_validate(
+            '?verb=ListIdentifiers&metadataPrefix=oai_dc')
+        items = list(parse_list(StringIO(xml), 'ListIdentifiers'))
+        self.assert_(items.pop())
+        self.assert_(len(items) == 10)
+        self.assert_(all(header.identifier() for header in items))
+
     def test_zharvester_import(self, mocked=True):
         harvest_object, harv = self._create_harvester()
         self.assert_(harv.info()['name'] == 'OAI-PMH')
@@ -373,6 +833,317 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         errs = Session.query(HarvestObjectError).all()
         self.assert_(len(errs) == 3)
 
+    def test_record_store(self):
+        store = tempfile.mkdtemp()
+        config['ckanext.oaipmh.harvest.record_store'] = store
+        try:
+            harvest_object, harv = self._create_harvester()
+            digest = json.loads(harvest_object.content)['digest']
+            self.assert_(os.path.exists(
+                os.path.join(store, digest[:2], digest + '.xml.gz')))
+            self.assert_(harv.import_stage(harvest_object))
+            self.assert_(harv.reimport(harvest_object.job.source.id) == 1)
+            # A record missing from the store is skipped.
+            os.remove(os.path.join(store, digest[:2], digest + '.xml.gz'))
+            self.assert_(harv.reimport(harvest_object.job.source.id) == 0)
+        finally:
+            del config['ckanext.oaipmh.harvest.record_store']
+            shutil.rmtree(store)
+        self.assertRaises(ValueError, harv.reimport)
+
+    def test_import_job(self):
+        config['ckanext.oaipmh.harvest.deferred_import'] = 'true'
+        try:
+            harvest_object, harv = self._create_harvester()
+            self.assert_(harv.import_stage(harvest_object))
+            self.assert_(harvest_object.content)
+            self.assert_(harv.import_job(harvest_object.job.id) >= 1)
+            self.assert_(HarvestObject.get(harvest_object.id).content is None)
+        finally:
+            del config['ckanext.oaipmh.harvest.deferred_import']
+
+    def test_source_index(self):
+        packages = source_index.PackageMap([(u'oai:a:1', u'p1', 'ab' * 20),
+                                            (u'oai:a:2', u'p2', None)])
+        self.assert_(packages.get(u'oai:a:1') == (u'p1', 'ab' * 20))
+        self.assert_(packages.get(u'oai:a:2') == (u'p2', None))
+        self.assert_(packages.get(u'oai:a:3') is None)
+        harvest_object, harv = self._create_harvester()
+        content = harvest_object.content
+        self.assert_(harv.import_stage(harvest_object))
+        # An unchanged record is not imported again.
+        again = HarvestObject(job=harvest_object.job, content=content)
+        again.save()
+        source_index.forget(again.job.id)
+        self.assert_(harv.import_stage(again))
+        self.assert_(again.package_id == harvest_object.package_id)
+        self.assert_(again.content is None)
+        # Objects of several jobs in turn use the index of each job.
+        index = source_index.for_job(again.job)
+        other, _ = self._create_harvester_info(config=False)
+        Session.flush()
+        self.assert_(source_index.for_job(other) is not index)
+        self.assert_(source_index.for_job(again.job) is index)
+        # The index of a finished job is dropped for the next one.
+        other.status = u'Finished'
+        Session.flush()
+        third, _ = self._create_harvester_info(config=False)
+        Session.flush()
+        source_index.for_job(third)
+        self.assert_(other.id not in source_index._indexes)
+        self.assert_(again.job.id in source_index._indexes)
+
+    def test_static_harvester(self):
+        records = ''.join(
+            '<oai:record><oai:header><oai:identifier>oai:static:%i'
+            '</oai:identifier><oai:datestamp>2012-01-01</oai:datestamp>'
+            '</oai:header><oai:metadata><oai_dc:dc '
+            'xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            '<dc:title>Static %i</dc:title><dc:date>2012-01-01</dc:date>'
+            '</oai_dc:dc></oai:metadata></oai:record>' % (i, i)
+            for i in range(3))
+        f = tempfile.NamedTemporaryFile(suffix='.xml')
+        f.write('<Repository xmlns="http://www.openarchives.org/OAI/2.0/'
+                'static-repository" xmlns:oai="http://www.openarchives.org/'
+                'OAI/2.0/"><Identify><oai:repositoryName>Static'
+                '</oai:repositoryName></Identify><ListRecords '
+                'metadataPrefix="oai_dc">%s</ListRecords></Repository>'
+                % records)
+        f.flush()
+        config['ckanext.oaipmh.harvest.static_batch_size'] = '2'
+        try:
+            harvest_job, _ = self._create_harvester_info(config=False)
+            harvest_job.source.url = f.name
+            harv = harvester.OAIPMHStaticHarvester()
+            gathered = harv.gather_stage(harvest_job)
+            self.assert_(len(gathered) == 2)
+            for object_id in gathered:
+                self.assert_(harv.import_stage(HarvestObject.get(object_id)))
+            name = harv._package_name_from_identifier('oai:static:2')
+            self.assert_(Package.get(name).title == u'Static 2')
+        finally:
+            del config['ckanext.oaipmh.harvest.static_batch_size']
+            f.close()
+
+    def test_sharded_harvester(self):
+        harv = OAIPMHHarvester()
+        start, end = datetime(2012, 1, 1), datetime(2012, 3, 1, 12)
+        windows = harvester._date_windows(start, end, 4)
+        self.assert_(len(windows) == 4)
+        self.assert_(windows[0][0] == start and windows[-1][1] == end)
+        for (_, until), (from_, _) in zip(windows, windows[1:]):
+            self.assert_(from_ - until == timedelta(seconds=1))
+        shards = harv._shards([], {}, start, False)
+        self.assert_('from_' not in shards[0] and 'until' not in shards[-1])
+        shards = harv._shards([('a', 'A'), ('b', 'B')], {'from_': start},
+                              start, False)
+        self.assert_([shard.get('set') for shard in shards] ==
+                     ['a', 'b', None])
+        self.assert_(shards[-1]['rest'] and shards[-1]['sets'] == ['a', 'b'])
+        self.assert_(all(shard['from_'] == '2012-01-01T00:00:00'
+                         for shard in shards))
+        record = ('<record xmlns="http://www.openarchives.org/OAI/2.0/">'
+                  '<header><identifier>oai:shard:%s</identifier><datestamp>'
+                  '2012-01-01</datestamp></header><metadata><oai_dc:dc '
+                  'xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+                  'xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>'
+                  'Shard %s</dc:title><dc:date>2012-01-01</dc:date>'
+                  '</oai_dc:dc></metadata></record>')
+        items = [(oaipmh.common.Header('oai:shard:%s' % i, start, specs,
+                                       False), record % (i, i))
+                 for i, specs in (('1', ['b']), ('2', ['a', 'b']))]
+        harvest_job, _ = self._create_harvester_info(config=False)
+        harvest_object = HarvestObject(job=harvest_job)
+        harvest_object.content = json.dumps({
+            'fetch_type': 'shard', 'set': 'b', 'domain': 'Shards'})
+        harvest_object.save()
+        with contextlib.nested(
+                mock.patch.object(harvester, 'StreamingClient'),
+                mock.patch.object(harvester, 'get_fetch_publisher')) as \
+                (client, publisher):
+            client.return_value.listRawRecords.return_value = iter(items)
+            client.return_value.resumption_token = None
+            self.assert_(harv.fetch_stage(harvest_object))
+        sent = publisher.return_value.send.call_args_list
+        self.assert_(len(sent) == 1)
+        batch = HarvestObject.get(sent[0][0][0]['harvest_object_id'])
+        # The second record is kept by the shard of set a.
+        self.assert_(json.loads(batch.content)['digests'].keys() ==
+                     ['oai:shard:1'])
+        self.assert_(harv.import_stage(batch))
+        self.assert_(harv.import_stage(harvest_object))
+        self.assert_(harvest_object.content is None)
+        name = harv._package_name_from_identifier('oai:shard:1')
+        self.assert_(Package.get(name).title == u'Shard 1')
+        # The rest shard keeps the records without a set shard.
+        items = [(oaipmh.common.Header('oai:shard:%s' % i, start, specs,
+                                       False), record % (i, i))
+                 for i, specs in (('3', []), ('4', ['x', 'y']), ('5', ['a']),
+                                  ('6', ['a:c', 'b']))]
+        harvest_object = HarvestObject(job=harvest_job)
+        harvest_object.content = json.dumps({
+            'fetch_type': 'shard', 'rest': True, 'sets': ['a', 'b'],
+            'domain': 'Shards'})
+        harvest_object.save()
+        with contextlib.nested(
+                mock.patch.object(harvester, 'StreamingClient'),
+                mock.patch.object(harvester, 'get_fetch_publisher')) as \
+                (client, publisher):
+            client.return_value.listRawRecords.return_value = iter(items)
+            client.return_value.resumption_token = None
+            self.assert_(harv.fetch_stage(harvest_object))
+        sent = publisher.return_value.send.call_args_list
+        batch = HarvestObject.get(sent[0][0][0]['harvest_object_id'])
+        self.assert_(sorted(json.loads(batch.content)['digests']) ==
+                     ['oai:shard:3', 'oai:shard:4', 'oai:shard:6'])
+
+    def test_retry_queue(self):
+        harvest_job, harv = self._create_harvester_info(config=False)
+        Session.flush()
+        source_id = harvest_job.source.id
+        harvest_object = HarvestObject(job=harvest_job)
+        ident = {'fetch_type': 'record', 'record': 'oai:broken',
+                 'domain': 'Retry'}
+        harvest_object.content = json.dumps(ident)
+        harvest_object.save()
+
+        def gather():
+            with mock.patch.object(harvester, 'StreamingClient') as client:
+                client.return_value.identify.return_value = mock.Mock(**{
+                    'repositoryName.return_value': 'Retry',
+                    'earliestDatestamp.return_value': datetime(2012, 1, 1),
+                    'granularity.return_value': 'YYYY-MM-DDThh:mm:ssZ'})
+                client.return_value.listIdentifiers.return_value = [
+                    oaipmh.common.Header(i, datetime(2012, 1, 1), [], False)
+                    for i in ('oai:new', 'oai:broken')]
+                client.return_value.listSets.return_value = []
+                client.return_value.resumption_token = None
+                harv._set_config(None)
+                return [json.loads(HarvestObject.get(i).content)['record']
+                        for i in harv._gather_stage(harvest_job)]
+        config['ckanext.oaipmh.harvest.retry_backoff'] = '0'
+        config['ckanext.oaipmh.harvest.max_retries'] = '2'
+        try:
+            harv._retry_later(harvest_object, ident, 'syntax')
+            Session.commit()
+            self.assert_(due_retries(source_id) ==
+                         [('record', 'oai:broken', None)])
+            # Retries come first and are not gathered twice.
+            self.assert_(gather() == ['oai:broken', 'oai:new'])
+            harv._retry_later(harvest_object, ident, 'syntax')
+            Session.commit()
+            self.assert_(due_retries(source_id) == [])
+            self.assert_(('record', 'oai:broken') in
+                         parked_retries(source_id))
+            self.assert_(gather() == ['oai:new'])
+            self.assert_(unpark_retries(source_id) == 1)
+            self.assert_(due_retries(source_id))
+            forget_retry(source_id, 'record', 'oai:broken')
+            self.assert_(not due_retries(source_id))
+        finally:
+            del config['ckanext.oaipmh.harvest.retry_backoff']
+            del config['ckanext.oaipmh.harvest.max_retries']
+
+    def test_fetch_error_reported(self):
+        harvest_job, harv = self._create_harvester_info(config=False)
+        harvest_object = HarvestObject(job=harvest_job)
+        harvest_object.content = json.dumps(
+            {'fetch_type': 'record', 'record': 'oai:odd', 'domain': 'Odd'})
+        harvest_object.save()
+        with mock.patch.object(harvester, 'StreamingClient') as client:
+            client.return_value.makeRequest.side_effect = ValueError('odd')
+            self.assert_(harv.fetch_stage(harvest_object) == False)
+        errors = Session.query(HarvestObjectError).filter(
+            HarvestObjectError.harvest_object_id == harvest_object.id).all()
+        self.assert_(len(errors) == 1 and 'odd' in errors[0].message)
+
+    def test_requeue_to_retry_queue(self):
+        from ckanext.harvest import queue
+        harvest_job, harv = self._create_harvester_info(config=False)
+        harvest_object = HarvestObject(job=harvest_job)
+        harvest_object.content = json.dumps(
+            {'fetch_type': 'record', 'record': 'oai:flaky', 'domain': 'Flaky'})
+        harvest_object.save()
+        job_id, source_id = harvest_job.id, harvest_job.source.id
+        published = [harvest_object.id]
+        publisher = mock.Mock()
+        publisher.send.side_effect = \
+            lambda body: published.append(body['harvest_object_id'])
+        config['ckanext.oaipmh.harvest.retry_backoff'] = '0'
+        try:
+            with mock.patch.object(harvester, 'StreamingClient') as client, \
+                    mock.patch.object(harvester, 'get_fetch_publisher',
+                                      return_value=publisher), \
+                    mock.patch.object(queue, 'PluginImplementations',
+                                      return_value=[harv]):
+                client.return_value.makeRequest.side_effect = \
+                    scheduler.TransientError('down')
+                # The fetch consumer, with its cap on deliveries.
+                while published:
+                    queue.fetch_callback(mock.Mock(), mock.Mock(), None,
+                                         json.dumps({'harvest_object_id':
+                                                     published.pop(0)}))
+            states = [o.state for o in Session.query(HarvestObject).filter(
+                HarvestObject.harvest_job_id == job_id)]
+            # The first attempt and five more, each in an object of its own.
+            self.assert_(sorted(states) == ['COMPLETE'] * 5 + ['ERROR'])
+            self.assert_(due_retries(source_id) ==
+                         [('record', 'oai:flaky', None)])
+        finally:
+            del config['ckanext.oaipmh.harvest.retry_backoff']
+
+    def test_harvest_withdraws_deleted_records(self):
+        harvest_job, harv = self._create_harvester_info(config=False)
+        name = harv._package_name_from_identifier('oai:gone')
+        model.repo.new_revision()
+        Session.add(Package(name=name))
+        Group.get('roger').add_package_by_name(name)
+        model.repo.commit()
+        with mock.patch.object(harvester, 'StreamingClient') as client:
+            client.return_value.identify.return_value = mock.Mock(**{
+                'repositoryName.return_value': 'Deleted',
+                'earliestDatestamp.return_value': datetime(2012, 1, 1),
+                'granularity.return_value': 'YYYY-MM-DDThh:mm:ssZ'})
+            client.return_value.listIdentifiers.return_value = [
+                oaipmh.common.Header('oai:gone', datetime(2012, 1, 1), [],
+                                     True),
+                oaipmh.common.Header('oai:kept', datetime(2012, 1, 1), [],
+                                     False)]
+            client.return_value.listSets.return_value = []
+            client.return_value.resumption_token = None
+            harv._set_config(None)
+            object_ids = harv._gather_stage(harvest_job)
+        infos = [json.loads(HarvestObject.get(i).content) for i in object_ids]
+        self.assert_([info['fetch_type'] for info in infos] ==
+                     ['record', 'deletions'])
+        self.assert_(infos[1]['records'] == ['oai:gone'])
+        self.assert_(harv._import(HarvestObject.get(object_ids[1])))
+        package = Package.by_name(name)
+        self.assert_(package.state == 'deleted')
+        self.assert_(Session.query(Member).filter(
+            Member.table_id == package.id).filter(
+            Member.state == 'active').count() == 0)
+
+    def test_sync_resources(self):
+        model.repo.new_revision()
+        pkg = Package.get('bart')
+        dataconverter._sync_resources(pkg, [
+            {'url': u'http://a/x.csv', 'name': u'Bart', 'format': u'csv'},
+            {'url': u'http://a/y', 'name': u'Bart', 'format': u'html'}])
+        model.repo.commit()
+        first = dict((r.url, r.id) for r in pkg.resources)
+        model.repo.new_revision()
+        dataconverter._sync_resources(pkg, [
+            {'url': u'http://a/x.csv', 'name': u'Bart', 'format': u'csv'},
+            {'url': u'http://a/z.pdf', 'name': u'Bart', 'format': u'pdf'}])
+        model.repo.commit()
+        pkg = Package.get('bart')
+        resources = dict((r.url, r.id) for r in pkg.resources)
+        self.assert_(sorted(resources) == [u'http://a/x.csv', u'http://a/z.pdf'])
+        # The unchanged resource is the same row.
+        self.assert_(resources[u'http://a/x.csv'] == first[u'http://a/x.csv'])
+
     def test_rdf_reader_writer(self):
         client = CKANServer()
         metadata_registry = metadata.MetadataRegistry()
@@ -401,7 +1172,7 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         metadata_registry.registerReader('rdf', rdf_reader)
         metadata_registry.registerWriter('rdf', rdf_writer)
         serv = BatchingServer(client, metadata_registry=metadata_registry)
-        oaipmh.client.Client = mock.Mock(return_value=ServerClient(serv,metadata_registry))
+        harvester.StreamingClient = mock.Mock(return_value=ServerClient(serv,metadata_registry))
         harvest_object, harv = self._create_harvester()
         self.assert_(harv.info()['name'] == 'OAI-PMH')
         real_content = json.loads(harvest_object.content)
@@ -414,7 +1185,7 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         metadata_registry.registerReader('oai_dc', oai_dc_reader)
         metadata_registry.registerWriter('oai_dc', oai_dc_writer)
         serv = BatchingServer(client, metadata_registry=metadata_registry)
-        oaipmh.client.Client = mock.Mock(return_value=ServerClient(serv, metadata_registry))
+        harvester.StreamingClient = mock.Mock(return_value=ServerClient(serv, metadata_registry))
         harv = OAIPMHHarvester()
         harvest_job = HarvestJob()
         harvest_job.source = HarvestSource()
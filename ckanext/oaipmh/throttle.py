@@ -0,0 +1,140 @@
+'''Admission control for the OAI-PMH interface.
+
+Each verb can have its own cap on concurrently served requests, and each
+client gets a token bucket for the heavy list verbs and another one for the
+light verbs, so that harvesters walking the list verbs cannot starve the
+cheap ones. Rejected requests are answered with 503 and Retry-After, as the
+OAI-PMH specification suggests for flow control. The limits are kept per
+process.
+'''
+import math
+import time
+import threading
+
+from pylons import config
+
+VERBS = ('GetRecord', 'Identify', 'ListIdentifiers', 'ListMetadataFormats',
+         'ListRecords', 'ListSets')
+HEAVY_VERBS = ('ListIdentifiers', 'ListRecords', 'ListSets')
+BUDGETS = ('heavy', 'light')
+
+
+class TokenBucket(object):
+    '''Allows rate requests per second on average and bursts of burst.
+    '''
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def _fill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def is_full(self, now):
+        self._fill(now)
+        return self.tokens >= self.burst
+
+    def wait(self, now):
+        '''Return the seconds until a token is available, 0 if one is.
+        '''
+        self._fill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Throttle(object):
+    '''Per-verb concurrency caps and per-client token buckets.
+
+    :param concurrency: maximum concurrent requests by verb, verbs which are
+                        not given are not limited
+    :param rates: (rate, burst) of the token buckets by budget, 'heavy' or
+                  'light', budgets which are not given are not limited
+    :param retry_after: seconds to wait when a concurrency cap is reached
+    :param max_clients: number of buckets kept before idle ones are dropped
+    '''
+    def __init__(self, concurrency=None, rates=None, retry_after=10,
+                 max_clients=10000):
+        self._lock = threading.Lock()
+        self._concurrency = concurrency or {}
+        self._running = dict((verb, 0) for verb in self._concurrency)
+        self._rates = rates or {}
+        self._buckets = {}
+        self._retry_after = retry_after
+        self._max_clients = max_clients
+
+    def _bucket(self, budget, client, now):
+        key = (budget, client)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._max_clients:
+                for idle in [k for k, b in self._buckets.items()
+                             if b.is_full(now)]:
+                    del self._buckets[idle]
+            rate, burst = self._rates[budget]
+            bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def admit(self, verb, client, now=None):
+        '''Try to admit a request. Return 0 if it is admitted, in which case
+        release() must be called once it is served, or otherwise the number
+        of seconds after which the client should retry.
+        '''
+        now = time.time() if now is None else now
+        budget = 'heavy' if verb in HEAVY_VERBS else 'light'
+        with self._lock:
+            if verb in self._concurrency and \
+                    self._running[verb] >= self._concurrency[verb]:
+                return self._retry_after
+            if budget in self._rates:
+                bucket = self._bucket(budget, client, now)
+                wait = bucket.wait(now)
+                if wait:
+                    return max(1, int(math.ceil(wait)))
+                bucket.take()
+            if verb in self._concurrency:
+                self._running[verb] += 1
+        return 0
+
+    def release(self, verb):
+        with self._lock:
+            if verb in self._concurrency:
+                self._running[verb] -= 1
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def _from_config():
+    concurrency = {}
+    for verb in VERBS:
+        value = config.get('ckanext.oaipmh.throttle.concurrency.%s' % verb)
+        if value:
+            concurrency[verb] = int(value)
+    rates = {}
+    for budget in BUDGETS:
+        rate = config.get('ckanext.oaipmh.throttle.rate.%s' % budget)
+        if rate:
+            rate = float(rate)
+            burst = config.get('ckanext.oaipmh.throttle.burst.%s' % budget)
+            rates[budget] = (rate, float(burst) if burst else max(rate, 1.0))
+    retry_after = int(config.get('ckanext.oaipmh.throttle.retry_after', 10))
+    return Throttle(concurrency, rates, retry_after)
+
+
+def get_throttle():
+    '''Return the throttle of this process, set up from the configuration.
+    '''
+    global _throttle
+    if _throttle is None:
+        with _throttle_lock:
+            if _throttle is None:
+                _throttle = _from_config()
+    return _throttle
@@ -38,5 +38,9 @@ setup(
 	# Add plugins here, eg
 	oaipmh=ckanext.oaipmh.plugin:OAIPMHPlugin
 	oaipmh_harvester=ckanext.oaipmh.harvester:OAIPMHHarvester
+	oaipmh_static_harvester=ckanext.oaipmh.harvester:OAIPMHStaticHarvester
+
+	[paste.paster_command]
+	oaipmh=ckanext.oaipmh.commands:OAIPMHCommand
 	""",
 )